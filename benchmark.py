@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+"""Micro benchmarks, run as: benchmark.py [benchmark names]*"""
+
+import os
+import sys
+import random
+import tempfile
+import time
+import zipfile
+from xml.sax.saxutils import escape
+from statistics import *
+from spreadsheet import *
+
+def _timed(fun, *args):
+    start = time.time()
+    fun(*args)
+    return time.time() - start
+
+def _product_combine(per_cell):
+    # What TrainingSet.score used to do: concatenate the cell lists with
+    # reduce, then multiply every probability
+    flattened = reduce(lambda x, y: x + y, per_cell)
+    numerator = reduce(lambda x, y: x * y, sorted(flattened, reverse=True)) * 1.0
+    denominator = numerator + reduce(lambda x, y: x * y, [1 - p for p in sorted(flattened)])
+    return numerator / denominator if denominator else float('nan')
+
+def _log_odds_combine(per_cell):
+    combined = BayesAccumulator()
+    for cell_probs in per_cell:
+        combined.extend(cell_probs)
+    return combined.probability
+
+def bench_combine():
+    """Combining 4 probabilities per cell, old product vs summed log odds"""
+    random.seed(0)
+    print '%10s %14s %14s %16s %12s' % ('cells', 'product (s)', 'log odds (s)', 'log odds us/cell', 'result')
+    for cells in (1000, 5000, 10000, 20000, 50000, 100000):
+        per_cell = [[random.uniform(0.2, 0.8) for i in range(4)] for j in range(cells)]
+        product = _timed(_product_combine, per_cell) if cells <= 20000 else None
+        log_odds_time = _timed(_log_odds_combine, per_cell)
+        print '%10d %14s %14.4f %16.3f %12g' % (cells, '%.4f' % product if product is not None else '-',
+                                                log_odds_time, log_odds_time * 1e6 / cells,
+                                                _log_odds_combine(per_cell))
+
+def _synthetic_value(col, row):
+    """A value like the ones generate_samples.write_doc puts in column col"""
+    kind = col % 4
+    if row == 0:
+        return (XlsType.xls_string, u'Column %d' % (col))
+    if random.random() < 0.1:
+        return (XlsType.xls_empty, u'')
+    if kind == 0:
+        return (XlsType.xls_string, u'ID' + str(random.randint(0, 99999)))
+    if kind == 1:
+        return (XlsType.xls_string, random.choice([u'red', u'green', u'blue', u'n/a']))
+    if kind == 2:
+        return (XlsType.xls_date, float(random.randint(40500, 41000)))
+    return (XlsType.xls_float, random.uniform(10, 4000))
+
+def synthetic_set(rows, cols, good_files, bad_files, set_class=None, **set_options):
+    """TrainingSet (or set_class, created with set_options) trained with 
+    random grids, without going through xlrd"""
+    from classifier import TrainingSet
+    tset = (set_class or TrainingSet)(0, rows - 1, 0, cols - 1, 0, **set_options)
+    for files, bad in ((good_files, False), (bad_files, True)):
+        for i in range(files):
+            for ndx, tcell in enumerate(tset.training_cells):
+                cell_type, cell_value = _synthetic_value(ndx % cols + (1 if bad else 0), ndx // cols)
+                if bad:
+                    tcell.bad(cell_type, cell_value)
+                else:
+                    tcell.good(cell_type, cell_value)
+    return tset
+
+def bench_storage():
+    """Size and load/save time of pickled vs binary (.bset) training sets"""
+    from set_io import open_training_set, save_training_set
+    random.seed(0)
+    directory = tempfile.mkdtemp()
+    print '%12s %8s %12s %10s %10s' % ('grid', 'format', 'size (KB)', 'save (s)', 'load (s)')
+    for rows, cols in ((50, 10), (200, 20), (500, 40)):
+        tset = synthetic_set(rows, cols, 40, 10)
+        for name in ('set.pickle', 'set.bset'):
+            path = os.path.join(directory, name)
+            save = _timed(save_training_set, tset, path)
+            load = _timed(open_training_set, path)
+            print '%12s %8s %12.1f %10.3f %10.3f' % ('%dx%d' % (rows, cols), name.split('.')[1],
+                                                    os.path.getsize(path) / 1024.0, save, load)
+            os.remove(path)
+    os.rmdir(directory)
+
+_xlsx_parts = {
+    '[Content_Types].xml': '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>',
+    '_rels/.rels': '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>',
+    'xl/workbook.xml': '<?xml version="1.0" encoding="UTF-8"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels': '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '<Relationship Id="rId2" Target="styles.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"/>'
+        '</Relationships>',
+    'xl/styles.xml': '<?xml version="1.0" encoding="UTF-8"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy\\-mm\\-dd"/></numFmts>'
+        '<fonts count="1"><font/></fonts><fills count="1"><fill/></fills><borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf/></cellStyleXfs>'
+        '<cellXfs count="2"><xf numFmtId="0"/><xf numFmtId="164" applyNumberFormat="1"/></cellXfs>'
+        '</styleSheet>',
+}
+
+def deep_size(obj):
+    """Bytes taken by obj and everything it references, each object
+    counted once. Classes and modules are not counted"""
+    seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(sys))):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        if hasattr(obj, '__dict__'):
+            pending.append(obj.__dict__)
+        for name in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, name):
+                pending.append(getattr(obj, name))
+    return size
+
+def bench_memory():
+    """Memory, training and scoring time of a TrainingSet vs a
+    CompactTrainingSet trained with the same grids"""
+    from classifier import TrainingSet, CompactTrainingSet
+    print '%12s %8s %18s %12s %10s %10s %10s' % ('grid', 'files', 'layout', 'size (KB)', 'bytes/cell',
+                                                  'train (s)', 'score (s)')
+    for rows, cols, good_files, bad_files in ((50, 10, 40, 10), (200, 20, 40, 10), (1000, 100, 4, 1)):
+        grid = [[_synthetic_value(col, row) for col in range(cols)] for row in range(rows)]
+        inputs = [cell for row in grid for cell in row]
+        for set_class in (TrainingSet, CompactTrainingSet):
+            # The same random values for both layouts
+            random.seed(0)
+            start = time.time()
+            tset = synthetic_set(rows, cols, good_files, bad_files, set_class)
+            train = time.time() - start
+            start = time.time()
+            for tcell, (cell_type, cell_value) in zip(tset.training_cells, inputs):
+                tcell.score(cell_type, cell_value)
+            score = time.time() - start
+            size = deep_size(tset)
+            print '%12s %8d %18s %12.1f %10.1f %10.3f %10.3f' % ('%dx%d' % (rows, cols), good_files + bad_files,
+                                                                set_class.__name__, size / 1024.0,
+                                                                float(size) / (rows * cols), train, score)
+            del tset
+
+def bench_sketch():
+    """Memory per cell and scores of exact vs sketched (--sketch-values 64)
+    histograms as the files trained grow, a quarter of the columns hold
+    identifiers"""
+    rows, cols = 20, 8
+    print '%8s %12s %14s %10s %16s %16s' % ('files', 'sketch', 'bytes/cell', 'train (s)', 'mean score diff',
+                                            'max score diff')
+    for files in (100, 400, 1600):
+        random.seed(1)
+        grids = [[[_synthetic_value(col, row) for col in range(cols)] for row in range(rows)] for n in range(20)]
+        scored = {}
+        for sketch_size in (None, 64):
+            random.seed(0)
+            start = time.time()
+            tset = synthetic_set(rows, cols, files * 4 // 5, files // 5, sketch_size=sketch_size)
+            train = time.time() - start
+            scored[sketch_size] = [[p for tcell, (cell_type, cell_value) in zip(tset.training_cells, sum(grid, []))
+                                    for p in tcell.score(cell_type, cell_value)] for grid in grids]
+            diffs = [abs(a - b) for exact, sketched in zip(scored[None], scored[sketch_size])
+                     for a, b in zip(exact, sketched)]
+            print '%8d %12s %14.1f %10.3f %16.2g %16.2g' % (files, sketch_size or 'exact', 
+                                                            float(deep_size(tset)) / (rows * cols), train,
+                                                            sum(diffs) / len(diffs), max(diffs))
+
+def _column_name(col):
+    name = ''
+    col += 1
+    while col:
+        col, remainder = divmod(col - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+def write_xlsx(path, grid):
+    """Minimal .xlsx with one sheet holding grid, rows of (type, value),
+    strings inline and dates with a date style"""
+    rows = []
+    for row_ndx, row in enumerate(grid):
+        cells = []
+        for col, (cell_type, value) in enumerate(row):
+            ref = '%s%d' % (_column_name(col), row_ndx + 1)
+            if cell_type == XlsType.xls_string:
+                cells.append('<c r="%s" t="inlineStr"><is><t>%s</t></is></c>' % (ref, escape(value).encode('utf-8')))
+            elif cell_type == XlsType.xls_date:
+                cells.append('<c r="%s" s="1"><v>%r</v></c>' % (ref, value))
+            elif cell_type == XlsType.xls_float:
+                cells.append('<c r="%s"><v>%r</v></c>' % (ref, value))
+        rows.append('<row r="%d">%s</row>' % (row_ndx + 1, ''.join(cells)))
+    sheet = ('<?xml version="1.0" encoding="UTF-8"?>'
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+             '<sheetData>%s</sheetData></worksheet>' % (''.join(rows)))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, data in sorted(_xlsx_parts.items()):
+            z.writestr(name, data)
+        z.writestr('xl/worksheets/sheet1.xml', sheet)
+
+def write_xls(path, grid):
+    import xlwt
+    wbk = xlwt.Workbook()
+    sheet = wbk.add_sheet('Sheet1')
+    date_style = xlwt.easyxf(num_format_str='YYYY-MM-DD')
+    for row_ndx, row in enumerate(grid):
+        for col, (cell_type, value) in enumerate(row):
+            if cell_type == XlsType.xls_date:
+                sheet.write(row_ndx, col, value, date_style)
+            elif cell_type != XlsType.xls_empty:
+                sheet.write(row_ndx, col, value)
+    wbk.save(path)
+
+def write_csv(path, grid):
+    def field(cell_type, value):
+        if cell_type == XlsType.xls_date:
+            return xlrd.xldate.xldate_as_datetime(value, 0).strftime('%Y-%m-%d')
+        if cell_type == XlsType.xls_float:
+            return repr(value)
+        return value.encode('utf-8')
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        for row in grid:
+            writer.writerow([field(*cell) for cell in row])
+
+def _read_grid(path, rows, cols):
+    with open_workbook(path) as wb:
+        return list(cell_stream_from_sheet(wb.sheet_by_index(0), rows - 1, cols - 1,
+                                           row_values=lambda sheet, ndx: zip(sheet.row_types(ndx), sheet.row_values(ndx)),
+                                           empty_value=(XlsType.xls_empty, None)))
+
+def bench_readers():
+    """Cells per second streamed through cell_stream_from_sheet, per reader"""
+    random.seed(0)
+    directory = tempfile.mkdtemp()
+    writers = (('xls', write_xls), ('xlsx', write_xlsx), ('csv', write_csv))
+    print '%12s %8s %12s %10s %14s' % ('grid', 'format', 'size (KB)', 'read (s)', 'cells/s')
+    for rows, cols in ((100, 10), (1000, 20), (5000, 40)):
+        grid = [[_synthetic_value(col, row) for col in range(cols)] for row in range(rows)]
+        expected = None
+        for extension, write in writers:
+            path = os.path.join(directory, 'grid.' + extension)
+            write(path, grid)
+            seconds = _timed(_read_grid, path, rows, cols)
+            cells = _read_grid(path, rows, cols)
+            # Every reader must give the same cells
+            expected = expected or cells
+            assert cells == expected, extension
+            print '%12s %8s %12.1f %10.3f %14.0f' % ('%dx%d' % (rows, cols), extension,
+                                                    os.path.getsize(path) / 1024.0, seconds,
+                                                    rows * cols / seconds)
+            os.remove(path)
+    os.rmdir(directory)
+
+def _full_width_cells(sheet, end_row, end_col, start_row, start_col, row_values, empty_value):
+    # What cell_stream_from_sheet used to do: read every column of each
+    # row, then yield the cells and the padding one at a time
+    i = start_row - 1
+    for i in range(start_row, min(end_row + 1, sheet.nrows)):
+        row = row_values(sheet.row_types(i), sheet.row_values(i))
+        j = start_col - 1
+        for j in range(start_col, min(end_col + 1, len(row))):
+            yield row[j]
+        for j in range(j + 1, end_col + 1):
+            yield empty_value
+    for i_left in range(i + 1, end_row + 1):
+        for j_left in range(start_col, end_col + 1):
+            yield empty_value
+
+def _row_slice_cells(*args):
+    for row in row_slices_from_sheet(*args):
+        for cell in row:
+            yield cell
+
+def bench_rows():
+    """Window of a wide xls sheet, full rows cell by cell vs row slices"""
+    random.seed(0)
+    path = os.path.join(tempfile.mkdtemp(), 'wide.xls')
+    rows, cols = 2000, 200
+    write_xls(path, [[_synthetic_value(col, row) for col in range(cols)] for row in range(rows)])
+    pairs = lambda types, values: zip(types, values)
+    print '%16s %12s %12s %14s %14s' % ('window', 'cells', 'per cell (s)', 'row slices (s)', 'row cells/s')
+    with open_workbook(path) as wb:
+        sheet = wb.sheet_by_index(0)
+        for start_col, end_col, end_row in ((0, 9, rows - 1), (100, 109, rows - 1), (0, 199, rows - 1),
+                                            (0, 9, rows + 999)):
+            args = (sheet, end_row, end_col, 0, start_col, pairs, (XlsType.xls_empty, None))
+            assert list(_full_width_cells(*args)) == list(_row_slice_cells(*args))
+            per_cell = _timed(lambda: sum(1 for cell in _full_width_cells(*args)))
+            by_row = _timed(lambda: sum(len(row) for row in row_slices_from_sheet(*args)))
+            cells = (end_row + 1) * (end_col - start_col + 1)
+            print '%16s %12d %12.3f %14.3f %14.0f' % ('r0-%d c%d-%d' % (end_row, start_col, end_col), cells,
+                                                      per_cell, by_row, cells / by_row)
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+
+def bench_prefetch():
+    """Scoring files with 20ms of read latency, one at a time vs prefetched"""
+    from classifier import _score_file
+    from prefetch import prefetched, _read_file
+    random.seed(0)
+    directory = tempfile.mkdtemp()
+    rows, cols, files = 50, 10, 100
+    tset = synthetic_set(rows, cols, 20, 5).compile()
+    paths = [os.path.join(directory, 'book%d.xls' % (n)) for n in range(files)]
+    for path in paths:
+        write_xls(path, [[_synthetic_value(col, row) for col in range(cols)] for row in range(rows)])
+
+    def slow_read(path):
+        time.sleep(0.02)
+        return _read_file(path)
+
+    def score_all(concurrency):
+        for f, contents in prefetched(paths, concurrency, read=slow_read):
+            _score_file(tset, f, contents=slow_read(f) if concurrency < 1 else contents)
+
+    print '%12s %10s %12s' % ('threads', 'total (s)', 'files/s')
+    for concurrency in (0, 1, 2, 4, 8):
+        seconds = _timed(score_all, concurrency)
+        print '%12s %10.3f %12.1f' % (concurrency or 'none', seconds, files / seconds)
+    for path in paths:
+        os.remove(path)
+    os.rmdir(directory)
+
+benchmarks = {'combine': bench_combine,
+              'memory': bench_memory,
+              'prefetch': bench_prefetch,
+              'readers': bench_readers,
+              'rows': bench_rows,
+              'sketch': bench_sketch,
+              'storage': bench_storage}
+
+if __name__ == '__main__':
+    import sys
+    names = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in names:
+        print '== %s: %s' % (name, benchmarks[name].__doc__)
+        benchmarks[name]()
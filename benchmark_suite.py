@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""End to end benchmarks at several scales, on corpora written with
+generate_samples.write_corpus:
+
+    benchmark_suite.py [--scale name | --scale good=500,rows=50,cols=10,...]*
+                       [-o results.json] [--compare old_results.json]
+
+For every scale a corpus is generated from a fixed seed, a set is trained
+with it, saved and loaded in both formats, and the verification files are
+scored one at a time. Each scale runs in its own process, so the peak
+memory reported is that scale's. Results are written as JSON, and
+--compare reports the change of every metric against an earlier run."""
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import platform
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+from generate_samples import write_corpus, DISTRIBUTIONS
+
+# Corpus layout of every named scale: training files (good, bad),
+# verification files of each kind and the write_doc layout
+SCALES = OrderedDict([
+    ('small', dict(good=100, bad=25, verify=20, rows=10, cols=5)),
+    ('medium', dict(good=400, bad=100, verify=40, rows=50, cols=10)),
+    ('wide', dict(good=200, bad=50, verify=40, rows=20, cols=60)),
+    ('large', dict(good=1000, bad=250, verify=50, rows=200, cols=20)),
+    ('sheets', dict(good=200, bad=50, verify=40, rows=50, cols=10, sheets=5)),
+    ('sparse', dict(good=400, bad=100, verify=40, rows=50, cols=10, blank_ratio=0.6)),
+    ('skewed', dict(good=400, bad=100, verify=40, rows=50, cols=10, distribution='skewed')),
+])
+
+DEFAULT_SCALES = ('small', 'medium', 'wide')
+
+_layout_defaults = OrderedDict([('good', 100), ('bad', 25), ('verify', 20), ('rows', 10), ('cols', 5),
+                                ('sheets', 1), ('blank_ratio', 0.1), ('distribution', 'uniform')])
+
+# Metrics where higher is better, every other one is a time or a size
+_higher_is_better = ('train_files_per_sec', 'train_cells_per_sec')
+
+def parse_scale(spec):
+    """Layout of a named scale, or of name=value,... overriding the
+    defaults
+
+    >>> parse_scale('small')['good']
+    100
+    >>> layout = parse_scale('good=10,rows=20,distribution=normal')
+    >>> layout['good'], layout['rows'], layout['distribution'], layout['sheets']
+    (10, 20, 'normal', 1)
+    """
+    layout = OrderedDict(_layout_defaults)
+    if spec in SCALES:
+        layout.update(SCALES[spec])
+        return layout
+    for item in spec.split(','):
+        name, sep, value = item.partition('=')
+        if not sep or name not in layout:
+            raise ValueError('Unknown scale %s, expected one of %s or name=value,... with names from %s' %
+                             (spec, ', '.join(SCALES), ', '.join(layout)))
+        layout[name] = type(layout[name])(value)
+    if layout['distribution'] not in DISTRIBUTIONS:
+        raise ValueError('Unknown distribution %s, expected one of %s' % (layout['distribution'], ', '.join(DISTRIBUTIONS)))
+    return layout
+
+def _scale_name(spec, layout):
+    if spec in SCALES:
+        return spec
+    return '%dx%d-%df' % (layout['rows'], layout['cols'], layout['good'] + layout['bad'])
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+def _timed(fun, *args):
+    start = time.time()
+    result = fun(*args)
+    return (time.time() - start, result)
+
+def run_scale(layout, seed):
+    """Generates the corpus of layout, trains, saves, loads and verifies
+    with it, returns the metrics"""
+    from classifier import TrainingSet, _train_file, _score_file
+    from set_io import save_training_set, open_training_set
+    random.seed(seed)
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        corpus = write_corpus(directory, layout['good'], layout['bad'], layout['verify'],
+                              rows=layout['rows'], cols=layout['cols'], sheets=layout['sheets'],
+                              blank_ratio=layout['blank_ratio'], distribution=layout['distribution'])
+        metrics = OrderedDict([('generate_s', time.time() - start)])
+
+        tset = TrainingSet(0, layout['rows'] - 1, 0, layout['cols'] - 1, 0)
+        labelled = [(f, False) for f in corpus['good']] + [(f, True) for f in corpus['bad']]
+        start = time.time()
+        for f, bad_set in labelled:
+            _train_file(tset, f, bad_set)
+        train = time.time() - start
+        metrics['train_s'] = train
+        metrics['train_files_per_sec'] = len(labelled) / train
+        metrics['train_cells_per_sec'] = len(labelled) * len(tset.training_cells) / train
+
+        for name in ('set.pickle', 'set.bset'):
+            path = os.path.join(directory, name)
+            kind = name.split('.')[1]
+            metrics['save_%s_s' % (kind)] = _timed(save_training_set, tset, path)[0]
+            metrics['load_%s_s' % (kind)], loaded = _timed(open_training_set, path)
+            metrics['size_%s_kb' % (kind)] = os.path.getsize(path) / 1024.0
+
+        compiled = loaded.compile()
+        verify = corpus['verify_good'] + corpus['verify_bad']
+        for kind, model, thresholds in (('verify', loaded, None), ('verify_compiled', compiled, None),
+                                        ('verify_threshold', compiled, (0.5, 0.5))):
+            # The first file pays for warming up
+            _score_file(model, verify[0], thresholds=thresholds)
+            latencies = [_score_file(model, f, thresholds=thresholds)[-4] for f in verify]
+            metrics['%s_mean_ms' % (kind)] = 1000 * sum(latencies) / len(latencies)
+            metrics['%s_p50_ms' % (kind)] = 1000 * _percentile(latencies, 0.5)
+            metrics['%s_p95_ms' % (kind)] = 1000 * _percentile(latencies, 0.95)
+
+        metrics['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return metrics
+    finally:
+        shutil.rmtree(directory)
+
+def _run_scale_in_process(layout, seed):
+    # A fresh process per scale, so peak memory is the scale's own
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run_scale, (layout, seed))
+    finally:
+        pool.close()
+        pool.join()
+
+def _version():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=directory,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous, tolerance):
+    """Prints the change of every metric of the scales in both results,
+    returns the number of regressions beyond tolerance (a fraction)"""
+    previous_scales = dict((scale['name'], scale) for scale in previous['scales'])
+    regressions = 0
+    print '\nCompared with %s (%s):' % (previous.get('version'), time.ctime(previous['time']))
+    print '%-14s %-26s %14s %14s %9s' % ('scale', 'metric', 'before', 'now', 'change')
+    for scale in results['scales']:
+        before = previous_scales.get(scale['name'])
+        if before is None or before['layout'] != scale['layout']:
+            continue
+        for metric, value in scale['metrics'].items():
+            old = before['metrics'].get(metric)
+            if not old or metric == 'generate_s':
+                continue
+            change = float(value - old) / old
+            worse = -change if metric in _higher_is_better else change
+            flag = ' REGRESSION' if worse > tolerance else ''
+            regressions += 1 if flag else 0
+            print '%-14s %-26s %14.4f %14.4f %8.1f%%%s' % (scale['name'], metric, old, value, 100 * change, flag)
+    return regressions
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--scale', action='append', dest='scales', default=None,
+                      help='A named scale (%s) or name=value,... of %s. ' % (', '.join(SCALES), ', '.join(_layout_defaults)) +
+                      'Can be repeated, %s by default' % (', '.join(DEFAULT_SCALES)))
+    parser.add_option('--seed', action='store', dest='seed', type='int', default=0,
+                      help='Seed of the generated corpora, 0 by default')
+    parser.add_option('--output', '-o', action='store', dest='output', default=None,
+                      help='File to write the results to as JSON')
+    parser.add_option('--compare', action='store', dest='compare', default=None,
+                      help='Results of an earlier run to compare with, scales with the same layout are compared')
+    parser.add_option('--tolerance', action='store', dest='tolerance', type='float', default=0.2,
+                      help='Change of a metric reported as a regression, 0.2 (20%) by default')
+
+    (options, args) = parser.parse_args()
+
+    results = OrderedDict([('version', _version()), ('time', time.time()), ('seed', options.seed),
+                           ('python', platform.python_version()), ('platform', platform.platform()),
+                           ('scales', [])])
+    for spec in options.scales or DEFAULT_SCALES:
+        layout = parse_scale(spec)
+        name = _scale_name(spec, layout)
+        print >> sys.stderr, 'Running %s: %s' % (name, ', '.join('%s=%s' % item for item in layout.items()))
+        metrics = _run_scale_in_process(layout, options.seed)
+        results['scales'].append(OrderedDict([('name', name), ('layout', layout), ('metrics', metrics)]))
+        print '\n%s' % (name)
+        for metric, value in metrics.items():
+            print '  %-26s %14.4f' % (metric, value)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+        exit(1 if compare(results, previous, options.tolerance) else 0)
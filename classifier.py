@@ -1,48 +1,402 @@
 import math
+import os
+import sys
+import time
+import multiprocessing
+import json
+import csv
 import xlrd
-from itertools import izip
-from collections import defaultdict
+from array import array
+from itertools import izip, islice, chain, cycle
+from collections import defaultdict, OrderedDict, namedtuple
 from spreadsheet import *
 from statistics import *
 from filter_criteria import *
-import cPickle
+import storage
+import training_log
+import profiling
+from set_io import (load_training_set, replay_log, set_shape, open_training_set, save_training_set,
+                    save_error, scoring_model, grid_cache, open_workbook_for, expand_inputs, parse_rows)
+from prefetch import prefetched
 
-def _open_training_set(set_name):
-    with open(set_name, 'r') as f:
-        return cPickle.load(f)
+if __name__ == '__main__':
+    # The scripts importing classifier get this module, not a second copy
+    # with classes of its own that sets loaded here wouldn't be instances of
+    sys.modules.setdefault('classifier', sys.modules[__name__])
 
-def _save_training_set(tset, set_name):
-    with open(set_name, 'w') as f:
-        cPickle.dump(tset, f, protocol=1)
+def convert_trainingset(*args, **kwargs):
+    set_name = args[0]
+    converted_name = args[1]
+    print 'Converting set %s into %s' % (set_name, converted_name)
+    tset = open_training_set(set_name)
+    if kwargs['compact_grid'] and not isinstance(tset, CompactTrainingSet):
+        if tset.column_template:
+            print >> sys.stderr, '%s is a column template, which --compact-grid is not available for' % (set_name)
+            return 2
+        if tset.sketch_size:
+            print >> sys.stderr, '%s has sketched histograms, which --compact-grid is not available for' % (set_name)
+            return 2
+        tset = CompactTrainingSet.from_set(tset)
+    error = save_error(tset, converted_name)
+    if error:
+        print >> sys.stderr, error
+        return 2
+    save_training_set(tset, converted_name)
+    return 0
 
 def show_trainingset(*args, **kwargs):
     set_name = args[0]
     print 'Training set %s' % (set_name)
-    print str(_open_training_set(set_name))
+    tset = load_training_set(set_name)
+    logged = replay_log(tset, set_name)
+    if logged:
+        print '%d workbooks in the training log' % (logged)
+    print str(tset)
+    return 0
+
+def compact_trainingset(*args, **kwargs):
+    set_name = args[0]
+    # Nothing can be logged between replaying the log and removing it
+    with training_log.lock_log(set_name) as log:
+        tset = load_training_set(set_name)
+        logged = replay_log(tset, set_name, log)
+        print 'Compacting set %s, %d workbooks in the training log' % (set_name, logged)
+        save_training_set(tset, set_name, log)
     return 0
 
 def init_trainingset(*args, **kwargs):
     set_name = args[0]
+    geometry = (options.start_row, options.end_row, options.start_col, options.end_col, options.sheet)
+    if kwargs['body_row'] is not None:
+        if kwargs['body_row'] < options.start_row:
+            print >> sys.stderr, '--body-row cannot be before --row-start'
+            return 2
+        # The rows before the body are the header
+        geometry = (options.start_row, kwargs['body_row'] - 1, options.start_col, options.end_col, options.sheet, True)
+    if kwargs['compact_grid'] and (kwargs['sketch_values'] or kwargs['body_row'] is not None):
+        print >> sys.stderr, '--sketch-values and --body-row are not available with --compact-grid'
+        return 2
+    if kwargs['compact_grid']:
+        tset = CompactTrainingSet(*geometry)
+    else:
+        tset = TrainingSet(*geometry, sketch_size=kwargs['sketch_values'])
+    error = save_error(tset, set_name)
+    if error:
+        print >> sys.stderr, error
+        return 2
     print 'Creating set %s' % (set_name)
-    tset = TrainingSet(options.start_row, options.end_row, options.start_col, 
-                       options.end_col, options.sheet)
-    _save_training_set(tset, set_name)
+    save_training_set(tset, set_name)
 
     return 0
 
 def train_trainingset(*args, **kwargs):
+    """Appends the files to the set's training log, the set itself is 
+    only rewritten by --compact (or --train-batch)"""
     set_name = args[0]
     files = args[1:]
     bad_set = kwargs['bad_set']
-    tset = _open_training_set(set_name)
-    for f in files:
-        wb = xlrd.open_workbook(f)
-        if bad_set:
-            tset.bad(wb)
-        else:
-            tset.good(wb)
+    cache = grid_cache(kwargs)
+    tset = set_shape(set_name)
+
+    records = []
+    for f, contents in prefetched(files, kwargs['prefetch'], kwargs['prefetch_queue']):
+        with open_workbook_for(f, tset, cache, contents) as wb:
+            inputs = tset.cell_inputs(wb)
+        file_hash = training_log.file_hash(f) if contents is None else training_log.contents_hash(contents)
+        records.append((file_hash, 'bad' if bad_set else 'good', inputs))
 
-    _save_training_set(tset, set_name)
+    with profiling.stage('append training log'):
+        with training_log.lock_log(set_name) as log:
+            # The set may have been saved since its shape was read, its
+            # generation then changed and the log went with the old one
+            saved = set_shape(set_name)
+            if saved.geometry != tset.geometry:
+                print >> sys.stderr, '%s was replaced by a set of another shape while training' % (set_name)
+                return 1
+            if saved.generation is None:
+                # Sets saved before training logs need a generation to log against
+                saved = load_training_set(set_name)
+                replay_log(saved, set_name, log)
+                save_training_set(saved, set_name, log)
+            training_log.append_records(set_name, saved.generation, records, log)
+    return 0
+
+def _read_manifest(manifest):
+    """Yields (entry, bad_set) for every 'good <entry>' or 'bad <entry>'
+    line of the manifest, '-' reads the manifest from stdin"""
+    f = sys.stdin if manifest == '-' else open(manifest, 'r')
+    try:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2 or parts[0] not in ('good', 'bad'):
+                raise ValueError('%s:%d: expected "good <path>" or "bad <path>"' % (manifest, line_no))
+            yield (parts[1], parts[0] == 'bad')
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def _labelled_files(entries, bad_set, manifest=None):
+    if manifest:
+        for entry, entry_bad_set in _read_manifest(manifest):
+            for path in expand_inputs([entry]):
+                yield (path, entry_bad_set)
+
+    for path in expand_inputs(entries):
+        yield (path, bad_set)
+
+def _train_file(tset, f, bad_set, cache=None, contents=None):
+    """Trains tset with f, returns (bytes, rows) parsed or None if the
+    workbook can't be read"""
+    try:
+        with open_workbook_for(f, tset, cache, contents) as wb:
+            if bad_set:
+                tset.bad(wb)
+            else:
+                tset.good(wb)
+            return (wb.bytes_parsed, wb.rows_parsed)
+    except (IOError, OSError, xlrd.XLRDError), e:
+        print >> sys.stderr, 'Skipping %s: %s' % (f, e)
+        return None
+
+def _train_shard(job):
+    """Pool worker, trains the empty set it is given"""
+    tset, labelled_files, cache = job
+    trained = 0
+    parsed = [0, 0]
+    for f, bad_set in labelled_files:
+        file_parsed = _train_file(tset, f, bad_set, cache)
+        if file_parsed:
+            trained += 1
+            parsed = [a + b for a, b in zip(parsed, file_parsed)]
+    return (tset, trained, len(labelled_files) - trained, parsed)
+
+def _chunks(items, size):
+    for ndx in range(0, len(items), size):
+        yield items[ndx:ndx + size]
+
+def _train_parallel(tset, labelled_files, jobs, batch_size, checkpoint, cache=None):
+    """Splits every batch of files into contiguous shards, one per 
+    process, and merges the shards back in file order so the result 
+    is the same as training the files one after another"""
+    trained = 0
+    failed = 0
+    parsed = [0, 0]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        batches = list(_chunks(labelled_files, batch_size))
+        for ndx, batch in enumerate(batches):
+            shard_size = (len(batch) + jobs - 1) // jobs
+            work = [(tset.empty_like(), shard, cache) for shard in _chunks(batch, shard_size)]
+            for shard_set, shard_trained, shard_failed, shard_parsed in pool.map(_train_shard, work):
+                with profiling.stage('merge shards'):
+                    tset.merge(shard_set)
+                trained += shard_trained
+                failed += shard_failed
+                parsed = [a + b for a, b in zip(parsed, shard_parsed)]
+            if ndx < len(batches) - 1:
+                checkpoint(trained)
+    finally:
+        pool.close()
+        pool.join()
+
+    return (trained, failed, parsed)
+
+def train_batch(*args, **kwargs):
+    set_name = args[0]
+    entries = args[1:]
+    bad_set = kwargs['bad_set']
+    manifest = kwargs['manifest']
+    checkpoint_every = kwargs['checkpoint_every']
+    jobs = kwargs['jobs']
+    cache = grid_cache(kwargs)
+
+    tset = open_training_set(set_name)
+    trained = 0
+    failed = 0
+    start = time.time()
+
+    def checkpoint(trained):
+        save_training_set(tset, set_name)
+        elapsed = time.time() - start
+        print 'Checkpoint after %d files (%.1f files/sec)' % (trained, trained / elapsed if elapsed else 0.0)
+
+    labelled_files = _labelled_files(entries, bad_set, manifest)
+    parsed = [0, 0]
+    if jobs > 1:
+        labelled_files = list(labelled_files)
+        trained, failed, parsed = _train_parallel(tset, labelled_files, jobs, 
+                                                  checkpoint_every or len(labelled_files) or 1, checkpoint, cache)
+    else:
+        labelled_files = prefetched(labelled_files, kwargs['prefetch'], kwargs['prefetch_queue'], 
+                                    path=lambda (f, file_bad_set): f)
+        for (f, file_bad_set), contents in labelled_files:
+            file_parsed = _train_file(tset, f, file_bad_set, cache, contents)
+            if not file_parsed:
+                failed += 1
+                continue
+            trained += 1
+            parsed = [a + b for a, b in zip(parsed, file_parsed)]
+
+            if checkpoint_every and trained % checkpoint_every == 0:
+                checkpoint(trained)
+
+    save_training_set(tset, set_name)
+    elapsed = time.time() - start
+    print 'Trained %d files in %.1fs (%.1f files/sec), %d skipped, parsed %.1f MB and %d rows' % (
+        trained, elapsed, trained / elapsed if elapsed else 0.0, failed, parsed[0] / 1048576.0, parsed[1])
+    return 0 if failed == 0 else 1
+
+_record_fields = ('path', 'probability', 'seconds', 'bytes_parsed', 'rows_parsed', 'error')
+_threshold_record_fields = ('path', 'verdict', 'low', 'high', 'cells_scored', 
+                            'seconds', 'bytes_parsed', 'rows_parsed', 'error')
+
+def _score_file(tset, f, start_row=None, end_row=None, cache=None, contents=None, thresholds=None):
+    """Returns (path, probability, seconds, bytes parsed, rows parsed, error) 
+    for f, error is None unless the workbook couldn't be read or scored, a
+    workbook without the set's sheet say. With thresholds the probability
+    is replaced by the verdict, the bounds of the probability and the number
+    of cells scored by score_threshold
+
+    >>> tset = TrainingSet(0, 0, 0, 0, 1)
+    >>> _score_file(tset, 'x.csv', contents='a\\n')[-1]
+    'IndexError: CSV files only have one sheet'
+    """
+    start = time.time()
+    failed = (None, None, None, 0) if thresholds else (None,)
+    try:
+        with open_workbook_for(f, tset, cache, contents) as wb:
+            if thresholds:
+                decided, (low, high), cells = tset.score_threshold(wb, thresholds, start_row, end_row)
+                scored = (decided, low, high, cells)
+            else:
+                scored = (tset.score(wb, start_row=start_row, end_row=end_row),)
+        return (f,) + scored + (time.time() - start, wb.bytes_parsed, wb.rows_parsed, None)
+    except (IOError, OSError, xlrd.XLRDError), e:
+        return (f,) + failed + (time.time() - start, 0, 0, str(e))
+    except Exception, e:
+        # Anything else is about this workbook too, the other files are
+        # still scored
+        return (f,) + failed + (time.time() - start, 0, 0, '%s: %s' % (type(e).__name__, e))
+
+_worker_set = None
+_worker_rows = (None, None)
+_worker_cache = None
+_worker_thresholds = None
+
+def _init_score_worker(tset, rows, cache, thresholds):
+    global _worker_set, _worker_rows, _worker_cache, _worker_thresholds
+    _worker_set = tset
+    _worker_rows = rows
+    _worker_cache = cache
+    _worker_thresholds = thresholds
+
+def _score_file_in_worker(f):
+    return _score_file(_worker_set, f, _worker_rows[0], _worker_rows[1], _worker_cache, 
+                       thresholds=_worker_thresholds)
+
+def _write_results(results, out, output_format, fields=_record_fields):
+    """Writes one jsonl or csv record per result, returns the number of
+    files that couldn't be scored"""
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(fields)
+        write = writer.writerow
+    else:
+        write = lambda row: out.write(json.dumps(OrderedDict(zip(fields, row))) + '\n')
+
+    failed = 0
+    for row in results:
+        if row[-1] is not None:
+            failed += 1
+        write(row)
+        out.flush()
+    return failed
+
+def verify_batch(*args, **kwargs):
+    set_name = args[0]
+    entries = args[1:] or ['-']
+    output_format = kwargs['output_format']
+    if output_format not in ('jsonl', 'csv'):
+        print >> sys.stderr, 'Unknown output format %s' % (output_format)
+        return 2
+
+    error = _scoring_options_error(set_name, kwargs)
+    if error:
+        print >> sys.stderr, error
+        return 2
+    tset = _open_for_scoring(set_name, kwargs)
+    thresholds = _parse_thresholds(kwargs['threshold'])
+    start_row, end_row = parse_rows(kwargs['rows'])
+    results = tset.score_many(expand_inputs(entries), processes=kwargs['jobs'], 
+                              start_row=start_row, end_row=end_row, cache=grid_cache(kwargs),
+                              prefetch=kwargs['prefetch'], prefetch_queue=kwargs['prefetch_queue'],
+                              thresholds=thresholds)
+
+    out = open(kwargs['output'], 'w') if kwargs['output'] else sys.stdout
+    try:
+        failed = _write_results(results, out, output_format, 
+                                _threshold_record_fields if thresholds else _record_fields)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    return 0 if failed == 0 else 1
+
+def _parse_grid(specs):
+    """{'name': [values]} from 'name=value,value,...' strings"""
+    grid = OrderedDict()
+    for spec in specs or []:
+        name, sep, values = spec.partition('=')
+        if not sep or not values:
+            raise ValueError('Expected name=value,value,... for --grid, not %s' % (spec))
+        grid[name.strip()] = [float(value) for value in values.split(',')]
+    return grid
+
+def sweep_parameters(*args, **kwargs):
+    """Cross-validates every combination of the --grid cell parameters
+    over the labelled files, with the geometry of the set"""
+    import sweep
+    set_name = args[0]
+    entries = args[1:]
+    folds = kwargs['folds']
+    output_format = kwargs['output_format']
+    if folds < 2:
+        print >> sys.stderr, '--folds must be at least 2'
+        return 2
+
+    geometry = set_shape(set_name).geometry
+    start = time.time()
+    corpus = sweep.extract_corpus(_labelled_files(entries, kwargs['bad_set'], kwargs['manifest']), 
+                                  geometry, grid_cache(kwargs))
+    scores = sweep.RawScores(sweep.raw_scores(corpus, geometry, folds), 
+                             [bad_set for path, bad_set, inputs in corpus])
+    configurations = sweep.parameter_grid(_parse_grid(kwargs['grid']))
+    print 'Read %d files and trained %d folds in %.1fs, evaluating %d configurations' % (
+        len(corpus), folds, time.time() - start, len(configurations))
+
+    start = time.time()
+    results = list(sweep.sweep(scores, configurations, processes=kwargs['jobs']))
+    print 'Evaluated in %.1fs, best first:' % (time.time() - start)
+    results.sort(key=lambda (parameters, accuracy, auc): (-auc, -accuracy))
+    print '%10s %10s  %s' % ('AUC', 'accuracy', ' '.join(CellParameters._fields))
+    for parameters, accuracy, auc in results:
+        print '%10.4f %10.4f  %s%s' % (auc, accuracy, ' '.join(str(p) for p in parameters),
+                                       ' (default)' if parameters == DEFAULT_CELL_PARAMETERS else '')
+
+    if kwargs['output']:
+        fields = CellParameters._fields + ('accuracy', 'auc')
+        with open(kwargs['output'], 'w') as out:
+            rows = [tuple(parameters) + (accuracy, auc) for parameters, accuracy, auc in results]
+            if output_format == 'csv':
+                writer = csv.writer(out)
+                writer.writerow(fields)
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    out.write(json.dumps(OrderedDict(zip(fields, row))) + '\n')
     return 0
 
 def _format_cell(probs):
@@ -85,10 +439,23 @@ def verify_file(*args, **kwargs):
     show_grid = kwargs['show_grid']
     print '\nVerifying file %s against set %s' % (f, set_name)
     
-    tset = _open_training_set(set_name)
-    wb = xlrd.open_workbook(f)
+    error = _scoring_options_error(set_name, kwargs)
+    if error:
+        print >> sys.stderr, error
+        return 2
+    tset = _open_for_scoring(set_name, kwargs)
+    start_row, end_row = parse_rows(kwargs['rows'])
+    thresholds = _parse_thresholds(kwargs['threshold'])
+    if thresholds:
+        with open_workbook_for(f, tset, grid_cache(kwargs)) as wb:
+            model = tset._threshold_scorer()
+            decided, (low, high), scored = model.score_threshold(wb, thresholds, start_row, end_row)
+        print '   %s is %s, its probability of being good is between %f and %f (%d cells scored)\n' % (
+            f, decided, low, high, scored)
+        return 0
 
-    prob, cells = tset.score(wb, include_cells=True)
+    with open_workbook_for(f, tset, grid_cache(kwargs)) as wb:
+        prob, cells = tset.score(wb, include_cells=True, start_row=start_row, end_row=end_row)
 
     print '   There is a %f probability that %s is a good file\n' % (prob, f)
 
@@ -99,27 +466,121 @@ def verify_file(*args, **kwargs):
 
     return 0
 
-class TrainingCell(object):
-    """Groups series for multiple criteria for a single cell"""
+# Probability bands of score_threshold, the same as --show-grid colours
+THRESHOLD_BANDS = (0.3, 0.7)
+
+def verdict(prob, thresholds):
+    """'bad' below the first threshold, 'good' from the second on and
+    'uncertain' in between
+
+    >>> [verdict(p, (0.3, 0.7)) for p in (0.1, 0.5, 0.7)], verdict(0.5, (0.5, 0.5))
+    (['bad', 'uncertain', 'good'], 'good')
+    """
+    bad_below, good_from = thresholds
+    if prob < bad_below:
+        return 'bad'
+    return 'good' if prob >= good_from else 'uncertain'
+
+def _parse_thresholds(thresholds):
+    """'t' or 'bad_below:good_from' to a (bad_below, good_from) pair
+
+    >>> _parse_thresholds('0.3:0.7'), _parse_thresholds('0.5')
+    ((0.3, 0.7), (0.5, 0.5))
+    >>> _parse_thresholds('0.2,0.8')
+    Traceback (most recent call last):
+    ValueError: Expected t or bad_below:good_from for --threshold, not 0.2,0.8
+    """
+    if not thresholds:
+        return None
+    bad_below, sep, good_from = thresholds.partition(':')
+    try:
+        bad_below = float(bad_below)
+        good_from = float(good_from) if sep else bad_below
+    except ValueError:
+        raise ValueError('Expected t or bad_below:good_from for --threshold, not %s' % (thresholds))
+    if not 0 <= bad_below <= good_from <= 1:
+        raise ValueError('Thresholds must be probabilities, the first not above the second')
+    return (bad_below, good_from)
+
+def _bounded_verdict(combined, remaining, thresholds):
+    """(verdict, (lowest, highest) probability) once the cells left, 
+    whose log odds are within remaining, can't change the verdict of the
+    BayesAccumulator combined, None until then"""
+    remaining_low, remaining_high = remaining
+    low, high = combined.probability_bounds(remaining_low, remaining_high)
+    # A cell left that can be certain cancels any certainty so far
+    if remaining_low == float('-inf'):
+        low = 0.0
+    if remaining_high == float('inf'):
+        high = 1.0
+    if verdict(low, thresholds) == verdict(high, thresholds):
+        return (verdict(low, thresholds), (low, high))
+    return None
+
+class _LogOddsBounds(object):
+    """Sums of the CompiledCell.log_odds_bounds of any run of cells, from
+    prefix sums of the (lowest, highest) log odds of every cell. Cells that
+    can be certain are counted apart, so the sums stay finite"""
+    def __init__(self, cell_bounds):
+        self.low = [0.0]
+        self.high = [0.0]
+        self.certain_low = [0]
+        self.certain_high = [0]
+        for low, high in cell_bounds:
+            self.low.append(self.low[-1] + (low if low != float('-inf') else 0.0))
+            self.high.append(self.high[-1] + (high if high != float('inf') else 0.0))
+            self.certain_low.append(self.certain_low[-1] + (low == float('-inf')))
+            self.certain_high.append(self.certain_high[-1] + (high == float('inf')))
+
+    def between(self, first, end):
+        """(lowest, highest) log odds of cells first to end - 1"""
+        low = self.low[end] - self.low[first]
+        high = self.high[end] - self.high[first]
+        if self.certain_low[end] > self.certain_low[first]:
+            low = float('-inf')
+        if self.certain_high[end] > self.certain_high[first]:
+            high = float('inf')
+        return (low, high)
 
-    def __init__(self):
-        values_positive_bias = 0.835 #Good one
-        #values_positive_bias = 0.35
+# Tuning constants of the series of a TrainingCell, they only change how
+# trained counts turn into probabilities (see sweep.py)
+CellParameters = namedtuple('CellParameters', ['values_bias', 'numeric_moderation', 'has_value_bias',
+                                               'has_value_confidence', 'type_bias', 'type_moderation'])
 
+DEFAULT_CELL_PARAMETERS = CellParameters(
+    values_bias=0.835, #Good one, 0.35 was tried too
+    numeric_moderation=2.8,
+    has_value_bias=1.08,
+    has_value_confidence=0.88,
+    type_bias=1.9,
+    type_moderation=2)
+
+class TrainingCell(object):
+    """Groups series for multiple criteria for a single cell. values is
+    the ValueTable of its nominal series, usually the set's, and 
+    sketch_size caps the values the values series keeps, see 
+    SketchHistogram"""
+
+    def __init__(self, parameters=DEFAULT_CELL_PARAMETERS, values=None, sketch_size=None):
+        values = ValueTable() if values is None else values
         values_class = BiasedSeries(
-            NominalSeries(ignore_blanks=True, correct_for_confidence=True, estimate_missing_probabilities=False), 
-            values_positive_bias)
+            NominalSeries(ignore_blanks=True, correct_for_confidence=True, estimate_missing_probabilities=False,
+                          values=values, sketch_size=sketch_size), 
+            parameters.values_bias)
 
         #Make scores more radical
         #values_class = ModerationSeries(values_class, 0.3)
 
-        number_range_class = ModerationSeries(NumericSeries(), 2.8)
-        has_value_class = LowConfidenceSeries(BiasedSeries(HasValueSeries(correct_for_confidence=True), 1.08), 0.88)
+        number_range_class = ModerationSeries(NumericSeries(), parameters.numeric_moderation)
+        has_value_class = LowConfidenceSeries(BiasedSeries(HasValueSeries(correct_for_confidence=True, values=values), 
+                                                           parameters.has_value_bias), 
+                                              parameters.has_value_confidence)
 
         self.value_classes = [values_class, number_range_class, has_value_class]
 
-        type_class = NominalSeries(ignored_values=[XlsType.xls_empty], correct_for_confidence=True, estimate_missing_probabilities=False)
-        type_class = ModerationSeries(BiasedSeries(type_class, 1.9), 2)
+        type_class = NominalSeries(ignored_values=[XlsType.xls_empty], correct_for_confidence=True, 
+                                   estimate_missing_probabilities=False, values=values)
+        type_class = ModerationSeries(BiasedSeries(type_class, parameters.type_bias), parameters.type_moderation)
 
         self.type_classes = [type_class]
 
@@ -135,6 +596,11 @@ class TrainingCell(object):
         for type_class in self.type_classes:
             type_class.bad(cell_type)
 
+    def merge(self, other):
+        for mine, theirs in izip(self.value_classes + self.type_classes, 
+                                 other.value_classes + other.type_classes):
+            mine.merge(theirs)
+
     def score(self, cell_type, cell_value):
         probs = []
         for value_class in self.value_classes:
@@ -144,22 +610,124 @@ class TrainingCell(object):
 
         return probs
 
+    def compile(self):
+        return CompiledCell([c.compile() for c in self.value_classes], 
+                            [c.compile() for c in self.type_classes])
+
     def __repr__(self):
         return 'TCell'
 
+class CompiledCell(object):
+    """Read-only TrainingCell, see TrainingSet.compile
+
+    >>> tcell = TrainingCell()
+    >>> for value in [10.0, 12.5, 11.0, 'ID1', 'ID2', '']: 
+    ...     tcell.good(XlsType.xls_float if type(value) == float else XlsType.xls_string, value)
+    >>> for value in ['x', 'ID1', 400.0]: 
+    ...     tcell.bad(XlsType.xls_float if type(value) == float else XlsType.xls_string, value)
+    >>> compiled = tcell.compile()
+    >>> samples = [(XlsType.xls_float, 11.5), (XlsType.xls_string, 'ID1'), (XlsType.xls_empty, '')]
+    >>> max(abs(a - b) for t, v in samples for a, b in zip(tcell.score(t, v), compiled.score(t, v)))
+    0.0
+    """
+    def __init__(self, value_scorers, type_scorers):
+        self.value_scorers = value_scorers
+        self.type_scorers = type_scorers
+
+    def score(self, cell_type, cell_value):
+        probs = [scorer.score(cell_value) for scorer in self.value_scorers]
+        probs.extend([scorer.score(cell_type) for scorer in self.type_scorers])
+        return probs
+
+    def log_odds_bounds(self):
+        """(lowest, highest) sum of the log odds of the probabilities score
+        can return, -inf or inf when one of them can be certain"""
+        low = high = 0.0
+        for scorer in self.value_scorers + self.type_scorers:
+            prob_low, prob_high = scorer.bounds()
+            low += log_odds(prob_low) if prob_low > 0 else float('-inf')
+            high += log_odds(prob_high) if prob_high < 1 else float('inf')
+        return (low, high)
+
+    def compile(self):
+        return self
+
+    def __repr__(self):
+        return 'CCell'
+
+# Last row read from the sheet by column templates, whatever its length
+_LAST_ROW = sys.maxint
+
 class TrainingSet(object):
-    def __init__(self, start_row, end_row, start_col, end_col, sheet):
+    """A TrainingCell for every cell of rows start_row to end_row. A 
+    column template also has one for every column, trained and scored
+    with each row after end_row down to the last row of the sheet, so
+    end_row is the last header row and the body can have any length:
+
+    >>> wb = CsvWorkbook(file_contents='Date,Price\\n2020,10\\n2021,12\\n2022,11\\n')
+    >>> tset = TrainingSet(0, 0, 0, 1, 0, column_template=True)
+    >>> len(tset.training_cells), len(tset.cell_inputs(wb))
+    (4, 8)
+    >>> tset.good(wb)
+    >>> tset.bad(CsvWorkbook(file_contents='Name,Total\\nx,abc\\ny,def\\n'))
+    >>> longer = CsvWorkbook(file_contents='Date,Price\\n' + '2023,11\\n' * 50)
+    >>> tset.score(longer) > 0.99, tset.score_threshold(longer)[0]
+    (True, 'good')
+    """
+
+    # Set by save_training_set, None for sets never saved
+    generation = None
+    sketch_size = None
+    column_template = False
+
+    def __init__(self, start_row, end_row, start_col, end_col, sheet, column_template=False, sketch_size=None):
         self.start_row = start_row
         self.end_row = end_row
         self.start_col = start_col
         self.end_col = end_col
         self.sheet = sheet
-        size = (1 + self.end_row - self.start_row) * (1 + self.end_col - self.start_col)
-        self.training_cells = [TrainingCell() for i in range(0, size)]
+        self.column_template = column_template
+        self.sketch_size = sketch_size
+        size = self.header_size + ((1 + self.end_col - self.start_col) if column_template else 0)
+        # Every distinct value is kept once for the whole set
+        self.values = ValueTable()
+        self.training_cells = [TrainingCell(values=self.values, sketch_size=sketch_size) for i in range(0, size)]
         
     def __repr__(self):
         return repr(self.__dict__)
 
+    @property
+    def geometry(self):
+        """Constructor arguments for an empty set with the same shape"""
+        geometry = (self.start_row, self.end_row, self.start_col, self.end_col, self.sheet)
+        return geometry + (True,) if self.column_template else geometry
+
+    def empty_like(self):
+        """Untrained set of the same kind, shape and options, which can be
+        merged into this one"""
+        return TrainingSet(*self.geometry, sketch_size=self.sketch_size)
+
+    @property
+    def region(self):
+        """(start_row, end_row, start_col, end_col, sheet) read from every
+        workbook, down to the last row of the sheet for column templates"""
+        return (self.start_row, _LAST_ROW if self.column_template else self.end_row, 
+                self.start_col, self.end_col, self.sheet)
+
+    @property
+    def header_size(self):
+        """Number of training cells of rows start_row to end_row, the
+        column cells of a column template follow them"""
+        return (1 + self.end_row - self.start_row) * (1 + self.end_col - self.start_col)
+
+    def merge(self, other):
+        """Adds everything other was trained with to this set"""
+        if other.geometry != self.geometry:
+            raise ValueError('Cannot merge training sets with different geometry: %s, %s' % 
+                             (self.geometry, other.geometry))
+        for mine, theirs in izip(self.training_cells, other.training_cells):
+            mine.merge(theirs)
+
     def good(self, xls_doc):
         action = lambda tcell, cell_type, cell_value: tcell.good(cell_type, cell_value)
         self._enumerate_against_training_cells(action, xls_doc)
@@ -168,38 +736,727 @@ class TrainingSet(object):
         action = lambda tcell, cell_type, cell_value: tcell.bad(cell_type, cell_value)
         self._enumerate_against_training_cells(action, xls_doc)
 
-    def score(self, xls_doc, include_cells=False):
+    def cell_inputs(self, xls_doc):
+        """(type, value) of xls_doc for every training cell, what good and
+        bad train the cells with"""
+        inputs = []
+        for row, tcells, first in self._row_cells(self._sheet(xls_doc)):
+            inputs.extend(row)
+        return inputs
+
+    def input_cells(self, cells=None):
+        """Items of cells, one per training cell and the training cells
+        by default, in the order of the cell_inputs they go with: the 
+        column cells of a column template repeat for every body row"""
+        cells = self.training_cells if cells is None else cells
+        if not self.column_template:
+            return iter(cells)
+        columns = [cells[ndx] for ndx in xrange(self.header_size, len(cells))]
+        return chain(islice(cells, 0, self.header_size), cycle(columns))
+
+    def train_inputs(self, inputs, bad_set=False):
+        """Trains with the cell_inputs of a workbook"""
+        for tcell, (cell_type, cell_value) in izip(self.input_cells(), inputs):
+            if bad_set:
+                tcell.bad(cell_type, cell_value)
+            else:
+                tcell.good(cell_type, cell_value)
+
+    def score(self, xls_doc, include_cells=False, start_row=None, end_row=None):
+        """Probability that xls_doc is good. start_row and end_row 
+        restrict scoring to those rows of the set's region"""
         action = lambda tcell, cell_type, cell_value: tcell.score(cell_type, cell_value)
-        probs = self._enumerate_against_training_cells(action, xls_doc, keep_result=True)
+        probs = self._enumerate_against_training_cells(action, xls_doc, keep_result=True,
+                                                       start_row=start_row, end_row=end_row)
 
-        flattened = reduce(lambda x, y: x + y, probs)
+        combined = BayesAccumulator()
+        for cell_probs in probs:
+            combined.extend(cell_probs)
         if include_cells:
-            return (bayes_combine(flattened), probs)
+            return (combined.probability, probs)
         else:
-            return bayes_combine(flattened)
+            return combined.probability
+
+    def score_threshold(self, xls_doc, thresholds=(0.5, 0.5), start_row=None, end_row=None):
+        """Decides the verdict of xls_doc for thresholds (see verdict) 
+        without scoring more cells than needed. Cells are scored in row 
+        order and reading stops once the lowest and highest score the cells 
+        left can give lead to the same verdict. Returns (verdict, (lowest, 
+        highest) probability, cells scored), the bounds being the score 
+        itself when every cell was scored"""
+        if self.column_template:
+            return self._template_score_threshold(xls_doc, thresholds, start_row, end_row)
+        start_row = self.start_row if start_row is None else max(start_row, self.start_row)
+        end_row = self.end_row if end_row is None else min(end_row, self.end_row)
+        cols_per_row = 1 + self.end_col - self.start_col
+        first = (start_row - self.start_row) * cols_per_row
+        end = (end_row - self.start_row + 1) * cols_per_row
+        bounds = self._log_odds_bounds()
+
+        combined = BayesAccumulator()
+        ndx = first
+        tcells = self._cells(first, end)
+        for row in self._rows_from_sheet(self._sheet(xls_doc), start_row, end_row):
+            for (cell_type, cell_value), tcell in izip(row, tcells):
+                combined.extend(tcell.score(cell_type, cell_value))
+                ndx += 1
+                decided = _bounded_verdict(combined, bounds.between(ndx, end), thresholds)
+                if decided:
+                    return decided + (ndx - first,)
 
-    def _enumerate_against_training_cells(self, action, xls_doc, keep_result=False):
+        prob = combined.probability
+        return (verdict(prob, thresholds), (prob, prob), ndx - first)
+
+    def _template_score_threshold(self, xls_doc, thresholds, start_row, end_row):
+        """score_threshold of a column template, the cells left depend on
+        the length of the body so every row is read first"""
+        cols_per_row = 1 + self.end_col - self.start_col
+        bounds = self._log_odds_bounds()
+        rows = list(self._row_cells(self._sheet(xls_doc), start_row, end_row))
+        # Bounds of the rows after each row
+        later = [(0.0, 0.0)]
+        for row, tcells, first in reversed(rows[1:]):
+            low, high = bounds.between(first, first + cols_per_row)
+            later.append((later[-1][0] + low, later[-1][1] + high))
+        later.reverse()
+
+        combined = BayesAccumulator()
+        scored = 0
+        for (row, tcells, first), (later_low, later_high) in izip(rows, later):
+            ndx = first
+            for (cell_type, cell_value), tcell in izip(row, tcells):
+                combined.extend(tcell.score(cell_type, cell_value))
+                ndx += 1
+                scored += 1
+                low, high = bounds.between(ndx, first + cols_per_row)
+                decided = _bounded_verdict(combined, (low + later_low, high + later_high), thresholds)
+                if decided:
+                    return decided + (scored,)
+
+        prob = combined.probability
+        return (verdict(prob, thresholds), (prob, prob), scored)
+
+    def _log_odds_bounds(self):
+        return _LogOddsBounds(tcell.compile().log_odds_bounds() for tcell in self.training_cells)
+
+    def _threshold_scorer(self):
+        """The set to run score_threshold with on many workbooks, compiled
+        so the bounds of the cells are only worked out once"""
+        return self.compile()
+
+    def compile(self):
+        """Returns a read-only CompiledTrainingSet with the same scores"""
+        with profiling.stage('compile set'):
+            return CompiledTrainingSet(self)
+
+    def score_many(self, files, processes=1, start_row=None, end_row=None, cache=None,
+                   prefetch=0, prefetch_queue=16, thresholds=None):
+        """Scores every path in files, yielding (path, probability, seconds, 
+        bytes parsed, rows parsed, error) in the same order, or the records of
+        score_threshold with thresholds. With processes > 1 the files are scored 
+        by a pool of processes that each get a copy of this set once, otherwise prefetch threads
+        read up to prefetch_queue files ahead. Workbooks are read through the GridCache cache if 
+        there is one"""
+        tset = self._threshold_scorer() if thresholds else self
+        if processes <= 1:
+            for f, contents in prefetched(files, prefetch, prefetch_queue):
+                yield _score_file(tset, f, start_row, end_row, cache, contents, thresholds)
+            return
+
+        pool = multiprocessing.Pool(processes, _init_score_worker, 
+                                    (tset, (start_row, end_row), cache, thresholds))
+        try:
+            for result in pool.imap(_score_file_in_worker, files, chunksize=4):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def _enumerate_against_training_cells(self, action, xls_doc, keep_result=False, 
+                                          start_row=None, end_row=None):
         #TODO: by name or sheet
         all_results = None
         if keep_result:  
             all_results = []
+        for row, tcells, first in self._row_cells(self._sheet(xls_doc), start_row, end_row):
+            # The row goes first, izip stops without taking a cell of the next row
+            for (cell_type, cell_value), tcell in izip(row, tcells):
+                res = action(tcell, cell_type, cell_value)
+                if keep_result:
+                    all_results.append(res)
+
+        return all_results
+
+    def _row_cells(self, sheet, start_row=None, end_row=None):
+        """(row, training cells, index of the first of them) of every row
+        of sheet scored from start_row to end_row. Header rows share one
+        iterator over their cells, body rows the list of column cells"""
+        cols_per_row = 1 + self.end_col - self.start_col
+        start_row = self.start_row if start_row is None else max(start_row, self.start_row)
+        end_row = self.region[1] if end_row is None else min(end_row, self.region[1])
+        first = (start_row - self.start_row) * cols_per_row
+        tcells = self._cells(first, (min(end_row, self.end_row) - self.start_row + 1) * cols_per_row)
+        columns = list(self._cells(self.header_size, len(self.training_cells))) if self.column_template else None
+        for ndx, row in enumerate(self._rows_from_sheet(sheet, start_row, end_row), start_row):
+            if ndx <= self.end_row:
+                yield (row, tcells, first + (ndx - start_row) * cols_per_row)
+            else:
+                yield (row, columns, self.header_size)
+
+    def _cells(self, first, end):
+        """Training cells first to end - 1, in row order"""
+        return islice(self.training_cells, first, end)
+
+    def _sheet(self, xls_doc):
         if type(self.sheet) == int:
-            sheet = xls_doc.sheet_by_index(self.sheet)
+            return xls_doc.sheet_by_index(self.sheet)
         else:
-            sheet = xls_doc.sheet_by_name(self.sheet)
-        stream = self._stream_from_sheet(sheet)
-        for tcell, (cell_type, cell_value) in zip(self.training_cells, stream):
-            res = action(tcell, cell_type, cell_value)
-            if keep_result:
-                all_results.append(res)
+            return xls_doc.sheet_by_name(self.sheet)
 
-        return all_results
-            
-    def _stream_from_sheet(self, sheet):
-        return cell_stream_from_sheet(sheet, self.end_row, self.end_col, 
-                                      start_col=self.start_col, start_row=self.start_row,
-                                      row_values=lambda sheet, ndx: zip(sheet.row_types(ndx), sheet.row_values(ndx)),
-                                      empty_value=(XlsType.xls_empty, None))
+    def _rows_from_sheet(self, sheet, start_row=None, end_row=None):
+        """Lists of (type, value) of the columns of the set, one per row.
+        Only header rows past the end of the sheet are padded"""
+        start_row = self.start_row if start_row is None else start_row
+        end_row = self.region[1] if end_row is None else end_row
+        return profiling.timed_iter('read cells', row_slices_from_sheet(
+            sheet, end_row, self.end_col, start_col=self.start_col, start_row=start_row,
+            row_values=lambda types, values: zip(types, values), empty_value=(XlsType.xls_empty, None),
+            padded_end_row=min(end_row, self.end_row)))
+
+class CompiledTrainingSet(TrainingSet):
+    """Frozen scoring model precomputed from a trained set. Nominal 
+    series become a dict lookup per value and numeric series keep only 
+    their means, deviations and confidences, with every bias, moderation
+    and confidence curve already applied. Scores are the same as the 
+    live set's, the operations are identical so any difference stays 
+    within floating point rounding (< 1e-12 per cell)."""
+
+    # See score_threshold
+    _bounds = None
+
+    def __init__(self, tset):
+        self.start_row, self.end_row, self.start_col, self.end_col, self.sheet = tset.geometry[:5]
+        self.column_template = tset.column_template
+        self.training_cells = [tcell.compile() for tcell in tset.training_cells]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_bounds', None)
+        return state
+
+    def _log_odds_bounds(self):
+        # Read-only, so they are only worked out once
+        if self._bounds is None:
+            self._bounds = _LogOddsBounds(tcell.log_odds_bounds() for tcell in self.training_cells)
+        return self._bounds
+
+    def good(self, xls_doc):
+        raise TypeError('Compiled training sets are read-only')
+
+    def bad(self, xls_doc):
+        raise TypeError('Compiled training sets are read-only')
+
+    def train_inputs(self, inputs, bad_set=False):
+        raise TypeError('Compiled training sets are read-only')
+
+    def merge(self, other):
+        raise TypeError('Compiled training sets are read-only')
+
+    def compile(self):
+        return self
+
+class VectorisedTrainingSet(CompiledTrainingSet):
+    """Compiled set scored with NumPy, reading the sheet region into
+    type/value arrays and scoring every cell of a series at once. Scores
+    match CompiledTrainingSet within floating point rounding."""
+
+    def __init__(self, tset):
+        from vector_scoring import GridScorer
+        super(VectorisedTrainingSet, self).__init__(tset.compile())
+        self.grid_scorer = GridScorer(self.training_cells)
+
+    def score(self, xls_doc, include_cells=False, start_row=None, end_row=None):
+        # The grid scorer has a cell per position, not column templates
+        if start_row is not None or end_row is not None or self.column_template:
+            return super(VectorisedTrainingSet, self).score(xls_doc, include_cells, start_row, end_row)
+
+        from vector_scoring import combine_array
+        types = []
+        values = []
+        for row in self._rows_from_sheet(self._sheet(xls_doc)):
+            types.extend(cell_type for cell_type, cell_value in row)
+            values.extend(cell_value for cell_type, cell_value in row)
+        with profiling.stage('score grid with numpy'):
+            probs = self.grid_scorer.score_grid(types, values)
+            prob = combine_array(probs)
+
+        if include_cells:
+            return (prob, probs.tolist())
+        else:
+            return prob
+
+# Cells a MappedTrainingSet keeps deserialised, the least recently used
+# ones are dropped past that
+MAPPED_CELL_CACHE = 4096
+
+class _MappedCells(object):
+    """Sequence of the cells of a MappedTrainingSet, each one is read 
+    from the file when it is used. Only the cache_size most recently used
+    are kept, so a set mapped for long doesn't end up loaded whole
+
+    >>> import tempfile
+    >>> from set_io import save_training_set
+    >>> path = os.path.join(tempfile.mkdtemp(), 'set.bset')
+    >>> save_training_set(TrainingSet(0, 9, 0, 9, 0), path)
+    >>> cells = MappedTrainingSet(path).training_cells
+    >>> cells.cache_size = 10
+    >>> len([tcell for tcell in cells]), cells.loaded.keys() == range(90, 100), cells[95] is cells[95]
+    (100, True, True)
+    """
+    def __init__(self, mapped, count, cache_size=MAPPED_CELL_CACHE):
+        self.mapped = mapped
+        self.count = count
+        self.cache_size = cache_size
+        self.loaded = OrderedDict()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, ndx):
+        if ndx < 0:
+            ndx += self.count
+        if not 0 <= ndx < self.count:
+            raise IndexError(ndx)
+        tcell = self.loaded.pop(ndx, None)
+        if tcell is None:
+            # With a value table of its own, which goes when it does
+            tcell = TrainingCell()
+            self.mapped.fill_cell(tcell, ndx)
+            if len(self.loaded) >= self.cache_size:
+                self.loaded.popitem(last=False)
+        self.loaded[ndx] = tcell
+        return tcell
+
+    def __iter__(self):
+        for ndx in xrange(self.count):
+            yield self[ndx]
+
+class MappedTrainingSet(TrainingSet):
+    """Read-only view of a binary (.bset) set. The file is memory-mapped
+    and each TrainingCell is only deserialised when scoring reaches it, 
+    so scoring a few rows of a large set touches just their pages"""
+
+    def __init__(self, set_name):
+        self.set_name = set_name
+        mapped = storage.MappedSet(set_name)
+        geometry = mapped.header['geometry']
+        self.start_row, self.end_row, self.start_col, self.end_col, self.sheet = geometry[:5]
+        self.column_template = len(geometry) > 5 and geometry[5]
+        self.generation = mapped.header.get('generation')
+        self.training_cells = _MappedCells(mapped, mapped.header['cells'])
+        if len(self.training_cells):
+            storage.check_parameters(mapped.header, TrainingSet(0, 0, 0, 0, 0))
+
+    _bounds = None
+
+    def __getstate__(self):
+        # Worker processes map the file again instead of copying the cells
+        return {'set_name': self.set_name}
+
+    def __setstate__(self, state):
+        self.__init__(state['set_name'])
+
+    def _cells(self, first, end):
+        return (self.training_cells[ndx] for ndx in xrange(first, min(end, len(self.training_cells))))
+
+    def _log_odds_bounds(self):
+        # Saved with the set, only sets saved without them have every
+        # cell read, once
+        if self._bounds is None:
+            cells = self.training_cells
+            saved = cells.mapped.log_odds_bounds(0, len(cells))
+            self._bounds = _LogOddsBounds(saved if saved is not None else
+                                          (tcell.compile().log_odds_bounds() for tcell in cells))
+        return self._bounds
+
+    def _threshold_scorer(self):
+        # Compiling would read every cell
+        return self
+
+    def good(self, xls_doc):
+        raise TypeError('Memory-mapped training sets are read-only')
+
+    def bad(self, xls_doc):
+        raise TypeError('Memory-mapped training sets are read-only')
+
+    def train_inputs(self, inputs, bad_set=False):
+        raise TypeError('Memory-mapped training sets are read-only')
+
+    def merge(self, other):
+        raise TypeError('Memory-mapped training sets are read-only')
+
+class _SparseCounts(object):
+    """Counts of one side of a nominal series for every cell, a dict per
+    cell that has any (None otherwise) and the totals in an array. For
+    series with many distinct values"""
+    def __init__(self, size):
+        self.counts = [None] * size
+        self.totals = array('l', [0]) * size
+
+    def add(self, ndx, value, how_much):
+        counts = self.counts[ndx]
+        if counts is None:
+            counts = self.counts[ndx] = {}
+        counts[value] = counts.get(value, 0) + how_much
+        self.totals[ndx] += how_much
+
+    def get(self, ndx, value):
+        counts = self.counts[ndx]
+        return counts.get(value) if counts else None
+
+    def distinct(self, ndx):
+        counts = self.counts[ndx]
+        return len(counts) if counts else 0
+
+    def items(self, ndx):
+        return (self.counts[ndx] or {}).items()
+
+class _DenseCounts(object):
+    """Counts of one side of a nominal series for every cell, an array of
+    every cell's counts per value. For series with a handful of values, 
+    like cell types"""
+    def __init__(self, size):
+        self.size = size
+        self.counts = {}
+        self.totals = array('l', [0]) * size
+
+    def add(self, ndx, value, how_much):
+        counts = self.counts.get(value)
+        if counts is None:
+            counts = self.counts[value] = array('l', [0]) * self.size
+        counts[ndx] += how_much
+        self.totals[ndx] += how_much
+
+    def get(self, ndx, value):
+        counts = self.counts.get(value)
+        return counts[ndx] if counts is not None and counts[ndx] else None
+
+    def distinct(self, ndx):
+        return sum(1 for counts in self.counts.itervalues() if counts[ndx])
+
+    def items(self, ndx):
+        return [(value, counts[ndx]) for value, counts in self.counts.iteritems() if counts[ndx]]
+
+class _NominalSlot(object):
+    """One nominal series of every cell of a CompactTrainingSet, scored
+    as the series of TrainingCell it stands for. Counts are kept by the 
+    id values (the set's ValueTable) gives"""
+    def __init__(self, series, size, dense, values):
+        inner = innermost_series(series)
+        self.transforms = series_transforms(series)
+        self.map_has_value = isinstance(inner, HasValueSeries)
+        self.ignore_blanks = inner.ignore_blanks
+        self.ignored_values = list(inner.ignored_values)
+        self.correct_for_confidence = inner.correct_for_confidence
+        self.estimate_missing_probabilities = inner.estimate_missing_probabilities
+        self.values = values
+        counts = _DenseCounts if dense else _SparseCounts
+        self.good_data = counts(size)
+        self.bad_data = counts(size)
+        self.good_unknown = array('l', [0]) * size
+        self.bad_unknown = array('l', [0]) * size
+
+    def _should_ignore(self, value):
+        return value in self.ignored_values or (self.ignore_blanks and not has_value(value))
+
+    def train(self, ndx, value, bad_set, how_much=1):
+        if self.map_has_value:
+            value = has_value(value)
+        if self._should_ignore(value):
+            (self.bad_unknown if bad_set else self.good_unknown)[ndx] += how_much
+        else:
+            (self.bad_data if bad_set else self.good_data).add(ndx, self.values.add(value), how_much)
+
+    def score(self, ndx, value):
+        if self.map_has_value:
+            value = has_value(value)
+        if not self.good_data.distinct(ndx) or self._should_ignore(value):
+            prob = 0.5
+        else:
+            value_id = self.values.get(value)
+            prob = bayes_probability(self.good_data.get(ndx, value_id), self.good_data.totals[ndx],
+                                     self.bad_data.get(ndx, value_id), self.bad_data.totals[ndx],
+                                     lambda: self.good_data.distinct(ndx) + self.bad_data.distinct(ndx),
+                                     self.correct_for_confidence, self.estimate_missing_probabilities)
+        for transform, parameter in self.transforms:
+            prob = transform(prob, parameter)
+        return prob
+
+    def load(self, ndx, series):
+        """Adds the counts of series, the innermost series of a cell"""
+        if series.sketch_size:
+            raise ValueError('Sets with sketched histograms cannot be made compact')
+        for bad_set, data, unknown in ((False, self.good_data, self.good_unknown), 
+                                       (True, self.bad_data, self.bad_unknown)):
+            if series.values is self.values:
+                for value_id, count in (series.bad_data if bad_set else series.good_data).iteritems():
+                    data.add(ndx, value_id, count)
+            else:
+                for value, count in series.value_counts(bad_set):
+                    data.add(ndx, self.values.add(value), count)
+            unknown[ndx] += series.bad_unknown_samples_count if bad_set else series.good_unknown_samples_count
+
+    def fill(self, ndx, series):
+        """Sets the counts of the empty innermost series of a cell, which
+        must share the ValueTable of the set"""
+        for side, data, unknown in (('good', self.good_data, self.good_unknown), 
+                                    ('bad', self.bad_data, self.bad_unknown)):
+            setattr(series, side + '_data', Histogram(data.items(ndx)))
+            setattr(series, side + '_unknown_samples_count', unknown[ndx])
+
+class _NumericSlot(object):
+    """The NumericSeries of every cell of a CompactTrainingSet, the 
+    moments of each side in arrays"""
+    def __init__(self, series, size):
+        self.transforms = series_transforms(series)
+        for side in ('good', 'bad'):
+            setattr(self, side + '_count', array('l', [0]) * size)
+            setattr(self, side + '_mean', array('d', [0.0]) * size)
+            setattr(self, side + '_m2', array('d', [0.0]) * size)
+            setattr(self, side + '_unknown', array('l', [0]) * size)
+
+    def _side(self, bad_set):
+        side = 'bad' if bad_set else 'good'
+        return (getattr(self, side + '_count'), getattr(self, side + '_mean'), 
+                getattr(self, side + '_m2'), getattr(self, side + '_unknown'))
+
+    def train(self, ndx, value, bad_set, how_much=1):
+        count, mean, m2, unknown = self._side(bad_set)
+        value = as_number(value)
+        if value == None:
+            unknown[ndx] += 1
+            return
+        # Zeros have never been counted as samples, as in NumericSeries
+        if not value:
+            return
+        # NumericMoments.add
+        count[ndx] += how_much
+        delta = value - mean[ndx]
+        mean[ndx] += delta * how_much / count[ndx]
+        m2[ndx] += how_much * delta * (value - mean[ndx])
+
+    def _parameters(self, ndx, bad_set):
+        count, mean, m2, unknown = self._side(bad_set)
+        return moment_parameters(count[ndx], mean[ndx], m2[ndx], unknown[ndx])
+
+    def score(self, ndx, value):
+        value = as_number(value)
+        if value == None:
+            prob = 0.5
+        else:
+            good_prob = numeric_side_score(value, self._parameters(ndx, False))
+            bad_prob = numeric_side_score(value, self._parameters(ndx, True))
+            prob = good_prob / (good_prob + bad_prob)
+        for transform, parameter in self.transforms:
+            prob = transform(prob, parameter)
+        return prob
+
+    def load(self, ndx, series):
+        for bad_set, moments, unknown_count in ((False, series.good_data, series.good_unknown_samples_count),
+                                                (True, series.bad_data, series.bad_unknown_samples_count)):
+            count, mean, m2, unknown = self._side(bad_set)
+            # NumericMoments.merge
+            unknown[ndx] += unknown_count
+            if moments.count == 0:
+                continue
+            if count[ndx] == 0:
+                # Copied as they are, so converted sets score the same
+                count[ndx], mean[ndx], m2[ndx] = moments.count, moments.mean, moments.m2
+                continue
+            total = count[ndx] + moments.count
+            delta = moments.mean - mean[ndx]
+            mean[ndx] += delta * moments.count / total
+            m2[ndx] += moments.m2 + delta * delta * count[ndx] * moments.count / total
+            count[ndx] = total
+
+    def fill(self, ndx, series):
+        for bad_set, moments in ((False, series.good_data), (True, series.bad_data)):
+            count, mean, m2, unknown = self._side(bad_set)
+            moments.count, moments.mean, moments.m2 = count[ndx], mean[ndx], m2[ndx]
+        series.good_unknown_samples_count = self.good_unknown[ndx]
+        series.bad_unknown_samples_count = self.bad_unknown[ndx]
+
+class _CompactCell(object):
+    """Cell ndx of a CompactTrainingSet, with the TrainingCell methods"""
+    __slots__ = ('tset', 'ndx')
+
+    def __init__(self, tset, ndx):
+        self.tset = tset
+        self.ndx = ndx
+
+    def good(self, cell_type, cell_value):
+        for slot, value in izip(self.tset.slots, self.tset._slot_inputs(cell_type, cell_value)):
+            slot.train(self.ndx, value, False)
+
+    def bad(self, cell_type, cell_value):
+        for slot, value in izip(self.tset.slots, self.tset._slot_inputs(cell_type, cell_value)):
+            slot.train(self.ndx, value, True)
+
+    def score(self, cell_type, cell_value):
+        return [slot.score(self.ndx, value) for slot, value
+                in izip(self.tset.slots, self.tset._slot_inputs(cell_type, cell_value))]
+
+    def merge(self, other):
+        if isinstance(other, _CompactCell):
+            other = other.training_cell()
+        for slot, series in izip(self.tset.slots, other.value_classes + other.type_classes):
+            slot.load(self.ndx, innermost_series(series))
+
+    def training_cell(self):
+        """A TrainingCell with a copy of the counts of this one"""
+        tcell = TrainingCell(self.tset.parameters, self.tset.values)
+        for slot, series in izip(self.tset.slots, tcell.value_classes + tcell.type_classes):
+            slot.fill(self.ndx, innermost_series(series))
+        return tcell
+
+    def compile(self):
+        return self.training_cell().compile()
+
+    # Copies, for code reading the series (storage, sweeps). Training 
+    # them doesn't train the set
+    @property
+    def value_classes(self):
+        return self.training_cell().value_classes
+
+    @property
+    def type_classes(self):
+        return self.training_cell().type_classes
+
+    def __repr__(self):
+        return 'CTCell'
+
+class _CompactCells(object):
+    """Sequence of the cells of a CompactTrainingSet"""
+    def __init__(self, tset):
+        self.tset = tset
+
+    def __len__(self):
+        return self.tset.size
+
+    def __getitem__(self, ndx):
+        if ndx < 0:
+            ndx += self.tset.size
+        if not 0 <= ndx < self.tset.size:
+            raise IndexError(ndx)
+        return _CompactCell(self.tset, ndx)
+
+    def __iter__(self):
+        for ndx in xrange(self.tset.size):
+            yield _CompactCell(self.tset, ndx)
+
+class CompactTrainingSet(TrainingSet):
+    """TrainingSet holding every cell's counts in one structure per 
+    series, indexed by cell position, instead of a TrainingCell of series
+    objects per cell. The parameters are kept once for the set, numeric
+    moments and unknown counts are arrays, cell types and has-value counts
+    one array per value, and the trained values a dict per cell that has 
+    any. Scores are the same as those of a TrainingSet with the same 
+    parameters trained with the same files, training_cells gives views of 
+    the cells with the TrainingCell methods."""
+
+    # Saved in the header of binary sets, which are loaded as TrainingSets
+    layout = 'compact'
+
+    def __init__(self, start_row, end_row, start_col, end_col, sheet, parameters=DEFAULT_CELL_PARAMETERS):
+        self.start_row = start_row
+        self.end_row = end_row
+        self.start_col = start_col
+        self.end_col = end_col
+        self.sheet = sheet
+        self.parameters = CellParameters(*parameters)
+        self.size = (1 + self.end_row - self.start_row) * (1 + self.end_col - self.start_col)
+        self.values = ValueTable()
+        prototype = TrainingCell(self.parameters)
+        self.value_slots = len(prototype.value_classes)
+        self.slots = ([_NominalSlot(series, self.size, isinstance(innermost_series(series), HasValueSeries), self.values)
+                       if not isinstance(innermost_series(series), NumericSeries) 
+                       else _NumericSlot(series, self.size) for series in prototype.value_classes] +
+                      [_NominalSlot(series, self.size, True, self.values) for series in prototype.type_classes])
+        self.training_cells = _CompactCells(self)
+
+    @classmethod
+    def from_set(cls, tset):
+        """CompactTrainingSet with the counts of tset"""
+        if tset.column_template:
+            raise ValueError('Column templates cannot be made compact')
+        compact = cls(*tset.geometry)
+        compact.generation = tset.generation
+        compact.merge(tset)
+        return compact
+
+    def empty_like(self):
+        return CompactTrainingSet(*self.geometry, parameters=self.parameters)
+
+    def to_training_set(self):
+        """TrainingSet of TrainingCells with the counts of this set"""
+        tset = TrainingSet(*self.geometry)
+        tset.generation = self.generation
+        tset.values = self.values
+        tset.training_cells = [tcell.training_cell() for tcell in self.training_cells]
+        return tset
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['training_cells']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.training_cells = _CompactCells(self)
+
+    def __repr__(self):
+        return repr(dict(geometry=self.geometry, parameters=self.parameters, cells=self.size))
+
+    def _slot_inputs(self, cell_type, cell_value):
+        return [cell_value] * self.value_slots + [cell_type] * (len(self.slots) - self.value_slots)
+
+def _scoring_options_error(set_name, options):
+    """Message for verification options that can't be used with the set,
+    None if they can"""
+    if options['use_mmap'] and not storage.is_binary_set(set_name):
+        return '--mmap needs a binary (%s) set, %s is pickled. Convert it with --convert' % (
+            storage.BINARY_EXTENSION, set_name)
+    try:
+        _parse_thresholds(options['threshold'])
+        parse_rows(options['rows'])
+    except ValueError, e:
+        return str(e)
+    return None
+
+def _open_for_scoring(set_name, options):
+    """Opens the set as the verification options ask for"""
+    if options['use_mmap']:
+        with profiling.stage('load set'):
+            tset = MappedTrainingSet(set_name)
+        if training_log.read_log(set_name, tset.generation):
+            print >> sys.stderr, ('%s has workbooks in its training log, loading it without --mmap. ' +
+                                  'Use --compact to fold them into the set') % (set_name)
+            tset = open_training_set(set_name)
+    else:
+        tset = open_training_set(set_name)
+    return scoring_model(tset, options['use_numpy'])
+
+def compile_trainingset(*args, **kwargs):
+    set_name = args[0]
+    compiled_name = args[1]
+    print 'Compiling set %s into %s' % (set_name, compiled_name)
+    compiled = open_training_set(set_name).compile()
+    error = save_error(compiled, compiled_name)
+    if error:
+        print >> sys.stderr, error
+        return 2
+    save_training_set(compiled, compiled_name)
+    return 0
 
 if __name__ == '__main__':
 
@@ -210,9 +1467,29 @@ if __name__ == '__main__':
     parser.add_option('--init', dest='cmd', action='store_const', const=init_trainingset,
                           default=None, help='Initialises a training set')
     parser.add_option('--train', dest='cmd', action='store_const', const=train_trainingset,
-                          default=None, help='Trains the training set with the files provided')
+                          default=None, help='Trains the training set with the files provided, ' +
+                          'appending them to the training log of the set')
+    parser.add_option('--train-batch', dest='cmd', action='store_const', const=train_batch,
+                          default=None, help='Trains the training set with every file, directory or glob provided, ' +
+                          'loading and saving the set only once')
     parser.add_option('--verify', dest='cmd', action='store_const', const=verify_file,
                           default=None, help='Returns the probability that the file is good, within the specified training set')
+    parser.add_option('--verify-batch', dest='cmd', action='store_const', const=verify_batch,
+                          default=None, help='Scores every file, directory or glob provided (- or nothing for paths on ' +
+                          'stdin) against the training set, writing one record per file')
+    parser.add_option('--compile', dest='cmd', action='store_const', const=compile_trainingset,
+                          default=None, help='Saves a read-only, faster to score copy of the training set. ' +
+                          'Usage: compare.py --compile trainingset_name compiled_name')
+    parser.add_option('--convert', dest='cmd', action='store_const', const=convert_trainingset,
+                          default=None, help='Copies a training set, saving it in the binary format if the new name ends ' +
+                          'in %s and pickled otherwise. Usage: compare.py --convert trainingset_name new_name' % (storage.BINARY_EXTENSION))
+    parser.add_option('--compact', dest='cmd', action='store_const', const=compact_trainingset,
+                          default=None, help='Folds the training log (<set>%s) written by --train into the set' % 
+                          (training_log.LOG_EXTENSION))
+    parser.add_option('--sweep', dest='cmd', action='store_const', const=sweep_parameters,
+                          default=None, help='Cross-validates combinations of the cell parameters over labelled ' +
+                          'files, reporting accuracy and AUC for each. The files are read and the counts trained ' +
+                          'only once per fold')
     parser.add_option('--show', dest='cmd', action='store_const', const=show_trainingset,
                           default=None, help='Display information about the trainingset specified')
 
@@ -233,6 +1510,22 @@ if __name__ == '__main__':
     init_opts.add_option('--column-end', '--ce', action='store', dest='end_col', 
                          help='Last column to process, base 0')
 
+    init_opts.add_option('--compact-grid', dest='compact_grid', action='store_const', const=True, default=False,
+                         help='Keep the counts of the cells in arrays shared by the whole set instead of objects ' +
+                         'per cell, much smaller for large regions. Scores are the same. Also converts a set ' +
+                         'with --convert')
+
+    init_opts.add_option('--body-row', dest='body_row', action='store', type='int', default=None,
+                         help='First row of a body of rows sharing the same columns, base 0. Makes a column ' +
+                         'template: the rows from --row-start to the body are the header, with a model per cell, ' +
+                         'and every body row down to the last of the sheet trains and is scored against one model ' +
+                         'per column, so any number of rows can be scored. Replaces --row-end')
+
+    init_opts.add_option('--sketch-values', dest='sketch_values', action='store', type='int', default=None,
+                         help='Most values the value series of a cell keeps per side. Values past it are counted ' +
+                         'in a fixed size sketch and only the most frequent keep their counts, so memory stays ' +
+                         'flat for cells holding identifiers. Sketched sets can only be saved as pickles')
+
     parser.add_option_group(init_opts)
 
     train_opts = OptionGroup(parser, 'Training Options', 'Usage: compare.py --train [options] trainingset_name files*')
@@ -243,12 +1536,85 @@ if __name__ == '__main__':
     
     parser.add_option_group(train_opts)
 
+    batch_opts = OptionGroup(parser, 'Batch Training Options', 
+                             'Usage: compare.py --train-batch [options] trainingset_name [files|directories|globs]*')
+    batch_opts.add_option('--manifest', action='store', dest='manifest', default=None,
+                          help='File with one "good <path>" or "bad <path>" line per entry, - for stdin')
+    batch_opts.add_option('--checkpoint-every', action='store', dest='checkpoint_every', type='int', 
+                          default=0, help='Save the training set every N files')
+    batch_opts.add_option('--jobs', '-j', action='store', dest='jobs', type='int', default=1,
+                          help='Number of processes to train or verify with, partial training sets are merged at the end')
+
+    parser.add_option_group(batch_opts)
+
     verify_opts = OptionGroup(parser, 'Verification Options', 'Usage: compare.py --verify [options] trainingset_name file')
     verify_opts.add_option('--show-grid', dest='show_grid', action='store_const', const=True, 
                           default=False, help='Show the grid of probabilities per cell in addition to the overall probability.')
+    verify_opts.add_option('--numpy', dest='use_numpy', action='store_const', const=True, default=False,
+                           help='Score every cell at once with NumPy, also applies to --verify-batch')
+    verify_opts.add_option('--mmap', dest='use_mmap', action='store_const', const=True, default=False,
+                           help='Memory-map a binary (%s) set and only read the cells being scored' % (storage.BINARY_EXTENSION))
+    verify_opts.add_option('--rows', dest='rows', action='store', default=None,
+                           help='Only score these rows of the set, as first:last, base 0')
+    verify_opts.add_option('--threshold', dest='threshold', action='store', default=None,
+                           help='Only decide whether the file is good, as bad_below:good_from (%s:%s for the ' % 
+                           THRESHOLD_BANDS + '--show-grid colours) or a single threshold, stopping once the cells ' +
+                           'left cannot change the verdict. Reports the verdict, bounds of the probability and ' +
+                           'the cells scored, also applies to --verify-batch')
 
     parser.add_option_group(verify_opts)
 
+    verify_batch_opts = OptionGroup(parser, 'Batch Verification Options', 
+                                    'Usage: compare.py --verify-batch [options] trainingset_name [files|directories|globs|-]*')
+    verify_batch_opts.add_option('--format', action='store', dest='output_format', default='jsonl',
+                                 help='jsonl (default) or csv, with path, probability, seconds, bytes and rows parsed and error per file')
+    verify_batch_opts.add_option('--output', '-o', action='store', dest='output', default=None,
+                                 help='File to write the results to, stdout by default')
+
+    parser.add_option_group(verify_batch_opts)
+
+    sweep_opts = OptionGroup(parser, 'Sweep Options', 
+                             'Usage: compare.py --sweep [options] trainingset_name [files|directories|globs]*, ' +
+                             'with --bad and --manifest as for --train-batch and -j to evaluate in parallel')
+    sweep_opts.add_option('--folds', action='store', dest='folds', type='int', default=5,
+                          help='Number of cross-validation folds, 5 by default')
+    sweep_opts.add_option('--grid', action='append', dest='grid', default=None,
+                          help='name=value,value,... values to try for one of the cell parameters (%s), ' % 
+                          (', '.join(CellParameters._fields)) + 'can be repeated. The rest keep their defaults')
+
+    parser.add_option_group(sweep_opts)
+
+    prefetch_opts = OptionGroup(parser, 'Prefetch Options',
+                                'Used by --train, --train-batch and --verify-batch without --jobs, reading files ' + 
+                                'in threads while the previous ones are parsed')
+    prefetch_opts.add_option('--prefetch', action='store', dest='prefetch', type='int', default=0,
+                             help='Number of threads reading files ahead, 0 (default) reads each file when its ' +
+                             'turn comes. Worth it when reading is slow, as on network storage')
+    prefetch_opts.add_option('--prefetch-queue', action='store', dest='prefetch_queue', type='int', default=16,
+                             help='Most files read ahead and waiting, 16 by default')
+
+    parser.add_option_group(prefetch_opts)
+
+    cache_opts = OptionGroup(parser, 'Grid Cache Options',
+                             'Used by --train, --train-batch, --verify and --verify-batch')
+    cache_opts.add_option('--cache', action='store', dest='cache', default=None,
+                          help='Directory caching the cells read from each workbook, by content hash and region, ' +
+                          'so reading the same files again skips parsing them')
+    cache_opts.add_option('--cache-size', action='store', dest='cache_size', type='int', default=256,
+                          help='Size limit of the cache in MB, the least recently used entries are removed ' +
+                          'past it. Defaults to 256')
+
+    parser.add_option_group(cache_opts)
+
+    profile_opts = OptionGroup(parser, 'Profiling Options', 'Used by every command')
+    profile_opts.add_option('--profile', dest='profile', action='store_const', const=True, default=False,
+                            help='Print the wall and CPU time and calls of every stage and series type, and ' +
+                            'the peak memory, to stderr when done')
+    profile_opts.add_option('--profile-output', dest='profile_output', action='store', default=None,
+                            help='Also write the profile as JSON to this file, implies --profile')
+
+    parser.add_option_group(profile_opts)
+
     (options, args) = parser.parse_args()
 
     options.end_row = int(options.end_row) if options.end_row else 0
@@ -260,7 +1626,14 @@ if __name__ == '__main__':
     elif options.sheet.isdigit(): options.sheet = int(options.sheet)
 
     if options.cmd != None:
-        exit(options.cmd(*args, **options.__dict__))
+        if not (options.profile or options.profile_output):
+            exit(options.cmd(*args, **options.__dict__))
+        profiling.enable()
+        try:
+            result = options.cmd(*args, **options.__dict__)
+        finally:
+            profiling.write_report(profiling.disable(), ' '.join(sys.argv[1:]), options.profile_output)
+        exit(result)
 
     if len(args) > 0:
         if args[0] == 'test':
@@ -1,28 +1,104 @@
 from statistics import *
 
-class NumericRangeBase(object):
-    def __add__(self, other):
-        new_nums = []
-        new_nums.extend(self.numbers)
-        new_nums.extend(other.numbers)
-        return NumericRangeCollection(new_nums)
+def as_number(value):
+    typ = type(value)
+    if typ == float or typ == int:
+        return value
+    else:
+        try:
+            return float(str(value))
+        except ValueError:
+            return None
+
+def has_value(value):
+    if value:
+        if value == '' or repr(value).strip() == '':
+            return False
+        else: 
+            return True
+    else: 
+        return False
+
+def moment_parameters(count, mean, m2, unknown_samples_count=0):
+    """NumericMoments.parameters of moments with this count, mean and m2"""
+    if count < 2:
+        mean, stdev = (None, 0)
+    else:
+        stdev = math.sqrt(m2 / (count - 1))
+
+    #with rate_divisor = 50:
+    #confidence: f(self.count): f(0)=0, f(25)=0.2, f(50)=0.5 and f(100)=0.8, f(500)=0.990
+    rate_divisor = 20
+    confidence = 1 - (1.0 / (math.pow(count * 1.0 / rate_divisor, 2) + 1))
+
+    #We don't want to to be overly confident, adjust for the number of samples 
+    #that we couldn't take into account because they weren't numbers
+    corrected_confidence = confidence
+    if unknown_samples_count > 0:
+        corrected_confidence *= count * 1.0 / (count + unknown_samples_count)
+
+    return (mean, stdev, confidence, corrected_confidence)
+
+class NumericMoments(object):
+    """Running count, mean and sum of squared differences (Welford), so
+    the mean and standard deviation are kept without storing the numbers.
+    Weights behave like adding the same value that many times.
+
+    >>> m = NumericMoments()
+    >>> m.add(2.0, 3)
+    >>> m.add(4.0)
+    >>> m.count, m.mean
+    (4, 2.5)
+    >>> mean, stdev = m._calculate()
+    >>> str(round(stdev, 6))
+    '1.0'
+    >>> mean, stdev = calculate_stdev([2.0, 2.0, 2.0, 4.0])
+    >>> str(round(stdev, 6))
+    '1.0'
+    >>> NumericMoments([1.0, 2.0, 3.0]).mean
+    2.0
+    >>> merged = NumericMoments([1.0, 2.0])
+    >>> merged.merge(NumericMoments([3.0, 6.0]))
+    >>> merged.count, merged.mean, merged.m2 == NumericMoments([1.0, 2.0, 3.0, 6.0]).m2
+    (4, 3.0, True)
+    """
+    def __init__(self, numbers=()):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        for number in numbers:
+            self.add(number)
+
+    def add(self, value, weight=1):
+        self.count += weight
+        delta = value - self.mean
+        self.mean += delta * weight / self.count
+        self.m2 += weight * delta * (value - self.mean)
+
+    def merge(self, other):
+        """Combines the moments of other into these (Chan et al.), the
+        result is the same as adding other's values after ours"""
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
 
     def _calculate(self):
         if self.count < 2:
             return (None, 0)
-    
-        return calculate_stdev(self.numbers)
-            
-    def score(self, value, unknown_samples_count=0):
-        if not hasattr(self, '_result'):
-            self._result = self._calculate()
-            
-        mean, stdev = self._result
 
-        #with rate_divisor = 50:
-        #confidence: f(self.count): f(0)=0, f(25)=0.2, f(50)=0.5 and f(100)=0.8, f(500)=0.990
-        rate_divisor = 20
-        confidence = 1 - (1.0 / (math.pow(self.count * 1.0 / rate_divisor, 2) + 1))
+        return (self.mean, math.sqrt(self.m2 / (self.count - 1)))
+
+    def parameters(self, unknown_samples_count=0):
+        """(mean, stdev, confidence, confidence corrected for the samples
+        that weren't numbers), everything score needs besides the value"""
+        return moment_parameters(self.count, self.mean, self.m2, unknown_samples_count)
+
+    def score(self, value, unknown_samples_count=0):
+        mean, stdev, confidence, corrected_confidence = self.parameters(unknown_samples_count)
 
         if stdev == 0:
             if value == mean: 
@@ -34,28 +110,18 @@ class NumericRangeBase(object):
 
         probability = 1.0 / (math.pow(diff / stdev, 2) + 1)
 
-        #We don't want to to be overly confident, adjust for the number of samples 
-        #that we couldn't take into account because they weren't numbers
-        if unknown_samples_count > 0:
-            confidence *= self.count * 1.0 / (self.count + unknown_samples_count)
-
-        return (probability, confidence)
+        return (probability, corrected_confidence)
 
-class NumericRangeCollection(NumericRangeBase):
+class NumericRangeCollection(object):
+    """List-backed storage used before NumericMoments, only kept so 
+    that old pickled training sets can be loaded"""
     def __init__(self, numbers):
         self.numbers = numbers
-        self.count = len(self.numbers)
 
-    def __add__(self, other):
-        new_nums = []
-        new_nums.extend(self.numbers)
-        new_nums.extend(other.numbers)
-        return NumericRangeCollection(new_nums)
-
-class NumericRangeHolder(NumericRangeBase):
+class NumericRangeHolder(object):
+    """See NumericRangeCollection"""
     def __init__(self, number):
         self.number = number
-        self.count = 1 if self.number else 0
 
     @property
     def numbers(self):
@@ -75,40 +141,52 @@ class NumericSeries(object):
     >>> n.bad(0.303, 2)
     >>> n.score(0.35) > 0.8
     True
+    >>> n.good_data.count
+    633
     """
     def __init__(self):
-        self.good_data = NumericRangeHolder(None)
-        self.bad_data = NumericRangeHolder(None)
+        self.good_data = NumericMoments()
+        self.bad_data = NumericMoments()
         self.good_unknown_samples_count = 0
         self.bad_unknown_samples_count = 0
 
+    def __setstate__(self, state):
+        # Sets pickled before NumericMoments hold the raw numbers
+        for key in ('good_data', 'bad_data'):
+            if not isinstance(state[key], NumericMoments):
+                state[key] = NumericMoments(state[key].numbers)
+        self.__dict__.update(state)
+
     def _as_number(self, value):
-        typ = type(value)
-        if typ == float or typ == int:
-            return value
-        else:
-            try:
-                return float(str(value))
-            except ValueError:
-                return None
+        return as_number(value)
         
     def good(self, value, how_much=1):
         value = self._as_number(value)
         if value == None: 
             self.good_unknown_samples_count += 1
             return
+        # Zeros have never been counted as samples, keep scores stable
+        if not value:
+            return
 
-        for i in range(0, how_much):
-            self.good_data += NumericRangeHolder(value)
+        self.good_data.add(value, how_much)
 
     def bad(self, value, how_much=1):
         value = self._as_number(value)
         if value == None: 
             self.bad_unknown_samples_count += 1
             return
+        # Zeros have never been counted as samples, keep scores stable
+        if not value:
+            return
+
+        self.bad_data.add(value, how_much)
 
-        for i in range(0, how_much):
-            self.bad_data += NumericRangeHolder(value)
+    def merge(self, other):
+        self.good_data.merge(other.good_data)
+        self.bad_data.merge(other.bad_data)
+        self.good_unknown_samples_count += other.good_unknown_samples_count
+        self.bad_unknown_samples_count += other.bad_unknown_samples_count
 
     def score(self, value):
         value = self._as_number(value)
@@ -123,6 +201,10 @@ class NumericSeries(object):
 
         return good_prob / (good_prob + bad_prob)
 
+    def compile(self):
+        return CompiledNumericSeries(self.good_data.parameters(self.good_unknown_samples_count),
+                                     self.bad_data.parameters(self.bad_unknown_samples_count))
+
 class BiasedSeries(object):
     """
     Exponents > 1 cause negative bias, exponents between 0 and 1
@@ -144,6 +226,16 @@ class BiasedSeries(object):
     def bad(self, value):
         self.inner_series.bad(value)
 
+    def merge(self, other):
+        self.inner_series.merge(other.inner_series)
+
+    @property
+    def transform(self):
+        return (adjust_for_bias, self.exponent)
+
+    def compile(self):
+        return self.inner_series.compile().transformed(*self.transform)
+
 class LowConfidenceSeries(object):
     def __init__(self, inner_series, confidence):
         self.inner_series = inner_series
@@ -160,6 +252,16 @@ class LowConfidenceSeries(object):
     def bad(self, value):
         self.inner_series.bad(value)
 
+    def merge(self, other):
+        self.inner_series.merge(other.inner_series)
+
+    @property
+    def transform(self):
+        return (adjust_for_confidence, self.confidence)
+
+    def compile(self):
+        return self.inner_series.compile().transformed(*self.transform)
+
 class ModerationSeries(object):
     """Exponents > 1 result in a radical bias, exponents between 0-1 
     produce a moderation bias.
@@ -181,9 +283,44 @@ class ModerationSeries(object):
     def bad(self, value):
         self.inner_series.bad(value)
 
+    def merge(self, other):
+        self.inner_series.merge(other.inner_series)
 
-class NominalSeries(object):
+    @property
+    def transform(self):
+        return (adjust_for_moderation, self.exponent)
+
+    def compile(self):
+        return self.inner_series.compile().transformed(*self.transform)
+
+
+def innermost_series(series):
+    """The series that holds the training data, inside any wrappers"""
+    while hasattr(series, 'inner_series'):
+        series = series.inner_series
+    return series
+
+def series_transforms(series):
+    """(transform, parameter) of every wrapper of series, innermost first:
+    series.score(v) applies them in order to the innermost series' score.
+
+    >>> s = ModerationSeries(BiasedSeries(NumericSeries(), 1.9), 2)
+    >>> [(t.__name__, p) for t, p in series_transforms(s)]
+    [('adjust_for_bias', 1.9), ('adjust_for_moderation', 2)]
     """
+    transforms = []
+    while hasattr(series, 'inner_series'):
+        transforms.insert(0, series.transform)
+        series = series.inner_series
+    return transforms
+
+class NominalSeries(object):
+    """Counts of every value trained as good and bad. Values are kept in
+    a ValueTable, which the series of a whole set share, and the 
+    histograms count their ids. With a sketch_size the histograms are
+    SketchHistograms keeping at most that many values each, and count 
+    the values themselves so the table doesn't grow with every value
+
     >>> n = NominalSeries()
     >>> n.good('test')
     >>> n.bad('gold', 20)
@@ -197,11 +334,30 @@ class NominalSeries(object):
     True
     >>> bayes_combine([n.score('test'), n.score('diego'), n.score('patata')]) > 0.5
     True
+    >>> m = NominalSeries()
+    >>> m.good('test', 2)
+    >>> m.bad(None)
+    >>> m.merge(n)
+    >>> m.good_data[m.values.get('test')], m.bad_data.value_total
+    (3, 521)
+    >>> sorted(m.value_counts(bad_set=True))
+    [(None, 1), ('gold', 20), ('patata', 500)]
+    >>> s = NominalSeries(sketch_size=8)
+    >>> for n in range(100): s.good('ID%d' % (n))
+    >>> s.good('a', 50)
+    >>> s.bad('b', 50)
+    >>> len(s.good_data), s.good_data.value_total, s.score('a') > 0.5
+    (8, 150, True)
     """
+    # Sets pickled before sketches count exactly
+    sketch_size = None
+
     def __init__(self, ignore_blanks=False, ignored_values=[], correct_for_confidence=True,
-                 estimate_missing_probabilities=True):
-        self.good_data = Histogram()
-        self.bad_data = Histogram()
+                 estimate_missing_probabilities=True, values=None, sketch_size=None):
+        self.values = ValueTable() if values is None else values
+        self.sketch_size = sketch_size
+        self.good_data = self._histogram()
+        self.bad_data = self._histogram()
 
         self.good_unknown_samples_count = 0
         self.bad_unknown_samples_count = 0
@@ -213,14 +369,35 @@ class NominalSeries(object):
 
         self.estimate_missing_probabilities=estimate_missing_probabilities
 
+    def __setstate__(self, state):
+        # Sets pickled before the ValueTable count the values themselves
+        if 'values' not in state:
+            state['values'] = ValueTable()
+            for key in ('good_data', 'bad_data'):
+                state[key] = Histogram([(state['values'].add(value), count) 
+                                        for value, count in state[key].iteritems()])
+        self.__dict__.update(state)
+
+    def _histogram(self):
+        return SketchHistogram(self.sketch_size) if self.sketch_size else Histogram()
+
+    def _key(self, value):
+        """Key counting value in the histograms"""
+        return value if self.sketch_size else self.values.add(value)
+
+    def _find(self, value):
+        """Key of value if it is in the histograms, or something no value
+        has as key"""
+        if self.sketch_size:
+            return value
+        value_id = self.values.get(value)
+        return _never_trained if value_id is None else value_id
+
+    def _value(self, key):
+        return key if self.sketch_size else self.values.value(key)
+
     def _has_value(self, value):
-        if value:
-            if value == '' or repr(value).strip() == '':
-                return False
-            else: 
-                return True
-        else: 
-            return False
+        return has_value(value)
 
     def _should_ignore(self, value):
         if value in self.ignored_values:
@@ -235,14 +412,34 @@ class NominalSeries(object):
             self.good_unknown_samples_count += how_much
             return
             
-        self.good_data[value] += how_much
+        self.good_data.add(self._key(value), how_much)
 
     def bad(self, value, how_much=1):
         if self._should_ignore(value):
             self.bad_unknown_samples_count += how_much
             return
 
-        self.bad_data[value] += how_much
+        self.bad_data.add(self._key(value), how_much)
+
+    def value_counts(self, bad_set=False):
+        """(value, count) of every value trained as good, or bad"""
+        data = self.bad_data if bad_set else self.good_data
+        return [(self._value(key), count) for key, count in data.iteritems()]
+
+    def merge(self, other):
+        if (self.sketch_size and other.sketch_size) or (not self.sketch_size and not other.sketch_size
+                                                         and other.values is self.values):
+            # Same keys
+            self.good_data.merge(other.good_data)
+            self.bad_data.merge(other.bad_data)
+        else:
+            if getattr(other.good_data, 'sketch', None) is not None or getattr(other.bad_data, 'sketch', None) is not None:
+                raise ValueError('Sketched histograms only merge into sketched series')
+            for data, bad_set in ((self.good_data, False), (self.bad_data, True)):
+                for value, count in other.value_counts(bad_set):
+                    data.add(self._key(value), count)
+        self.good_unknown_samples_count += other.good_unknown_samples_count
+        self.bad_unknown_samples_count += other.bad_unknown_samples_count
 
     def score(self, value):
         if len(self.good_data) == 0:
@@ -250,11 +447,34 @@ class NominalSeries(object):
         if self._should_ignore(value):
             return 0.5
 
-        res = calculate_bayes_probability(value, self.good_data, self.bad_data, correct_for_confidence=self.correct_for_confidence,
+        res = calculate_bayes_probability(self._find(value), self.good_data, self.bad_data, correct_for_confidence=self.correct_for_confidence,
                                   estimate_missing_probabilities=self.estimate_missing_probabilities)
         #print '   Nominal series score for \'%s\': %f' % (str(value), res)
         return res
 
+    def compile(self, map_has_value=False):
+        if len(self.good_data) == 0:
+            probabilities = {}
+            missing_probability = 0.5
+        else:
+            score = lambda key: calculate_bayes_probability(
+                key, self.good_data, self.bad_data, correct_for_confidence=self.correct_for_confidence,
+                estimate_missing_probabilities=self.estimate_missing_probabilities)
+            probabilities = dict((self._value(key), score(key)) for key in 
+                                 set(self.good_data.keys()) | set(self.bad_data.keys()) 
+                                 if not self._should_ignore(self._value(key)))
+            missing_probability = score(_never_trained)
+
+        return CompiledNominalSeries(probabilities, missing_probability, 0.5, self.ignore_blanks,
+                                     self.ignored_values, map_has_value=map_has_value)
+
+class _NeverTrained(object):
+    """Stands for a value that isn't in any histogram"""
+    def __repr__(self):
+        return '<never trained>'
+
+_never_trained = _NeverTrained()
+
 class HasValueSeries(NominalSeries):
     """
     >>> n = HasValueSeries()
@@ -283,6 +503,122 @@ class HasValueSeries(NominalSeries):
         value = self._has_value(value)
         return super(HasValueSeries, self).score(value)
 
+    def compile(self):
+        return super(HasValueSeries, self).compile(map_has_value=True)
+
+class CompiledNominalSeries(object):
+    """Read-only NominalSeries with the probability of every trained value,
+    and of any other value, precomputed. Wrapping transforms are applied 
+    to the stored probabilities when compiling, so scoring is a lookup.
+
+    >>> n = LowConfidenceSeries(BiasedSeries(NominalSeries(ignore_blanks=True), 1.5), 0.9)
+    >>> for v in ['a'] * 30 + ['b'] * 5 + ['']: n.good(v)
+    >>> for v in ['b'] * 10 + ['c'] * 3: n.bad(v)
+    >>> compiled = n.compile()
+    >>> [compiled.score(v) == n.score(v) for v in ('a', 'b', 'c', 'd', '', None)]
+    [True, True, True, True, True, True]
+    """
+    def __init__(self, probabilities, missing_probability, ignored_probability, 
+                 ignore_blanks, ignored_values, map_has_value=False):
+        self.probabilities = probabilities
+        self.missing_probability = missing_probability
+        self.ignored_probability = ignored_probability
+        self.ignore_blanks = ignore_blanks
+        self.ignored_values = tuple(ignored_values)
+        self.map_has_value = map_has_value
+
+    def transformed(self, transform, parameter):
+        """Returns a copy with transform(prob, parameter) applied to every probability"""
+        return CompiledNominalSeries(
+            dict((value, transform(prob, parameter)) for value, prob in self.probabilities.iteritems()),
+            transform(self.missing_probability, parameter), transform(self.ignored_probability, parameter),
+            self.ignore_blanks, self.ignored_values, map_has_value=self.map_has_value)
+
+    def bounds(self):
+        """(lowest, highest) probability score can return"""
+        probs = self.probabilities.values() + [self.missing_probability, self.ignored_probability]
+        return (min(probs), max(probs))
+
+    def score(self, value):
+        if self.map_has_value:
+            value = has_value(value)
+        if value in self.ignored_values or (self.ignore_blanks and not has_value(value)):
+            return self.ignored_probability
+        return self.probabilities.get(value, self.missing_probability)
+
+def numeric_side_score(value, parameters):
+    # Same as NumericMoments.score followed by the confidence adjustment
+    # in NumericSeries.score
+    mean, stdev, confidence, corrected_confidence = parameters
+    if stdev == 0:
+        return adjust_for_confidence(1 if value == mean else 0, confidence)
+
+    probability = 1.0 / (math.pow(abs(value - mean) / stdev, 2) + 1)
+    return adjust_for_confidence(probability, corrected_confidence)
+
+def _numeric_side_bounds(parameters):
+    """(lowest, highest) numeric_side_score for any value"""
+    mean, stdev, confidence, corrected_confidence = parameters
+    if stdev == 0:
+        return (adjust_for_confidence(0, confidence), adjust_for_confidence(1, confidence))
+    return (adjust_for_confidence(0, corrected_confidence), adjust_for_confidence(1, corrected_confidence))
+
+class CompiledNumericSeries(object):
+    """Read-only NumericSeries keeping only the moments derived values 
+    and the transforms of the wrapping series, applied in order.
+
+    >>> n = ModerationSeries(NumericSeries(), 2.8)
+    >>> for v in (1.0, 1.5, 2.0, 2.5, 'x'): n.good(v)
+    >>> for v in (8.0, 10.0, 9.0): n.bad(v)
+    >>> compiled = n.compile()
+    >>> [compiled.score(v) == n.score(v) for v in (1.2, 4.0, 9.5, 'x', None)]
+    [True, True, True, True, True]
+    """
+    def __init__(self, good_parameters, bad_parameters, transforms=()):
+        self.good_parameters = good_parameters
+        self.bad_parameters = bad_parameters
+        self.transforms = tuple(transforms)
+        self.non_numeric_probability = self._transform(0.5)
+
+    def _transform(self, prob):
+        for transform, parameter in self.transforms:
+            prob = transform(prob, parameter)
+        return prob
+
+    def transformed(self, transform, parameter):
+        return CompiledNumericSeries(self.good_parameters, self.bad_parameters, 
+                                     self.transforms + ((transform, parameter),))
+
+    def bounds(self):
+        """(lowest, highest) probability score can return, from the range of
+        each side's score: the transforms never reverse the order of two 
+        probabilities
+
+        >>> n = BiasedSeries(NumericSeries(), 1.5)
+        >>> for v in (1.0, 1.5, 2.0, 2.5): n.good(v)
+        >>> for v in (8.0, 10.0, 9.0): n.bad(v)
+        >>> compiled = n.compile()
+        >>> low, high = compiled.bounds()
+        >>> all(low <= compiled.score(v) <= high for v in (-50.0, 0.5, 1.7, 5.4, 9.0, 1e9, 'x'))
+        True
+        """
+        good_low, good_high = _numeric_side_bounds(self.good_parameters)
+        bad_low, bad_high = _numeric_side_bounds(self.bad_parameters)
+        low = good_low / (good_low + bad_high) if good_low else 0.0
+        high = good_high / (good_high + bad_low) if good_high else 0.0
+        return (min(self._transform(low), self.non_numeric_probability),
+                max(self._transform(high), self.non_numeric_probability))
+
+    def score(self, value):
+        value = as_number(value)
+        if value == None: 
+            return self.non_numeric_probability
+
+        good_prob = numeric_side_score(value, self.good_parameters)
+        bad_prob = numeric_side_score(value, self.bad_parameters)
+
+        return self._transform(good_prob / (good_prob + bad_prob))
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
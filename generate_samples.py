@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os
 import xlwt
 import random
 
@@ -10,9 +11,20 @@ date_style.num_format_str = excel_date_fmt
 def identifier():
     return 'ID' + str(random.random())[-5:]
 
-def value(start, end, integer=False):
-    initial = random.random()
-    has_value = random.choice([True] * 9 + [False])
+# How the numbers between start and end are spread
+DISTRIBUTIONS = ('uniform', 'normal', 'skewed')
+
+def _draw(distribution):
+    """A number between 0 and 1"""
+    if distribution == 'normal':
+        return min(max(random.gauss(0.5, 0.15), 0.0), 1.0)
+    if distribution == 'skewed':
+        return min(random.expovariate(5.0), 1.0)
+    return random.random()
+
+def value(start, end, integer=False, blank_ratio=0.1, distribution='uniform'):
+    initial = _draw(distribution)
+    has_value = random.random() >= blank_ratio
     
     if has_value:
         size = end - start
@@ -21,38 +33,66 @@ def value(start, end, integer=False):
     else:
         return ''
 
-def write_doc(name, random_swap=False):
+def _columns(cols, blank_ratio, distribution):
+    """(name, value function) of every column, the five columns of the 
+    samples repeated as many times as needed"""
+    number = lambda start, end, integer=False: value(start, end, integer, blank_ratio, distribution)
+    kinds = [('CODE', lambda: (identifier(), None)),
+             ('Date', lambda: (number(40500, 41000, integer=True), date_style)),
+             ('Wat', lambda: (number(1, 16), None)),
+             ('Price', lambda: (number(10, 16), None)),
+             ('Other', lambda: (number(20, 4000), None))]
+    columns = {}
+    for k in range(cols):
+        name, fun = kinds[k % len(kinds)]
+        columns[k] = (name if k < len(kinds) else '%s %d' % (name, k // len(kinds)), fun)
+    return columns
+
+def write_doc(name, random_swap=False, rows=10, cols=5, sheets=1, blank_ratio=0.1, distribution='uniform'):
+    """Writes a workbook with sheets sheets of rows rows (the first one 
+    being the column names) and cols columns. random_swap swaps two 
+    columns of every sheet, as in the bad samples"""
     wbk = xlwt.Workbook()
-    sheet = wbk.add_sheet('sheet 1')
-
-    cols = {0: ('CODE', lambda: (identifier(), None)),
-            1: ('Date', lambda: (value(40500, 41000, integer=True), date_style)),
-            2: ('Wat', lambda: (value(1, 16), None)),
-            3: ('Price', lambda: (value(10, 16), None)),
-            4: ('Other', lambda: (value(20, 4000), None))}
-
-    if random_swap:
-        keys = cols.keys()
-        swap1 = random.choice(keys)
-        keys.remove(swap1)
-        swap2 = random.choice(keys)
-        cols[swap1], cols[swap2] = cols[swap2], cols[swap1]
-
-    for k in cols:
-        col_name, _ = cols[k]
-        sheet.write(0, k, col_name)
-
-    for i in range(1, 10):
-        for k in cols:
-            _, fun = cols[k]
-            val, fmt = fun()
-            if fmt:
-                sheet.write(i, k, val, fmt)
-            else:
-                sheet.write(i, k, val)
+
+    for sheet_ndx in range(sheets):
+        sheet = wbk.add_sheet('sheet %d' % (sheet_ndx + 1))
+        cols_of_sheet = _columns(cols, blank_ratio, distribution)
+
+        if random_swap:
+            keys = cols_of_sheet.keys()
+            swap1 = random.choice(keys)
+            keys.remove(swap1)
+            swap2 = random.choice(keys)
+            cols_of_sheet[swap1], cols_of_sheet[swap2] = cols_of_sheet[swap2], cols_of_sheet[swap1]
+
+        for k in cols_of_sheet:
+            col_name, _ = cols_of_sheet[k]
+            sheet.write(0, k, col_name)
+
+        for i in range(1, rows):
+            for k in cols_of_sheet:
+                _, fun = cols_of_sheet[k]
+                val, fmt = fun()
+                if fmt:
+                    sheet.write(i, k, val, fmt)
+                else:
+                    sheet.write(i, k, val)
 
     wbk.save(name)
 
+def write_corpus(directory, good, bad, verify, **layout):
+    """Writes good and bad (column swapped) training workbooks and verify
+    of each for verification under directory, with the write_doc layout.
+    Returns the paths as {'good': [...], 'bad': [...], 'verify_good': [...],
+    'verify_bad': [...]}"""
+    corpus = {}
+    for kind, count, random_swap in (('good', good, False), ('bad', bad, True),
+                                     ('verify_good', verify, False), ('verify_bad', verify, True)):
+        corpus[kind] = [os.path.join(directory, '%s%d.xls' % (kind, i)) for i in range(count)]
+        for name in corpus[kind]:
+            write_doc(name, random_swap, **layout)
+    return corpus
+
 if __name__ == '__main__':
     for i in range(0, 1000):
         name = 'random_generated/training/training' + str(i) + '.xls'
@@ -0,0 +1,184 @@
+"""On-disk cache of the cells read from workbooks, so training and
+verifying the same files again doesn't parse them again.
+
+Entries are keyed by the SHA-1 of the file's contents plus the sheet and
+region read from it, and hold the (types, values) rows of the region as
+a compressed pickle, types packed one byte per cell. Each entry is a
+file in the cache directory, written atomically so processes can share
+the cache. Reading an entry touches its modification time, and the
+least recently used entries are removed once the directory grows past
+its size limit."""
+
+import os
+import zlib
+import hashlib
+import cPickle
+from array import array
+from spreadsheet import *
+from storage import atomic_write
+from training_log import file_hash, contents_hash
+
+# Part of every key, changing it invalidates what is cached
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 256 << 20
+ENTRY_EXTENSION = '.grid'
+
+class CachedSheet(object):
+    """The region of a sheet that was cached, rows are only available for
+    the rows and columns of that region"""
+    def __init__(self, name, first_row, first_col, rows):
+        self.name = name
+        self.first_row = first_row
+        self.first_col = first_col
+        self._rows = rows
+
+    def rows(self, start_row, end_row, start_col=0, end_col=None):
+        if start_col < self.first_col:
+            raise ValueError('Columns before %d are not cached' % (self.first_col))
+        first = start_col - self.first_col
+        end = None if end_col is None else end_col - self.first_col + 1
+        for ndx in range(max(start_row, self.first_row), min(end_row + 1, self.first_row + len(self._rows))):
+            types, values = self._rows[ndx - self.first_row]
+            yield (types[first:end], values[first:end])
+
+class CachedWorkbook(object):
+    """Stands in for a workbook, with the one sheet the region is read
+    from. bytes_parsed and rows_parsed are what was parsed to fill the
+    cache, nothing when the rows came from it"""
+    def __init__(self, sheet, bytes_parsed=0, rows_parsed=0):
+        self.sheet = sheet
+        self.bytes_parsed = bytes_parsed
+        self.rows_parsed = rows_parsed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def sheet_names(self):
+        return [self.sheet.name]
+
+    def sheet_by_index(self, ndx):
+        return self.sheet
+
+    def sheet_by_name(self, name):
+        return self.sheet
+
+    def close(self):
+        pass
+
+class GridCache(object):
+    """
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'book.csv')
+    >>> with open(path, 'w') as f:
+    ...     f.write('a,1,x\\nb,2,y\\n')
+    >>> cache = GridCache(os.path.join(directory, 'cache'))
+    >>> geometry = (0, 1, 1, 2, 0)
+    >>> wb = cache.open_workbook(path, geometry)
+    >>> wb.rows_parsed, list(wb.sheet_by_index(0).rows(0, 1, 1, 2))
+    (2, [([2, 1], [1.0, u'x']), ([2, 1], [2.0, u'y'])])
+    >>> wb = cache.open_workbook(path, geometry)
+    >>> wb.rows_parsed, list(wb.sheet_by_index(0).rows(1, 1, 2, 2))
+    (0, [([1], [u'y'])])
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._size = None
+
+    def __getstate__(self):
+        # Worker processes measure the directory themselves
+        return {'directory': self.directory, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'], state['max_bytes'])
+
+    def _path(self, content_hash, geometry):
+        key = hashlib.sha1(repr((CACHE_VERSION, content_hash, tuple(geometry)))).hexdigest()
+        return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+    def open_workbook(self, path, geometry, contents=None):
+        """Workbook with the rows of path (whose bytes are contents, if
+        they have been read already) in the region of a training set with
+        the given geometry, from the cache or parsed and cached"""
+        start_row, end_row, start_col, end_col, sheet = geometry
+        entry = self._path(file_hash(path) if contents is None else contents_hash(contents), geometry)
+        rows = self._read(entry)
+        if rows is not None:
+            return CachedWorkbook(CachedSheet(sheet, start_row, start_col, rows))
+
+        with open_workbook(path, file_contents=contents) as wb:
+            xls_sheet = wb.sheet_by_index(sheet) if type(sheet) == int else wb.sheet_by_name(sheet)
+            rows = [(list(types), list(values)) for types, values
+                    in sheet_rows(xls_sheet, start_row, end_row, start_col, end_col)]
+        self._write(entry, rows)
+        return CachedWorkbook(CachedSheet(sheet, start_row, start_col, rows), wb.bytes_parsed, wb.rows_parsed)
+
+    def _read(self, entry):
+        try:
+            with open(entry, 'rb') as f:
+                packed = cPickle.loads(zlib.decompress(f.read()))
+        except IOError:
+            return None
+        except (zlib.error, cPickle.UnpicklingError, EOFError, ValueError):
+            self._remove(entry)
+            return None
+        try:
+            # Most recently used
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return [(array('B', types).tolist(), values) for types, values in packed]
+
+    def _write(self, entry, rows):
+        packed = [(array('B', types).tostring(), values) for types, values in rows]
+        data = zlib.compress(cPickle.dumps(packed, protocol=2))
+        with atomic_write(entry) as f:
+            f.write(data)
+        if self._size is None:
+            self._size = self._entries_size()
+        else:
+            self._size += len(data)
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_EXTENSION):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        return entries
+
+    def _entries_size(self):
+        return sum(size for mtime, size, entry in self._entries())
+
+    def _evict(self):
+        """Removes the least recently used entries, down to 90% of the
+        limit so the directory isn't scanned again on the next write"""
+        entries = sorted(self._entries())
+        self._size = sum(size for mtime, size, entry in entries)
+        for mtime, size, entry in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            self._remove(entry)
+            self._size -= size
+
+    def _remove(self, entry):
+        try:
+            os.remove(entry)
+        except OSError:
+            # Another process got there first
+            pass
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,141 @@
+"""Reads files ahead of the code processing them, so that on slow (network)
+storage the wait for the next file overlaps with parsing and scoring the
+current one.
+
+Reader threads fetch the bytes; parsing stays with the caller, which
+passes them to open_workbook(path, file_contents=...). At most
+queue_size files are read ahead of the one being processed: the thread
+handing out paths blocks until the caller catches up."""
+
+import sys
+import time
+import Queue
+import threading
+
+DEFAULT_QUEUE_SIZE = 16
+# Seconds readers are waited for when the caller stops early
+STOP_TIMEOUT = 1.0
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+class _Pending(object):
+    def __init__(self, item):
+        self.item = item
+        self.contents = None
+        self.done = threading.Event()
+
+_end = object()
+
+def prefetched(items, concurrency, queue_size=DEFAULT_QUEUE_SIZE, path=lambda item: item, read=_read_file):
+    """Yields (item, contents) for every item, in order, contents being the
+    bytes of the file at path(item) or None if it couldn't be read (opening
+    it again gives the error). With concurrency < 1 files are read when
+    their turn comes.
+
+    >>> import os, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> paths = [os.path.join(directory, str(n)) for n in range(20)]
+    >>> for n, p in enumerate(paths):
+    ...     with open(p, 'w') as f:
+    ...         f.write('x' * n)
+    >>> results = list(prefetched(paths + ['missing'], 4, queue_size=3))
+    >>> [p for p, contents in results] == paths + ['missing']
+    True
+    >>> [len(contents or '') for p, contents in results][-4:], results[-1][1]
+    ([17, 18, 19, 0], None)
+
+    Stopping early doesn't wait for items, which may never come:
+
+    >>> def stalled():
+    ...     yield paths[0]
+    ...     threading.Event().wait()
+    >>> reading = prefetched(stalled(), 2)
+    >>> len(next(reading)[1])
+    0
+    >>> reading.close()
+    """
+    if concurrency < 1:
+        for item in items:
+            yield (item, None)
+        return
+
+    ready = Queue.Queue(maxsize=max(queue_size, 1))
+    work = Queue.Queue()
+    stopped = threading.Event()
+    failures = []
+
+    def hand_over(pending):
+        # Blocks while queue_size files wait for the caller, unless it 
+        # stopped listening
+        while not stopped.is_set():
+            try:
+                ready.put(pending, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def hand_out():
+        try:
+            for item in items:
+                pending = _Pending(item)
+                if not hand_over(pending):
+                    break
+                work.put(pending)
+        except Exception:
+            # items failed, raised again for the caller
+            failures.append(sys.exc_info())
+        finally:
+            for n in range(concurrency):
+                work.put(_end)
+            hand_over(_end)
+
+    def fetch():
+        while True:
+            pending = work.get()
+            if pending is _end or stopped.is_set():
+                return
+            try:
+                pending.contents = read(path(pending.item))
+            except (IOError, OSError):
+                pending.contents = None
+            finally:
+                pending.done.set()
+
+    threads = [threading.Thread(target=hand_out)] + [threading.Thread(target=fetch) for n in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = False
+    try:
+        while True:
+            pending = ready.get()
+            if pending is _end:
+                finished = True
+                if failures:
+                    raise failures[0][0], failures[0][1], failures[0][2]
+                break
+            pending.done.wait()
+            yield (pending.item, pending.contents)
+    finally:
+        stopped.set()
+        if finished:
+            for thread in threads:
+                thread.join()
+        else:
+            # The caller stopped early: hand_out may be blocked on items
+            # (stdin) and is left to finish on its own. Readers skip the
+            # files left and are given a moment to finish the one they
+            # are reading, which may hang on unresponsive storage
+            for n in range(concurrency):
+                work.put(_end)
+            deadline = time.time() + STOP_TIMEOUT
+            for thread in threads[1:]:
+                thread.join(max(deadline - time.time(), 0))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
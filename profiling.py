@@ -0,0 +1,214 @@
+"""Where train and verify spend their time: wall and CPU time and call
+counts per stage (opening workbooks, reading cells, loading and saving
+sets) and per series type, plus the peak memory of the process.
+
+Disabled by default. Stages are marked with stage() and timed_iter(),
+which do nothing but check a global while disabled. The series and the
+combining are timed by wrapping their methods, and the wrappers are only
+installed by enable() and removed by disable(), so the hot path costs
+nothing unless profiling is on.
+
+Times are exclusive: a stage or series called from another one is
+subtracted from the caller, so every second is counted once. Only the
+calling process is profiled, with --jobs the work of the pool shows up
+as waiting for it."""
+
+import sys
+import json
+import time
+import resource
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+
+class StageStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+class Profile(object):
+    """Stats of every stage, see report
+
+    >>> profile = Profile()
+    >>> with profile.timing('outer'):
+    ...     with profile.timing('inner'):
+    ...         pass
+    ...     with profile.timing('inner'):
+    ...         pass
+    >>> [(name, stats.calls) for name, stats in profile.stages.items()]
+    [('inner', 2), ('outer', 1)]
+    >>> report = profile.report()
+    >>> sum(stage['wall'] for stage in report['stages']) <= report['wall']
+    True
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.started = (time.time(), time.clock())
+        self.stopped = None
+        # [child wall, child cpu] of the calls being timed, innermost last
+        self._stack = []
+
+    def _enter(self):
+        self._stack.append([0.0, 0.0])
+        return (time.time(), time.clock())
+
+    def _exit(self, name, started):
+        wall = time.time() - started[0]
+        cpu = time.clock() - started[1]
+        children = self._stack.pop()
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        stats.calls += 1
+        stats.wall += wall - children[0]
+        stats.cpu += cpu - children[1]
+        if self._stack:
+            self._stack[-1][0] += wall
+            self._stack[-1][1] += cpu
+
+    @contextmanager
+    def timing(self, name):
+        started = self._enter()
+        try:
+            yield
+        finally:
+            self._exit(name, started)
+
+    def stop(self):
+        self.stopped = (time.time(), time.clock())
+
+    def report(self):
+        """JSON-friendly dict: total wall and CPU seconds, peak resident
+        memory and the stages, slowest first"""
+        end = self.stopped or (time.time(), time.clock())
+        stages = sorted(self.stages.items(), key=lambda (name, stats): -stats.wall)
+        return OrderedDict([('wall', end[0] - self.started[0]), ('cpu', end[1] - self.started[1]),
+                            ('peak_rss_kb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+                            ('stages', [OrderedDict([('name', name), ('calls', stats.calls),
+                                                     ('wall', stats.wall), ('cpu', stats.cpu)])
+                                        for name, stats in stages])])
+
+    def table(self):
+        report = self.report()
+        lines = ['%-36s %10s %10s %7s %10s %10s' % ('stage', 'calls', 'wall (s)', 'wall %', 'cpu (s)', 'us/call')]
+        for stage in report['stages']:
+            lines.append('%-36s %10d %10.4f %6.1f%% %10.4f %10.2f' % (
+                stage['name'], stage['calls'], stage['wall'],
+                100.0 * stage['wall'] / report['wall'] if report['wall'] else 0.0,
+                stage['cpu'], stage['wall'] * 1e6 / stage['calls']))
+        timed = sum(stage['wall'] for stage in report['stages'])
+        lines.append('%-36s %10s %10.4f %6.1f%%' % ('(not in a stage)', '', report['wall'] - timed,
+                                                     100.0 * (report['wall'] - timed) / report['wall']
+                                                     if report['wall'] else 0.0))
+        lines.append('Total %.4fs wall, %.4fs CPU, peak memory %.1f MB' % (
+            report['wall'], report['cpu'], report['peak_rss_kb'] / 1024.0))
+        return '\n'.join(lines)
+
+_profile = None
+_installed = []
+
+def active():
+    """The Profile being recorded, None when profiling is disabled"""
+    return _profile
+
+@contextmanager
+def stage(name):
+    """Times the block as the stage name when profiling is enabled"""
+    if _profile is None:
+        yield
+        return
+    with _profile.timing(name):
+        yield
+
+def timed_iter(name, iterable):
+    """iterable, timing each step as the stage name when profiling is
+    enabled"""
+    if _profile is None:
+        return iterable
+    return _timed_iter(name, iter(iterable))
+
+def _timed_iter(name, iterator):
+    profile = _profile
+    while True:
+        started = profile._enter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            profile._exit(name, started)
+            return
+        except:
+            profile._exit(name, started)
+            raise
+        profile._exit(name, started)
+        yield item
+
+def _timed_method(name, method):
+    @wraps(method)
+    def timed(*args, **kwargs):
+        profile = _profile
+        started = profile._enter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            profile._exit(name, started)
+    return timed
+
+def _hot_paths():
+    """(class, method name, stage name) of every method timed while
+    profiling, the series under their own type"""
+    import filter_criteria
+    import statistics
+    methods = []
+    for cls in (filter_criteria.NominalSeries, filter_criteria.HasValueSeries, filter_criteria.NumericSeries,
+                filter_criteria.BiasedSeries, filter_criteria.LowConfidenceSeries,
+                filter_criteria.ModerationSeries):
+        methods.extend([(cls, 'score', 'score %s' % (cls.__name__)),
+                        (cls, 'good', 'train %s' % (cls.__name__)),
+                        (cls, 'bad', 'train %s' % (cls.__name__))])
+    for cls in (filter_criteria.CompiledNominalSeries, filter_criteria.CompiledNumericSeries):
+        methods.append((cls, 'score', 'score %s' % (cls.__name__)))
+    methods.extend([(filter_criteria.NumericMoments, 'parameters', 'NumericMoments.parameters'),
+                    (statistics.BayesAccumulator, 'extend', 'combine')])
+    return methods
+
+def enable():
+    """Starts recording a new Profile, returns it"""
+    global _profile
+    disable()
+    _profile = Profile()
+    for cls, method_name, name in _hot_paths():
+        # Only the class's own methods, inherited ones are timed with
+        # the class defining them
+        if method_name in cls.__dict__:
+            method = cls.__dict__[method_name]
+            _installed.append((cls, method_name, method))
+            setattr(cls, method_name, _timed_method(name, method))
+    return _profile
+
+def disable():
+    """Stops recording, returns the Profile recorded if there was one"""
+    global _profile
+    while _installed:
+        cls, method_name, method = _installed.pop()
+        setattr(cls, method_name, method)
+    profile = _profile
+    _profile = None
+    if profile is not None:
+        profile.stop()
+    return profile
+
+def write_report(profile, command, output=None):
+    """Prints the table of profile to stderr and writes the JSON report,
+    with the command, to output if given"""
+    print >> sys.stderr, '\nProfile of %s:\n%s' % (command, profile.table())
+    if output:
+        report = OrderedDict([('command', command), ('time', time.time())])
+        report.update(profile.report())
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""Registry of training sets, one per workbook template, telling which
+templates a workbook matches:
+
+    registry.py --set [name=]set_file [--set ...] [options] [workbooks|directories|globs|-]*
+
+Sets are loaded and compiled once, and indexed by a fingerprint: their
+sheet, region and the values nearly every good file had in the first row
+of the region. Each workbook is opened once, every sheet sets refer to is
+read once over the union of their regions, the sets whose header values
+don't match are left out and the rest are scored together in one pass
+over the rows. Writes one JSON record per workbook with the matching
+sets, most probable first."""
+
+import sys
+import time
+import json
+from collections import OrderedDict, defaultdict, namedtuple
+import xlrd
+from spreadsheet import open_workbook, sheet_rows, XlsType
+from statistics import BayesAccumulator
+from filter_criteria import innermost_series
+from set_io import open_training_set, expand_inputs, set_files
+from prefetch import prefetched
+
+# Share of the good files a first row cell must have had the same value
+# in for the value to be part of the fingerprint
+HEADER_SHARE = 0.9
+# Share of its header values a workbook must have for a set to be scored
+DEFAULT_MIN_HEADER_MATCH = 0.5
+
+Fingerprint = namedtuple('Fingerprint', ['sheet', 'row', 'start_col', 'end_col', 'header'])
+
+def fingerprint(tset):
+    """Fingerprint of a trained set, header being the (column, value) of
+    the cells of its first row that held the same value in nearly every
+    good file. Compiled sets keep no counts, their header is empty
+
+    >>> from classifier import TrainingSet
+    >>> from spreadsheet import CsvWorkbook
+    >>> tset = TrainingSet(0, 1, 0, 2, 0)
+    >>> for price in range(10):
+    ...     tset.good(CsvWorkbook(file_contents='Date,Price,\\n2020,%d,x\\n' % (price)))
+    >>> fingerprint(tset)
+    Fingerprint(sheet=0, row=0, start_col=0, end_col=2, header=((0, u'Date'), (1, u'Price')))
+    """
+    header = []
+    if tset.header_size:
+        for col in range(tset.start_col, tset.end_col + 1):
+            tcell = tset.training_cells[col - tset.start_col]
+            if not hasattr(tcell, 'value_classes'):
+                break
+            values = innermost_series(tcell.value_classes[0])
+            counts = [(count, value) for value, count in values.value_counts() if value is not None]
+            files = values.good_data.value_total + values.good_unknown_samples_count
+            if counts and files:
+                count, value = max(counts)
+                if count >= HEADER_SHARE * files:
+                    header.append((col, value))
+    return Fingerprint(tset.sheet, tset.start_row, tset.start_col, tset.end_col, tuple(header))
+
+def _sheet_index(sheet, sheet_names):
+    """Index of the sheet of a set in a workbook, None if it has none"""
+    if type(sheet) == int:
+        return sheet if sheet < len(sheet_names) else None
+    return sheet_names.index(sheet) if sheet in sheet_names else None
+
+class RegisteredSet(object):
+    def __init__(self, name, tset):
+        self.name = name
+        self.fingerprint = fingerprint(tset)
+        self.model = tset.compile()
+
+class _Candidate(object):
+    """A set being scored in the pass over the rows of a sheet"""
+    def __init__(self, registered):
+        self.name = registered.name
+        self.model = model = registered.model
+        self.cols = 1 + model.end_col - model.start_col
+        self.columns = model.training_cells[model.header_size:] if model.column_template else None
+        self.combined = BayesAccumulator()
+
+    def cells(self, row, past_end):
+        """Training cells of the row of the sheet, None for rows the set
+        doesn't score. Header rows past the end of the sheet are scored
+        as empty, like TrainingSet does"""
+        model = self.model
+        if row < model.start_row:
+            return None
+        if row <= model.end_row:
+            first = (row - model.start_row) * self.cols
+            return model.training_cells[first:first + self.cols]
+        return None if past_end else self.columns
+
+class TemplateRegistry(object):
+    """
+    >>> from classifier import TrainingSet
+    >>> from spreadsheet import CsvWorkbook
+    >>> invoices = TrainingSet(0, 0, 0, 1, 0, column_template=True)
+    >>> orders = TrainingSet(0, 0, 0, 1, 0, column_template=True)
+    >>> for n in range(5):
+    ...     invoices.good(CsvWorkbook(file_contents='Date,Price\\n2020,%d\\n2021,12\\n' % (n)))
+    ...     orders.good(CsvWorkbook(file_contents='Item,Count\\nbolt,%d\\nnut,3\\n' % (n)))
+    ...     invoices.bad(CsvWorkbook(file_contents='Item,Count\\nbolt,%d\\n' % (n)))
+    ...     orders.bad(CsvWorkbook(file_contents='Date,Price\\n2020,%d\\n' % (n)))
+    >>> registry = TemplateRegistry()
+    >>> registry.add('invoices', invoices)
+    >>> registry.add('orders', orders)
+    >>> wb = CsvWorkbook(file_contents='Date,Price\\n2022,7\\n2023,9\\n2024,8\\n')
+    >>> [(name, header) for name, prob, header in registry.match(wb)]
+    [('invoices', 1.0)]
+    >>> registry.min_header_match = 0
+    >>> [(name, header) for name, prob, header in registry.match(wb)]
+    [('invoices', 1.0), ('orders', 0.0)]
+    >>> [abs(prob - tset.score(wb)) < 1e-12 for (name, prob, header), tset in zip(registry.match(wb), [invoices, orders])]
+    [True, True]
+    """
+    def __init__(self, min_header_match=DEFAULT_MIN_HEADER_MATCH):
+        self.min_header_match = min_header_match
+        self.sets = OrderedDict()
+        # Names of the sets by their sheet, and by (sheet, row, column,
+        # value) of their header values
+        self._by_sheet = defaultdict(list)
+        self._by_header = defaultdict(list)
+        self._header_cells = defaultdict(set)
+
+    def load(self, set_files):
+        """Loads {name: set file}, replaying their training logs"""
+        for name, set_file in set_files.items():
+            self.add(name, open_training_set(set_file))
+
+    def add(self, name, tset):
+        if name in self.sets:
+            raise ValueError('There is a set named %s already' % (name))
+        registered = self.sets[name] = RegisteredSet(name, tset)
+        sheet, row = registered.fingerprint.sheet, registered.fingerprint.row
+        self._by_sheet[sheet].append(name)
+        for col, value in registered.fingerprint.header:
+            self._by_header[(sheet, row, col, value)].append(name)
+            self._header_cells[sheet].add((row, col))
+
+    def match(self, xls_doc):
+        """Ranked [(name, probability, header match)] of the sets
+        shortlisted for the workbook, most probable first. The header
+        match is the share of the set's header values the workbook has,
+        None for sets without any"""
+        sheet_names = xls_doc.sheet_names()
+        by_index = defaultdict(list)
+        for sheet, names in self._by_sheet.items():
+            ndx = _sheet_index(sheet, sheet_names)
+            if ndx is not None:
+                by_index[ndx].append(sheet)
+        ranked = []
+        for ndx, sheets in sorted(by_index.items()):
+            ranked.extend(self._match_sheet(xls_doc.sheet_by_index(ndx), sheets))
+        ranked.sort(key=lambda (name, prob, header): (-prob, -(header or 0), name))
+        return ranked
+
+    def _match_sheet(self, sheet, sheets):
+        """Matches the sets of sheets (their sheet names or indexes), all
+        being sheet of the workbook"""
+        registered = [self.sets[name] for spec in sheets for name in self._by_sheet[spec]]
+        first_row = min(r.model.start_row for r in registered)
+        last_row = max(r.model.region[1] for r in registered)
+        first_col = min(r.model.start_col for r in registered)
+        last_col = max(r.model.end_col for r in registered)
+        rows = list(sheet_rows(sheet, first_row, last_row, first_col, last_col))
+
+        matched = defaultdict(int)
+        for spec in sheets:
+            for row, col in self._header_cells[spec]:
+                if 0 <= row - first_row < len(rows) and col - first_col < len(rows[row - first_row][1]):
+                    value = rows[row - first_row][1][col - first_col]
+                    for name in self._by_header.get((spec, row, col, value), ()):
+                        matched[name] += 1
+
+        candidates = []
+        shares = {}
+        for r in registered:
+            header = r.fingerprint.header
+            shares[r.name] = float(matched[r.name]) / len(header) if header else None
+            if (shares[r.name] is None or shares[r.name] >= self.min_header_match) and \
+               r.model.start_row - first_row < len(rows):
+                candidates.append(_Candidate(r))
+        if not candidates:
+            return []
+
+        # One pass over the rows, each scored by every set it is part of
+        last = max([first_row + len(rows) - 1] + [c.model.end_row for c in candidates])
+        for ndx in xrange(first_row, last + 1):
+            past_end = ndx - first_row >= len(rows)
+            types, values = ((), ()) if past_end else rows[ndx - first_row]
+            for candidate in candidates:
+                tcells = candidate.cells(ndx, past_end)
+                if not tcells:
+                    continue
+                combined = candidate.combined
+                col = candidate.model.start_col - first_col
+                for tcell in tcells:
+                    if col < len(types):
+                        combined.extend(tcell.score(types[col], values[col]))
+                    else:
+                        combined.extend(tcell.score(XlsType.xls_empty, None))
+                    col += 1
+
+        return [(c.name, c.combined.probability, shares[c.name]) for c in candidates]
+
+_record_fields = ('path', 'best', 'probability', 'matches', 'seconds', 'bytes_parsed', 'rows_parsed', 'error')
+
+def match_file(registry, f, contents=None, top=None):
+    """Record of the sets f (or contents, its bytes) matches, the fields
+    being _record_fields and error None unless it couldn't be read or
+    matched"""
+    start = time.time()
+    try:
+        with open_workbook(f, file_contents=contents) as wb:
+            ranked = registry.match(wb)
+        matches = [OrderedDict([('set', name), ('probability', prob), ('header_match', header)])
+                   for name, prob, header in ranked[:top]]
+        best = ranked[0] if ranked else (None, None)
+        return (f, best[0], best[1], matches, time.time() - start, wb.bytes_parsed, wb.rows_parsed, None)
+    except (IOError, OSError, xlrd.XLRDError), e:
+        return (f, None, None, [], time.time() - start, 0, 0, str(e))
+    except Exception, e:
+        return (f, None, None, [], time.time() - start, 0, 0, '%s: %s' % (type(e).__name__, e))
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog --set [name=]set_file [--set ...] [options] [workbooks|directories|globs|-]*')
+    parser.add_option('--set', '-s', action='append', dest='sets', default=[],
+                      help='A training set to match with, named after its file unless given as name=file. Can be repeated')
+    parser.add_option('--min-header-match', action='store', dest='min_header_match', type='float',
+                      default=DEFAULT_MIN_HEADER_MATCH, help='Share of the header values of a set a workbook must ' +
+                      'have for the set to be scored, %s by default. 0 scores every set of the sheets ' %
+                      (DEFAULT_MIN_HEADER_MATCH) + 'the workbook has')
+    parser.add_option('--top', action='store', dest='top', type='int', default=None,
+                      help='Only list the N best matching sets of every workbook')
+    parser.add_option('--output', '-o', action='store', dest='output', default=None,
+                      help='File to write the results to, stdout by default')
+    parser.add_option('--prefetch', action='store', dest='prefetch', type='int', default=0,
+                      help='Number of threads reading files ahead, see classifier.py --prefetch')
+
+    (options, args) = parser.parse_args()
+    if not options.sets:
+        parser.print_help()
+        exit(1)
+
+    registry = TemplateRegistry(options.min_header_match)
+    registry.load(set_files(options.sets))
+
+    out = open(options.output, 'w') if options.output else sys.stdout
+    failed = 0
+    try:
+        for f, contents in prefetched(expand_inputs(args or ['-']), options.prefetch):
+            record = match_file(registry, f, contents, options.top)
+            failed += record[-1] is not None
+            out.write(json.dumps(OrderedDict(zip(_record_fields, record))) + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    exit(0 if failed == 0 else 1)
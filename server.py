@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""Resident scoring server: keeps compiled training sets in memory and
+scores workbooks sent over localhost HTTP or a Unix socket, so callers
+don't pay for starting Python and loading the set on every file.
+
+    server.py [--port 8642 | --socket path] [-j N] [name=]set_file ...
+
+    POST /score/<name>[?rows=a:b&filename=x.csv]  workbook bytes in the body
+    GET  /score/<name>?path=/path/to/workbook     workbook read by the server
+    GET  /sets                                    loaded sets
+    GET  /stats                                   request latency counters
+
+Responses are JSON with the fields of --verify-batch records. Sets are
+reloaded when their file or training log changes on disk: the new
+version is loaded on the side and swapped in, requests already running
+finish with the old one."""
+
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+import multiprocessing
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+import xlrd
+from spreadsheet import open_workbook
+import training_log
+from set_io import open_training_set, scoring_model, parse_rows, set_files
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, float('inf'))
+
+class LatencyCounters(object):
+    """Request count, errors and a latency histogram, percentiles are the
+    upper bound of the bucket they fall in
+
+    >>> counters = LatencyCounters()
+    >>> for seconds in [0.0015] * 98 + [0.3, 3]:
+    ...     counters.add(seconds)
+    >>> stats = counters.stats()
+    >>> stats['count'], stats['p50'], stats['p99'], stats['max']
+    (100, 0.002, 0.5, 3)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, seconds, error=False):
+        with self.lock:
+            self.count += 1
+            self.errors += 1 if error else 0
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            for ndx, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[ndx] += 1
+                    break
+
+    def _percentile(self, fraction):
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= fraction * self.count:
+                return bound if bound != float('inf') else self.max
+        return None
+
+    def stats(self):
+        with self.lock:
+            return OrderedDict([('count', self.count), ('errors', self.errors),
+                                ('mean', self.total / self.count if self.count else None),
+                                ('p50', self._percentile(0.5) if self.count else None),
+                                ('p90', self._percentile(0.9) if self.count else None),
+                                ('p99', self._percentile(0.99) if self.count else None),
+                                ('max', self.max),
+                                ('buckets', OrderedDict((str(bound), count) for bound, count
+                                                        in zip(LATENCY_BUCKETS, self.buckets)))])
+
+def _score(model, path, contents, rows):
+    """A --verify-batch record for the workbook at path, or in contents.
+    Failures of any kind are an error record, so they are counted like
+    unreadable workbooks, and the unexpected ones are logged
+
+    >>> class Broken(object):
+    ...     def score(self, xls_doc, start_row=None, end_row=None):
+    ...         return 1 / 0
+    >>> _score(Broken(), 'x.csv', 'a,b\\n', (None, None))[-1]
+    'ZeroDivisionError: integer division or modulo by zero'
+    """
+    start = time.time()
+    try:
+        with open_workbook(path, file_contents=contents) as wb:
+            prob = model.score(wb, start_row=rows[0], end_row=rows[1])
+        return (path, prob, time.time() - start, wb.bytes_parsed, wb.rows_parsed, None)
+    except (IOError, OSError, xlrd.XLRDError), e:
+        return (path, None, time.time() - start, 0, 0, str(e))
+    except Exception, e:
+        print >> sys.stderr, 'Failed to score %s:' % (path or 'a posted workbook')
+        traceback.print_exc()
+        return (path, None, time.time() - start, 0, 0, '%s: %s' % (type(e).__name__, e))
+
+_worker_models = {}
+
+def _init_worker(models):
+    global _worker_models
+    _worker_models = models
+
+def _score_in_worker(name, path, contents, rows):
+    return _score(_worker_models[name], path, contents, rows)
+
+def _signature(set_file):
+    """Changes whenever the set is saved or trained"""
+    signature = []
+    for path in (set_file, training_log.log_path(set_file)):
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_ino, stat.st_mtime, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+class LoadedSet(object):
+    def __init__(self, set_file, use_numpy):
+        self.set_file = set_file
+        self.signature = _signature(set_file)
+        tset = open_training_set(set_file)
+        self.geometry = tset.geometry
+        self.generation = tset.generation
+        self.model = scoring_model(tset.compile(), use_numpy)
+        self.loaded_at = time.time()
+
+class Scorer(object):
+    """The loaded sets, the pool of processes scoring with them and the
+    latency counters. With jobs <= 1 requests are scored in the threads
+    serving them"""
+
+    def __init__(self, set_files, jobs=1, use_numpy=False):
+        self.set_files = set_files
+        self.jobs = jobs
+        self.use_numpy = use_numpy
+        self.lock = threading.Lock()
+        self.sets = dict((name, LoadedSet(set_file, use_numpy)) for name, set_file in set_files.items())
+        self.counters = dict((name, LatencyCounters()) for name in set_files)
+        self.reloads = dict((name, 0) for name in set_files)
+        self.pool = None
+        self._start_pool()
+
+    def _start_pool(self):
+        old_pool = self.pool
+        self.pool = None
+        if self.jobs > 1:
+            models = dict((name, loaded.model) for name, loaded in self.sets.items())
+            self.pool = multiprocessing.Pool(self.jobs, _init_worker, (models,))
+        if old_pool is not None:
+            # Lets the queued requests finish with the old sets
+            old_pool.close()
+            threading.Thread(target=old_pool.join).start()
+
+    def score(self, name, path=None, contents=None, rows=(None, None)):
+        if name not in self.sets:
+            raise KeyError(name)
+        start = time.time()
+        with self.lock:
+            pool = self.pool
+            model = self.sets[name].model
+            if pool is not None:
+                result = pool.apply_async(_score_in_worker, (name, path, contents, rows))
+        record = _score(model, path, contents, rows) if pool is None else result.get()
+        self.counters[name].add(time.time() - start, error=record[-1] is not None)
+        return record
+
+    def reload_changed(self):
+        """Reloads the sets whose files changed, returns their names"""
+        reloaded = []
+        for name, set_file in self.set_files.items():
+            if _signature(set_file) == self.sets[name].signature:
+                continue
+            try:
+                loaded = LoadedSet(set_file, self.use_numpy)
+            except Exception, e:
+                print >> sys.stderr, 'Keeping the loaded version of %s: %s' % (set_file, e)
+                continue
+            with self.lock:
+                self.sets[name] = loaded
+                self.reloads[name] += 1
+                self._start_pool()
+            reloaded.append(name)
+        return reloaded
+
+    def watch(self, interval):
+        def poll():
+            while True:
+                time.sleep(interval)
+                for name in self.reload_changed():
+                    print >> sys.stderr, 'Reloaded %s' % (name)
+        thread = threading.Thread(target=poll)
+        thread.daemon = True
+        thread.start()
+
+    def describe(self):
+        return OrderedDict((name, OrderedDict([('file', loaded.set_file), ('geometry', loaded.geometry),
+                                               ('generation', loaded.generation),
+                                               ('loaded_at', loaded.loaded_at),
+                                               ('reloads', self.reloads[name])]))
+                           for name, loaded in sorted(self.sets.items()))
+
+    def stats(self):
+        return OrderedDict((name, counters.stats()) for name, counters in sorted(self.counters.items()))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+_record_fields = ('path', 'probability', 'seconds', 'bytes_parsed', 'rows_parsed', 'error')
+
+class ScoringHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, code, body):
+        data = json.dumps(body) + '\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, contents=None):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+        scorer = self.server.scorer
+
+        if parts == ['sets']:
+            return self._reply(200, scorer.describe())
+        if parts == ['stats']:
+            return self._reply(200, scorer.stats())
+        if len(parts) != 2 or parts[0] != 'score':
+            return self._reply(404, {'error': 'Unknown path %s' % (url.path)})
+
+        name = parts[1]
+        path = query.get('path') if contents is None else query.get('filename')
+        if contents is None and not path:
+            return self._reply(400, {'error': 'Send the workbook in a POST body or its path in ?path='})
+        try:
+            rows = parse_rows(query.get('rows'))
+        except ValueError, e:
+            return self._reply(400, {'error': str(e)})
+        try:
+            record = scorer.score(name, path, contents, rows)
+        except KeyError:
+            return self._reply(404, {'error': 'No set named %s' % (name)})
+        body = OrderedDict(zip(_record_fields, record))
+        body['set'] = name
+        self._reply(200 if record[-1] is None else 422, body)
+
+    def do_GET(self):
+        self._route()
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self._route(self.rfile.read(length))
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class HTTPScoringServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class UnixScoringServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] [name=]trainingset_file ...')
+    parser.add_option('--port', '-p', action='store', dest='port', type='int', default=8642,
+                      help='Port to listen to on localhost, 8642 by default')
+    parser.add_option('--socket', action='store', dest='socket', default=None,
+                      help='Unix socket to listen to instead of a port')
+    parser.add_option('--jobs', '-j', action='store', dest='jobs', type='int', default=1,
+                      help='Processes scoring requests, 1 scores in the threads serving them')
+    parser.add_option('--numpy', dest='use_numpy', action='store_const', const=True, default=False,
+                      help='Score with NumPy, see classifier.py --numpy')
+    parser.add_option('--poll', action='store', dest='poll', type='float', default=2.0,
+                      help='Seconds between checks for changed sets, 2 by default')
+    parser.add_option('--verbose', '-v', dest='verbose', action='store_const', const=True, default=False,
+                      help='Log every request')
+
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.print_help()
+        exit(1)
+
+    scorer = Scorer(set_files(args), jobs=options.jobs, use_numpy=options.use_numpy)
+    if options.socket:
+        if os.path.exists(options.socket):
+            os.remove(options.socket)
+        server = UnixScoringServer(options.socket, ScoringHandler)
+        where = options.socket
+    else:
+        server = HTTPScoringServer(('127.0.0.1', options.port), ScoringHandler)
+        where = 'http://127.0.0.1:%d' % (options.port)
+    server.scorer = scorer
+    server.verbose = options.verbose
+    scorer.watch(options.poll)
+
+    print >> sys.stderr, 'Scoring with %s on %s' % (', '.join(scorer.set_files), where)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scorer.close()
+        if options.socket and os.path.exists(options.socket):
+            os.remove(options.socket)
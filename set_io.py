@@ -0,0 +1,217 @@
+"""Loading and saving training sets, and finding and opening the
+workbooks they read, shared by classifier.py and the scripts built on it
+(server.py, registry.py, sweep.py, the benchmarks).
+
+Sets named *.bset are saved in the binary format of storage.py, anything
+else is pickled after a small pickled header with the geometry and
+generation of the set, so set_shape needn't unpickle the set. Loading a set replays the workbooks in its training log
+(see training_log.py), saving it folds them in and removes the log."""
+
+import os
+import sys
+import glob
+import cPickle
+from collections import OrderedDict
+from spreadsheet import open_workbook, WORKBOOK_EXTENSIONS
+import storage
+import training_log
+import profiling
+from grid_cache import GridCache
+
+def _find_global(module_name, name):
+    # Sets pickled by the command line refer to __main__.TrainingSet,
+    # which is the classifier module whoever loads them
+    if module_name == '__main__':
+        module_name = 'classifier'
+    __import__(module_name)
+    return getattr(sys.modules[module_name], name)
+
+def load_training_set(set_name):
+    """The set saved as set_name, without its training log"""
+    from classifier import TrainingSet, CompactTrainingSet
+    with profiling.stage('load set'):
+        if storage.is_binary_set(set_name):
+            with open(set_name, 'rb') as f:
+                layout = storage.read_header(f)[0].get('layout')
+                f.seek(0)
+                tset = storage.load_binary(f, TrainingSet)
+            return CompactTrainingSet.from_set(tset) if layout == CompactTrainingSet.layout else tset
+
+        with open(set_name, 'rb') as f:
+            unpickler = _unpickler(f)
+            tset = unpickler.load()
+            if type(tset) is dict:
+                # The header
+                tset = unpickler.load()
+            return tset
+
+def _unpickler(f):
+    unpickler = cPickle.Unpickler(f)
+    unpickler.find_global = _find_global
+    return unpickler
+
+def replay_log(tset, set_name, log=None):
+    """Trains tset with the workbooks in the training log of set_name,
+    returns how many there were. log is the log when the caller holds its
+    lock (see training_log.lock_log)"""
+    with profiling.stage('replay training log'):
+        logged = training_log.read_log(set_name, tset.generation, log)
+        for file_hash, label, inputs in logged:
+            tset.train_inputs(inputs, bad_set=(label == 'bad'))
+    return len(logged)
+
+def set_shape(set_name):
+    """Untrained set with the geometry and generation of the set saved as
+    set_name, enough to read workbooks the way the set does. Only the
+    header of the set is read, and training logs aren't replayed"""
+    from classifier import TrainingSet
+    with open(set_name, 'rb') as f:
+        if storage.is_binary_set(set_name):
+            header = storage.read_header(f)[0]
+        else:
+            header = _unpickler(f).load()
+            if type(header) is not dict:
+                # Pickled before sets had a header
+                header = {'geometry': header.geometry, 'generation': header.generation}
+    shape = TrainingSet(*header['geometry'])
+    shape.generation = header.get('generation')
+    return shape
+
+def open_training_set(set_name):
+    """Loads the set and replays the workbooks in its training log,
+    which is locked so the set isn't saved in between"""
+    with training_log.lock_log(set_name, exclusive=False) as log:
+        tset = load_training_set(set_name)
+        replay_log(tset, set_name, log)
+    return tset
+
+def save_error(tset, set_name):
+    """Message for why tset can't be saved as set_name, None if it can"""
+    from classifier import CompiledTrainingSet
+    if not set_name.endswith(storage.BINARY_EXTENSION):
+        return None
+    if tset.sketch_size:
+        return 'Sets with sketched histograms (--sketch-values) can only be pickled, not saved as %s' % (
+            set_name)
+    if isinstance(tset, CompiledTrainingSet):
+        return 'Compiled sets can only be pickled, not saved as %s' % (set_name)
+    return None
+
+def save_training_set(tset, set_name, log=None):
+    """Sets named *.bset are saved in the binary format, anything else
+    is pickled. The file is replaced atomically, under a new generation
+    which makes the set's training log stale, and the log is removed. log
+    is the log when the caller holds its lock, for as long as it read the
+    set and its log, otherwise the log is only locked while saving"""
+    error = save_error(tset, set_name)
+    if error:
+        raise ValueError(error)
+    if log is None:
+        with training_log.lock_log(set_name) as log:
+            return save_training_set(tset, set_name, log)
+    tset.generation = training_log.new_generation()
+    with profiling.stage('save set'):
+        with storage.atomic_write(set_name) as f:
+            if set_name.endswith(storage.BINARY_EXTENSION):
+                storage.save_binary(tset, f)
+            else:
+                cPickle.dump({'geometry': list(tset.geometry), 'generation': tset.generation}, f, protocol=1)
+                cPickle.dump(tset, f, protocol=1)
+        training_log.remove_log(set_name)
+
+def scoring_model(tset, use_numpy):
+    """tset, or a VectorisedTrainingSet if numpy was requested and works"""
+    from classifier import VectorisedTrainingSet
+    if not use_numpy:
+        return tset
+    try:
+        return VectorisedTrainingSet(tset)
+    except ImportError:
+        print >> sys.stderr, 'NumPy is not available, scoring without it'
+        return tset
+
+def set_files(specs):
+    """{name: file} from name=file or file arguments, named after the file
+
+    >>> set_files(['sets/invoices.bset', 'orders=sets/o2.set'])
+    OrderedDict([('invoices', 'sets/invoices.bset'), ('orders', 'sets/o2.set')])
+    """
+    files = OrderedDict()
+    for spec in specs:
+        name, sep, set_file = spec.partition('=')
+        if not sep:
+            set_file = spec
+            name = os.path.splitext(os.path.basename(spec))[0]
+        files[name] = set_file
+    return files
+
+def grid_cache(options):
+    """GridCache the options ask for, or None"""
+    if not options['cache']:
+        return None
+    return GridCache(options['cache'], options['cache_size'] << 20)
+
+def open_workbook_for(f, tset, cache=None, contents=None):
+    """Workbook f, whose bytes are contents if they were prefetched,
+    through the grid cache when there is one"""
+    with profiling.stage('open workbook'):
+        if cache is None:
+            return open_workbook(f, file_contents=contents)
+        return cache.open_workbook(f, tset.region, contents)
+
+def expand_inputs(entries):
+    """Yields workbook paths for each entry, which can be a file, a
+    directory (searched recursively for workbooks), a glob pattern
+    or - to read one path per line from stdin"""
+    for entry in entries:
+        if entry == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        elif os.path.isdir(entry):
+            for root, dirs, files in os.walk(entry):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(WORKBOOK_EXTENSIONS):
+                        yield os.path.join(root, name)
+        elif os.path.exists(entry):
+            yield entry
+        else:
+            matches = sorted(glob.glob(entry))
+            if not matches:
+                print >> sys.stderr, 'No workbooks found for %s' % (entry)
+            for path in matches:
+                yield path
+
+def parse_rows(rows):
+    """'first:last' to (first, last), either can be left out
+
+    >>> parse_rows('2:'), parse_rows(None)
+    ((2, None), (None, None))
+    >>> parse_rows('x')
+    Traceback (most recent call last):
+    ValueError: Expected first:last rows, not x
+    >>> parse_rows('5:2')
+    Traceback (most recent call last):
+    ValueError: The first row, 5, is after the last, 2
+    >>> parse_rows(':3'), parse_rows('4:4')
+    ((None, 3), (4, 4))
+    """
+    if not rows:
+        return (None, None)
+    first, sep, last = rows.partition(':')
+    try:
+        if not sep:
+            raise ValueError()
+        first, last = (int(first) if first else None, int(last) if last else None)
+    except ValueError:
+        raise ValueError('Expected first:last rows, not %s' % (rows))
+    if any(row is not None and row < 0 for row in (first, last)):
+        raise ValueError('Rows start at 0, not %s' % (rows))
+    if first is not None and last is not None and first > last:
+        raise ValueError('The first row, %d, is after the last, %d' % (first, last))
+    return (first, last)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,13 +1,464 @@
+import os
+import re
+import csv
+import datetime
+import zipfile
+import zlib
+import posixpath
 import xlrd
+from cStringIO import StringIO
 from itertools import izip
+from xml.etree import cElementTree
 
 class XlsType(object):
     xls_date = 3
     xls_string = 1
     xls_float = 2
     xls_empty = 0
+    xls_boolean = 4
+    xls_error = 5
 
-def cell_stream_from_sheet(sheet, end_row, end_col, start_row=0, start_col=0, 
+WORKBOOK_EXTENSIONS = ('.xls', '.xlsx', '.csv')
+
+class WorkbookError(xlrd.XLRDError):
+    """A workbook that none of the readers can make sense of"""
+
+def open_workbook(path=None, file_contents=None):
+    """Opens path (or the bytes in file_contents) with the reader for its
+    format: xls, xlsx or CSV. Every reader returns a workbook to be used
+    as a context manager, with sheet_by_index/sheet_by_name returning
+    sheets whose rows() yield xlrd style (types, values) lists of a range
+    of rows and columns, and the bytes_parsed/rows_parsed counters."""
+    if file_contents is not None:
+        peek = file_contents[:8]
+    else:
+        with open(path, 'rb') as f:
+            peek = f.read(8)
+
+    if peek.startswith('PK\x03\x04'):
+        return XlsxWorkbook(path, file_contents)
+    # OLE2 compound document, or a bare BIFF stream
+    if peek.startswith('\xd0\xcf\x11\xe0') or peek[:2] in ('\x09\x00', '\x09\x02', '\x09\x04', '\x09\x08'):
+        return XlsWorkbook(path, file_contents)
+    if path and os.path.splitext(path)[1].lower() == '.csv':
+        return CsvWorkbook(path, file_contents)
+    # Let xlrd complain, or read whatever else it supports
+    return XlsWorkbook(path, file_contents)
+
+class _WorkbookBase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def sheet_by_name(self, name):
+        try:
+            ndx = self.sheet_names().index(name)
+        except ValueError:
+            raise xlrd.XLRDError('No sheet named <%r>' % (name))
+        return self.sheet_by_index(ndx)
+
+    def close(self):
+        pass
+
+class XlsSheet(object):
+    """Rows of an xlrd sheet"""
+    def __init__(self, sheet, workbook):
+        self.sheet = sheet
+        self.workbook = workbook
+        self.name = sheet.name
+        self.nrows = sheet.nrows
+
+    def row_types(self, ndx):
+        return self.sheet.row_types(ndx)
+
+    def row_values(self, ndx):
+        return self.sheet.row_values(ndx)
+
+    def rows(self, start_row, end_row, start_col=0, end_col=None):
+        end_colx = None if end_col is None else end_col + 1
+        for ndx in range(start_row, min(end_row + 1, self.sheet.nrows)):
+            yield (self.sheet.row_types(ndx, start_col, end_colx), 
+                   self.sheet.row_values(ndx, start_col, end_colx))
+
+class XlsWorkbook(_WorkbookBase):
+    """Workbook opened on demand: only the sheets asked for are parsed,
+    without formatting or padding of short rows, and everything is
+    released on close.
+
+    xlrd always parses a sheet as a whole, so rows past the region are
+    parsed but never read. bytes_parsed and rows_parsed report the work
+    actually done: the workbook globals plus the loaded sheets, out of
+    file_bytes."""
+
+    def __init__(self, path=None, file_contents=None):
+        self.path = path
+        self.book = xlrd.open_workbook(path, file_contents=file_contents, on_demand=True, ragged_rows=True)
+        self.file_bytes = len(file_contents) if file_contents else os.path.getsize(path)
+        # For .xls files, where the globals stop and the sheets start
+        self._sheet_positions = getattr(self.book, '_sh_abs_posn', None)
+        self.bytes_parsed = getattr(self.book, '_position', self.file_bytes)
+        self.rows_parsed = 0
+        self._used = []
+
+    def sheet_names(self):
+        return self.book.sheet_names()
+
+    def sheet_by_index(self, ndx):
+        if ndx not in self._used:
+            loaded = self.book.sheet_loaded(ndx)
+            sheet = self.book.sheet_by_index(ndx)
+            if not loaded and self._sheet_positions:
+                self.bytes_parsed += self.book._position - self._sheet_positions[ndx]
+            self.rows_parsed += sheet.nrows
+            self._used.append(ndx)
+        return XlsSheet(self.book.sheet_by_index(ndx), self)
+
+    def close(self):
+        for ndx in self._used:
+            self.book.unload_sheet(ndx)
+        self._used = []
+        self.book.release_resources()
+
+class _CountingReader(object):
+    """File wrapper counting the bytes read through it"""
+    def __init__(self, f, counter):
+        self.f = f
+        self.counter = counter
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.counter.bytes_parsed += len(data)
+        return data
+
+_main_ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_rel_ns = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_package_rel_ns = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# Built in number formats that show dates
+_date_format_ids = set(range(14, 23)) | set(range(45, 48))
+
+# Bracketed colours, conditions and locales, which _is_date_format drops,
+# and elapsed times ([h], [mm], [ss]), which it keeps
+_format_brackets = re.compile(r'\[([^]]*)\]')
+# Quoted text and the characters after \, _ (padding) and * (fill)
+_format_literals = re.compile(r'"[^"]*"|[\\_*].')
+
+def _is_date_format(format_code):
+    """Whether numbers shown with the format code are dates or times
+
+    >>> [_is_date_format(code) for code in ('yyyy-mm-dd', '[$-409]mmm d, yyyy', '[h]:mm:ss', 'hh\\hmm')]
+    [True, True, True, True]
+    >>> [_is_date_format(code) for code in ('#,##0.00;[Red]-#,##0.00', '#,##0.00_);[Red](#,##0.00)',
+    ...                                     '[$-409]#,##0.00', '0 "days"', 'General')]
+    [False, False, False, False, False]
+    """
+    elapsed = lambda match: match.group(1) if not match.group(1).strip('hms') else ''
+    code = _format_literals.sub('', _format_brackets.sub(elapsed, format_code.lower()))
+    return any(c in code for c in 'dmyhs') and 'general' not in code
+
+def _column_index(reference):
+    """'AB12' -> 27"""
+    ndx = 0
+    for c in reference:
+        if c.isalpha():
+            ndx = ndx * 26 + (ord(c.upper()) - ord('A') + 1)
+        else:
+            break
+    return ndx - 1
+
+# What zipfile and cElementTree raise for corrupt xlsx parts
+_xlsx_errors = (zipfile.BadZipfile, zlib.error, KeyError, ValueError, IndexError, SyntaxError)
+
+class XlsxSheet(object):
+    """Rows of a worksheet part, parsed as a stream of XML events. Only
+    one row element is kept in memory and parsing stops after the last
+    row asked for. A part that can't be parsed raises WorkbookError
+
+    >>> data = StringIO()
+    >>> with zipfile.ZipFile(data, 'w') as z:
+    ...     z.writestr('xl/workbook.xml', '<workbook xmlns="%s" xmlns:r="%s"><sheets>'
+    ...                '<sheet name="S" r:id="r1"/></sheets></workbook>' % (_main_ns[1:-1], _rel_ns[1:-1]))
+    ...     z.writestr('xl/_rels/workbook.xml.rels', '<Relationships xmlns="%s"><Relationship Id="r1" '
+    ...                'Target="worksheets/sheet1.xml"/></Relationships>' % (_package_rel_ns[1:-1]))
+    ...     z.writestr('xl/worksheets/sheet1.xml', '<worksheet xmlns="%s"><sheetData><row r="1">'
+    ...                '<c r="A1"><v>1</v></c></row><row r="2"><c r="A' % (_main_ns[1:-1]))
+    >>> with XlsxWorkbook('cut.xlsx', data.getvalue()) as wb:
+    ...     list(wb.sheet_by_index(0).rows(0, 5))
+    Traceback (most recent call last):
+    WorkbookError: cut.xlsx: corrupt worksheet xl/worksheets/sheet1.xml: unclosed token: line 1, column 138
+    """
+    def __init__(self, workbook, name, part):
+        self.workbook = workbook
+        self.name = name
+        self.part = part
+
+    def rows(self, start_row, end_row, start_col=0, end_col=None):
+        try:
+            for row in self._rows(start_row, end_row, start_col, end_col):
+                yield row
+        except _xlsx_errors, e:
+            raise WorkbookError('%s: corrupt worksheet %s: %s' % (self.workbook.path, self.part, e))
+
+    def _rows(self, start_row, end_row, start_col, end_col):
+        workbook = self.workbook
+        next_row = start_row
+        with workbook.zip.open(self.part) as f:
+            events = cElementTree.iterparse(_CountingReader(f, workbook), events=('start', 'end'))
+            sheet_data = None
+            for event, elem in events:
+                if event == 'start':
+                    if elem.tag == _main_ns + 'sheetData':
+                        sheet_data = elem
+                    continue
+                if elem.tag != _main_ns + 'row':
+                    continue
+
+                ndx = int(elem.get('r')) - 1 if elem.get('r') else next_row
+                if ndx > end_row:
+                    break
+                if ndx >= start_row:
+                    # Rows without cells aren't in the file
+                    for missing in range(next_row, ndx):
+                        yield ([], [])
+                    workbook.rows_parsed += 1
+                    yield self._row(elem, start_col, end_col)
+                    next_row = ndx + 1
+                elem.clear()
+                if sheet_data is not None:
+                    sheet_data.remove(elem)
+
+    def _row(self, row, start_col, end_col):
+        types = []
+        values = []
+        col = start_col - 1
+        for cell in row.iter(_main_ns + 'c'):
+            reference = cell.get('r')
+            col = _column_index(reference) if reference else col + 1
+            if col < start_col:
+                continue
+            if end_col is not None and col > end_col:
+                break
+            while len(types) < col - start_col:
+                types.append(XlsType.xls_empty)
+                values.append(u'')
+            cell_type, cell_value = self.workbook._cell(cell)
+            types.append(cell_type)
+            values.append(cell_value)
+        return (types, values)
+
+class XlsxWorkbook(_WorkbookBase):
+    """Reads .xlsx files without xlrd: the workbook, relationships, styles
+    and shared strings parts are parsed when opening, worksheet parts
+    only when their rows are read. Cells become the same (type, value)
+    pairs xlrd would give for an .xls file."""
+
+    def __init__(self, path=None, file_contents=None):
+        self.path = path
+        self.file_bytes = len(file_contents) if file_contents else os.path.getsize(path)
+        self.bytes_parsed = 0
+        self.rows_parsed = 0
+        try:
+            self.zip = zipfile.ZipFile(StringIO(file_contents) if file_contents is not None else path)
+            self._read_workbook()
+            self._read_styles()
+            self._read_shared_strings()
+        except _xlsx_errors, e:
+            raise WorkbookError('%s: unsupported or corrupt xlsx file: %s' % (path, e))
+
+    def _parse(self, part):
+        with self.zip.open(part) as f:
+            return cElementTree.parse(_CountingReader(f, self)).getroot()
+
+    def _read_workbook(self):
+        relations = self._parse('xl/_rels/workbook.xml.rels')
+        targets = dict((rel.get('Id'), rel.get('Target')) for rel in relations.iter(_package_rel_ns + 'Relationship'))
+        self._sheets = []
+        for sheet in self._parse('xl/workbook.xml').iter(_main_ns + 'sheet'):
+            target = targets[sheet.get(_rel_ns + 'id')]
+            part = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+            self._sheets.append((sheet.get('name'), part))
+        date_1904 = self._parse('xl/workbook.xml').find(_main_ns + 'workbookPr')
+        self._date_1904 = date_1904 is not None and date_1904.get('date1904') in ('1', 'true')
+
+    def _read_styles(self):
+        self._date_styles = set()
+        if 'xl/styles.xml' not in self.zip.namelist():
+            return
+        styles = self._parse('xl/styles.xml')
+        date_formats = set(_date_format_ids)
+        for num_fmt in styles.iter(_main_ns + 'numFmt'):
+            if _is_date_format(num_fmt.get('formatCode', '')):
+                date_formats.add(int(num_fmt.get('numFmtId')))
+        cell_xfs = styles.find(_main_ns + 'cellXfs')
+        if cell_xfs is not None:
+            for ndx, xf in enumerate(cell_xfs.findall(_main_ns + 'xf')):
+                if int(xf.get('numFmtId', 0)) in date_formats:
+                    self._date_styles.add(str(ndx))
+
+    def _read_shared_strings(self):
+        self._strings = []
+        if 'xl/sharedStrings.xml' not in self.zip.namelist():
+            return
+        with self.zip.open('xl/sharedStrings.xml') as f:
+            for event, elem in cElementTree.iterparse(_CountingReader(f, self)):
+                if elem.tag == _main_ns + 'si':
+                    self._strings.append(u''.join(t.text or u'' for t in elem.iter(_main_ns + 't')))
+                    elem.clear()
+
+    def _cell(self, cell):
+        typ = cell.get('t', 'n')
+        if typ == 'inlineStr':
+            text = u''.join(t.text or u'' for t in cell.iter(_main_ns + 't'))
+            return (XlsType.xls_string, text) if text else (XlsType.xls_empty, u'')
+        value = cell.findtext(_main_ns + 'v')
+        if not value:
+            return (XlsType.xls_empty, u'')
+        if typ == 's':
+            return (XlsType.xls_string, self._strings[int(value)])
+        if typ == 'str':
+            return (XlsType.xls_string, value if type(value) == unicode else value.decode('utf-8'))
+        if typ == 'b':
+            return (XlsType.xls_boolean, int(value))
+        if typ == 'e':
+            return (XlsType.xls_error, value)
+        number = float(value)
+        if cell.get('s') in self._date_styles:
+            return (XlsType.xls_date, number + 1462 if self._date_1904 else number)
+        return (XlsType.xls_float, number)
+
+    def sheet_names(self):
+        return [name for name, part in self._sheets]
+
+    def sheet_by_index(self, ndx):
+        name, part = self._sheets[ndx]
+        return XlsxSheet(self, name, part)
+
+    def close(self):
+        self.zip.close()
+
+def _csv_value(text):
+    """Cell type and value for a CSV field, numbers and ISO dates become
+    floats like they would in a spreadsheet"""
+    if text == '':
+        return (XlsType.xls_empty, u'')
+    try:
+        number = float(text)
+        # Not for 'nan' or 'inf', spreadsheets don't have those numbers
+        if number == number and abs(number) != float('inf'):
+            return (XlsType.xls_float, number)
+    except ValueError:
+        pass
+    if len(text) == 10 and text[4] in '-/' and text[7] == text[4]:
+        try:
+            date = datetime.date(int(text[:4]), int(text[5:7]), int(text[8:]))
+            return (XlsType.xls_date, float((date - datetime.date(1899, 12, 30)).days))
+        except ValueError:
+            pass
+    return (XlsType.xls_string, text.decode('utf-8', 'replace'))
+
+class CsvSheet(object):
+    def __init__(self, workbook, name):
+        self.workbook = workbook
+        self.name = name
+
+    def _lines(self, f):
+        # Counts what csv reads, the file is read in buffered chunks
+        for line in f:
+            self.workbook.bytes_parsed += len(line)
+            yield line
+
+    def rows(self, start_row, end_row, start_col=0, end_col=None):
+        workbook = self.workbook
+        end_colx = None if end_col is None else end_col + 1
+        f = StringIO(workbook.file_contents) if workbook.file_contents is not None else open(workbook.path, 'rb')
+        try:
+            for ndx, fields in enumerate(csv.reader(self._lines(f))):
+                if ndx > end_row:
+                    break
+                if ndx >= start_row:
+                    workbook.rows_parsed += 1
+                    fields = fields[start_col:end_colx]
+                    # Trailing empty fields are missing cells, like in
+                    # the rows of the other readers
+                    while fields and fields[-1] == '':
+                        fields.pop()
+                    cells = [_csv_value(field) for field in fields]
+                    yield ([t for t, v in cells], [v for t, v in cells])
+        except csv.Error, e:
+            raise WorkbookError('%s: %s' % (workbook.path, e))
+        finally:
+            f.close()
+
+class CsvWorkbook(_WorkbookBase):
+    """A CSV file as a workbook with a single sheet named after the file"""
+    def __init__(self, path=None, file_contents=None):
+        self.path = path
+        self.file_contents = file_contents
+        self.file_bytes = len(file_contents) if file_contents is not None else os.path.getsize(path)
+        self.bytes_parsed = 0
+        self.rows_parsed = 0
+
+    def sheet_names(self):
+        return [os.path.splitext(os.path.basename(self.path or 'csv'))[0]]
+
+    def sheet_by_index(self, ndx):
+        if ndx != 0:
+            raise IndexError('CSV files only have one sheet')
+        return CsvSheet(self, self.sheet_names()[0])
+
+def sheet_rows(sheet, start_row, end_row, start_col=0, end_col=None):
+    """(types, values) of columns start_col to end_col of the rows of
+    sheet from start_row up to end_row or the last row, whatever reader
+    sheet comes from. Rows can be shorter than the range of columns"""
+    if hasattr(sheet, 'rows'):
+        return sheet.rows(start_row, end_row, start_col, end_col)
+    end_colx = None if end_col is None else end_col + 1
+    return ((sheet.row_types(ndx, start_col, end_colx), sheet.row_values(ndx, start_col, end_colx))
+            for ndx in range(start_row, min(end_row + 1, sheet.nrows)))
+
+def row_slices_from_sheet(sheet, end_row, end_col, start_row=0, start_col=0,
+                          row_values=lambda types, values: types,
+                          empty_value=XlsType.xls_empty, padded_end_row=None):
+    """Yields a list of end_col - start_col + 1 items for every row from
+    start_row to end_row: row_values(types, values) of the cells of the
+    row, padded with empty_value. Only those columns are read from the
+    sheet. Rows past the end of the sheet, up to padded_end_row (end_row
+    by default), are the same padding list, which must not be changed.
+
+    >>> wb = CsvWorkbook(file_contents='a,b,c\\nd\\n')
+    >>> list(row_slices_from_sheet(wb.sheet_by_index(0), 2, 2, start_col=1, empty_value=None))
+    [[1, 1], [None, None], [None, None]]
+    >>> list(row_slices_from_sheet(wb.sheet_by_index(0), 5, 2, start_col=1, empty_value=None, padded_end_row=0))
+    [[1, 1], [None, None]]
+    """
+    width = end_col - start_col + 1
+    padding_row = [empty_value] * width
+    i = start_row - 1
+    for i, (types, values) in enumerate(sheet_rows(sheet, start_row, end_row, start_col, end_col), start_row):
+        row = row_values(types, values)
+        if len(row) < width:
+            row = list(row) + padding_row[len(row):]
+        yield row
+
+    for i_left in range(i + 1, (end_row if padded_end_row is None else padded_end_row) + 1):
+        yield padding_row
+
+class _StreamedRow(object):
+    """A row read by a streamed reader, standing for its sheet in the
+    row_values(sheet, ndx) callbacks of cell_stream_from_sheet"""
+    def __init__(self, types, values):
+        self.types = types
+        self.values = values
+
+    def row_types(self, ndx):
+        return self.types
+
+    def row_values(self, ndx):
+        return self.values
+
+def cell_stream_from_sheet(sheet, end_row, end_col, start_row=0, start_col=0,
                     row_values=lambda sheet, ndx: sheet.row_types(ndx),
                     empty_value=XlsType.xls_empty):
     """
@@ -20,17 +471,29 @@ def cell_stream_from_sheet(sheet, end_row, end_col, start_row=0, start_col=0,
     4
     >>> len([x for x in cell_stream_from_sheet(sheet, 2, 1000, start_row=1)])
     2002
+    >>> wb = CsvWorkbook(file_contents='a,1,2015-01-31\\n,2.5,\\n')
+    >>> pairs = lambda sheet, ndx: zip(sheet.row_types(ndx), sheet.row_values(ndx))
+    >>> list(cell_stream_from_sheet(wb.sheet_by_index(0), 2, 2, row_values=pairs, empty_value=None))
+    [(1, u'a'), (2, 1.0), (3, 42035.0), (0, u''), (2, 2.5), None, None, None, None]
+    >>> list(cell_stream_from_sheet(wb.sheet_by_index(0), 1, 2, start_col=1, empty_value=None))
+    [2, 3, 2, None]
     """
-
-    for i in range(start_row, min(end_row + 1, sheet.nrows)):
-        row = row_values(sheet, i)
-        for j in range(start_col, min(end_col + 1, len(row))):
-            yield row[j]
-        for j in range(j + 1, end_col + 1):
+    if hasattr(sheet, 'row_types'):
+        rows = ((i, sheet) for i in range(start_row, min(end_row + 1, sheet.nrows)))
+    else:
+        rows = enumerate((_StreamedRow(types, values) for types, values
+                          in sheet.rows(start_row, end_row, 0, end_col)), start_row)
+    width = end_col - start_col + 1
+    i = start_row - 1
+    for i, source in rows:
+        row = row_values(source, i)[start_col:end_col + 1]
+        for cell in row:
+            yield cell
+        for j in range(len(row), width):
             yield empty_value
-                           
+
     for i_left in range(i + 1, end_row + 1):
-        for j_left in range(0, end_col + 1):
+        for j_left in range(width):
             yield empty_value
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 from collections import defaultdict
+from array import array
 import math
 
 def adjust_for_moderation(value, moderation):
@@ -67,19 +68,90 @@ def bayes_combine(prob_series):
     '0.4'
     >>> str(round(bayes_combine([0.8, 0.2, 0.5, 0.4, 0.5, 0.5, 0.5, 0.5, 0.5]), 9))[:3]
     '0.4'
+    >>> round(bayes_combine([0.3] * 2000 + [0.7] * 1999), 6)
+    0.3
+    >>> bayes_combine([0.4, 0, 1, 0.6, 1])
+    1.0
     """
+    combined = BayesAccumulator()
+    combined.extend(prob_series)
+    return combined.probability
+
+def log_odds(prob):
+    """log(p / (1 - p)), only for 0 < p < 1"""
+    return math.log(prob) - math.log1p(-prob)
 
-    # To multiply biggest first
-    prob_series = sorted(prob_series, reverse=True)
+def odds_to_probability(total_log_odds, certain_good=0, certain_bad=0):
+    """Probability for summed log odds, where certain_good and certain_bad
+    count the probabilities of exactly 1 and 0 left out of the sum. 
+    Certainties cancel each other out one for one, any left over decide
+    the result.
 
-    numerator = reduce(lambda x, y: x * y, prob_series) * 1.0
+    >>> odds_to_probability(0.0)
+    0.5
+    >>> odds_to_probability(-1e6), odds_to_probability(1e6)
+    (0.0, 1.0)
+    >>> odds_to_probability(3.0, certain_good=1, certain_bad=2)
+    0.0
+    """
+    if certain_good != certain_bad:
+        return 1.0 if certain_good > certain_bad else 0.0
 
-    # Same here, trying to get biggest first when doing 1 - p
-    prob_series.reverse()
+    # Written so exp never overflows
+    if total_log_odds >= 0:
+        return 1.0 / (1.0 + math.exp(-total_log_odds))
+    else:
+        odds = math.exp(total_log_odds)
+        return odds / (1.0 + odds)
+
+class BayesAccumulator(object):
+    """Streaming form of bayes_combine, keeps the sum of the log odds of
+    every probability added instead of multiplying them, so long series 
+    don't underflow. 
+
+    probability_bounds tells how far the result can still move given
+    bounds on the log odds of whatever is left to add, so callers can 
+    stop once the verdict can't change.
+
+    >>> acc = BayesAccumulator()
+    >>> acc.extend([0.9, 0.8])
+    >>> acc.add(0.6)
+    >>> str(round(acc.probability, 4)), acc.count
+    ('0.9818', 3)
+    >>> low, high = acc.probability_bounds(log_odds(0.1) * 2, log_odds(0.9) * 2)
+    >>> low < 0.5 < high
+    True
+    >>> acc.probability_bounds(0, 0) == (acc.probability, acc.probability)
+    True
+    """
+    def __init__(self):
+        self.log_odds = 0.0
+        self.certain_good = 0
+        self.certain_bad = 0
+        self.count = 0
+
+    def add(self, prob):
+        if prob >= 1:
+            self.certain_good += 1
+        elif prob <= 0:
+            self.certain_bad += 1
+        else:
+            self.log_odds += math.log(prob) - math.log1p(-prob)
+        self.count += 1
+
+    def extend(self, prob_series):
+        for prob in prob_series:
+            self.add(prob)
 
-    denominator = numerator + reduce(lambda x, y: x * y, [1 - p for p in prob_series])
-    
-    return numerator / denominator
+    @property
+    def probability(self):
+        return odds_to_probability(self.log_odds, self.certain_good, self.certain_bad)
+
+    def probability_bounds(self, remaining_low, remaining_high):
+        """(lowest, highest) final probability if the log odds still to
+        be added sum to something between remaining_low and remaining_high"""
+        return (odds_to_probability(self.log_odds + remaining_low, self.certain_good, self.certain_bad),
+                odds_to_probability(self.log_odds + remaining_high, self.certain_good, self.certain_bad))
 
 def adjust_for_bias(prob, exponent):
     """
@@ -149,6 +221,9 @@ class Histogram(defaultdict):
     85
     >>> Histogram().value_total
     0
+    >>> obj.merge(Histogram({'test': 1, 'new': 2}))
+    >>> obj.value_total, obj['new']
+    (88, 2)
     """
     
     def __init__(self, default_type=int, *args, **kwargs):
@@ -169,10 +244,219 @@ class Histogram(defaultdict):
         super(Histogram, self).__setitem__(key, value)
         self._total += (value - prev)
 
+    def add(self, key, how_much=1):
+        self[key] += how_much
+
+    def merge(self, other):
+        """Adds the counts of other to this histogram"""
+        for key, count in other.iteritems():
+            self[key] += count
+
+    @property
+    def value_total(self):
+        return self._total
+
+    @property
+    def distinct(self):
+        """Number of different keys counted"""
+        return len(self)
+
+_MASK64 = (1 << 64) - 1
+
+def _hash64(key):
+    """Well mixed 64 bit hash of key, ids are consecutive integers"""
+    h = hash(key) & _MASK64
+    h = ((h ^ (h >> 33)) * 0xff51afd7ed558ccd) & _MASK64
+    h = ((h ^ (h >> 33)) * 0xc4ceb9fe1a85ec53) & _MASK64
+    return h ^ (h >> 33)
+
+class SketchHistogram(object):
+    """Histogram taking the same memory however many different keys it
+    counts. Up to capacity keys it counts exactly, like Histogram. Past 
+    that it keeps the capacity most frequent keys with their counts (the
+    only keys get gives a count for, the rest count as never seen), and
+    every key in a count-min sketch, so a key that becomes frequent 
+    enters the top with its earlier count. value_total stays exact and 
+    distinct is estimated with HyperLogLog, within a few percent.
+
+    >>> h = SketchHistogram(capacity=64)
+    >>> for n in range(1000):
+    ...     h.add('ID%d' % n)
+    >>> h.add('common', 200)
+    >>> h.value_total, h.get('common') >= 200, h.get('never'), len(h) <= 64
+    (1200, True, None, True)
+    >>> abs(h.distinct - 1001) < 100
+    True
+    >>> small = SketchHistogram(capacity=16)
+    >>> small.add('a', 3)
+    >>> small.add('b')
+    >>> small.get('a'), small.distinct, sorted(small.iteritems())
+    (3, 2, [('a', 3), ('b', 1)])
+    """
+    depth = 4
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Counters per row of the sketch, and 2 ** precision HyperLogLog
+        # registers (the distinct estimate is within about 1 / sqrt of
+        # that), both growing with capacity
+        self.width = 1 << max(4, (2 * capacity - 1).bit_length())
+        self.precision = min(12, max(6, capacity.bit_length() + 3))
+        self.counts = {}
+        self._total = 0
+        # Created once there are more keys than capacity
+        self.sketch = None
+        self.registers = None
+        # No tracked count is lower, see _admit
+        self._floor = 0
+
+    def _start_sketch(self):
+        self.sketch = array('l', [0]) * (self.depth * self.width)
+        self.registers = array('B', [0]) * (1 << self.precision)
+        for key, count in self.counts.iteritems():
+            self._count(key, count)
+
+    def _cells(self, h):
+        """Index of the counter of hash h in every row of the sketch"""
+        width = self.width
+        first, step = h & 0xffffffff, (h >> 32) | 1
+        return [row * width + (first + row * step) % width for row in range(self.depth)]
+
+    def _count(self, key, how_much):
+        """Adds to the sketch and registers, returns the estimated count"""
+        h = _hash64(key)
+        sketch = self.sketch
+        estimate = None
+        for ndx in self._cells(h):
+            sketch[ndx] += how_much
+            if estimate is None or sketch[ndx] < estimate:
+                estimate = sketch[ndx]
+        rest = 64 - self.precision
+        rank = rest - (h & ((1 << rest) - 1)).bit_length() + 1
+        if rank > self.registers[h >> rest]:
+            self.registers[h >> rest] = rank
+        return estimate
+
+    def _admit(self, key, estimate):
+        """Tracks key in place of the least frequent key if it is now
+        more frequent"""
+        if estimate <= self._floor:
+            return
+        lowest = min(self.counts, key=self.counts.get)
+        if estimate > self.counts[lowest]:
+            del self.counts[lowest]
+            self.counts[key] = estimate
+            lowest = min(self.counts, key=self.counts.get)
+        self._floor = self.counts[lowest]
+
+    def add(self, key, how_much=1):
+        self._total += how_much
+        if self.sketch is None:
+            if key in self.counts or len(self.counts) < self.capacity:
+                self.counts[key] = self.counts.get(key, 0) + how_much
+                return
+            self._start_sketch()
+
+        estimate = self._count(key, how_much)
+        if key in self.counts:
+            self.counts[key] += how_much
+        else:
+            self._admit(key, estimate)
+
+    def merge(self, other):
+        """Adds the counts of other, a Histogram or SketchHistogram"""
+        if getattr(other, 'sketch', None) is None:
+            for key, count in other.iteritems():
+                self.add(key, count)
+            return
+        if self.sketch is None:
+            self._start_sketch()
+        if (self.capacity, len(self.sketch)) != (other.capacity, len(other.sketch)):
+            raise ValueError('Cannot merge sketches of different sizes')
+        for ndx, count in enumerate(other.sketch):
+            self.sketch[ndx] += count
+        for ndx, rank in enumerate(other.registers):
+            self.registers[ndx] = max(self.registers[ndx], rank)
+        self._total += other._total
+        # The most frequent of both by their merged estimates
+        candidates = set(self.counts) | set(other.counts)
+        merged = dict((key, self.counts.get(key, 0) + other.counts.get(key, 0) 
+                       if key in self.counts and key in other.counts else self._estimate(key))
+                      for key in candidates)
+        self.counts = dict(sorted(merged.iteritems(), key=lambda (key, count): -count)[:self.capacity])
+        self._floor = min(self.counts.itervalues()) if self.counts else 0
+
+    def _estimate(self, key):
+        return min(self.sketch[ndx] for ndx in self._cells(_hash64(key)))
+
+    def get(self, key, default=None):
+        return self.counts.get(key, default)
+
+    def iteritems(self):
+        return self.counts.iteritems()
+
+    def keys(self):
+        return self.counts.keys()
+
+    def __len__(self):
+        return len(self.counts)
+
     @property
     def value_total(self):
         return self._total
-        
+
+    @property
+    def distinct(self):
+        if self.registers is None:
+            return len(self.counts)
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -rank for rank in self.registers)
+        empty = self.registers.count(0)
+        if estimate <= 2.5 * m and empty:
+            # Linear counting is closer for few keys
+            estimate = m * math.log(float(m) / empty)
+        return max(int(round(estimate)), len(self.counts))
+
+class ValueTable(object):
+    """Gives every distinct value an integer id, so histograms sharing
+    the table count ids and each value is kept once
+
+    >>> table = ValueTable()
+    >>> table.add(u'red'), table.add(u'blue'), table.add(u'red')
+    (0, 1, 0)
+    >>> table.get(u'blue'), table.get(u'green'), table.value(0), len(table)
+    (1, None, u'red', 2)
+    """
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def __getstate__(self):
+        # The ids are rebuilt, so every value is pickled once
+        return {'values': self.values}
+
+    def __setstate__(self, state):
+        self.values = state['values']
+        self.ids = dict((value, value_id) for value_id, value in enumerate(self.values))
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        """Id of value, given a new one if it has none"""
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def get(self, value):
+        """Id of value, None if it has none"""
+        return self.ids.get(value)
+
+    def value(self, value_id):
+        return self.values[value_id]
+
 def calculate_bayes_probability(value, good_values, bad_values, correct_for_confidence=False,
                         estimate_missing_probabilities=True):
     """
@@ -191,14 +475,21 @@ def calculate_bayes_probability(value, good_values, bad_values, correct_for_conf
                            Histogram({'hey': 20, 'feck': 40})); str(round(res, 3))[:5]
     '0.667'
     """
-    def prob_and_total(value, data):
-        count = data.get(value)
-        total = data.value_total
-        return (count, total)
-
-    good_count, good_total = prob_and_total(value, good_values)
-    bad_count, bad_total = prob_and_total(value, bad_values)
-
+    return bayes_probability(good_values.get(value), good_values.value_total, 
+                             bad_values.get(value), bad_values.value_total,
+                             lambda: good_values.distinct + bad_values.distinct,
+                             correct_for_confidence, estimate_missing_probabilities)
+
+def bayes_probability(good_count, good_total, bad_count, bad_total, distinct_count,
+                      correct_for_confidence=False, estimate_missing_probabilities=True):
+    """calculate_bayes_probability from the counts of the value and the
+    totals of the histograms. distinct_count returns the number of keys of
+    both histograms, it is only called for values never trained when 
+    missing probabilities aren't estimated
+
+    >>> bayes_probability(40, 60, 20, 60, lambda: 3, correct_for_confidence=True)
+    0.6666666666666666
+    """
     all_total = good_total + bad_total
 
     simple_prob = False
@@ -221,8 +512,7 @@ def calculate_bayes_probability(value, good_values, bad_values, correct_for_conf
         #using the average probability per value here, it they're 
         #too scattered we don't want to punish the isolated 
         #value too much
-        distinct_count = len(good_values.keys()) + len(bad_values.keys())
-        avg_per_value = all_total * 1.0 / distinct_count
+        avg_per_value = all_total * 1.0 / distinct_count()
         return (good_prob + (0.5 / avg_per_value)) / 2
 
     return good_prob / (good_prob + bad_prob)
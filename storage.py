@@ -0,0 +1,377 @@
+"""Versioned, columnar on-disk format for training sets.
+
+Layout, little endian:
+
+    magic 'BXCSET', uint16 format version
+    uint32 header length, JSON header: geometry, cell parameters and the
+        (name, struct code, item count, offset) of every section
+    sections, one array each, read in bulk with struct
+
+Every value of every nominal histogram is interned once in a shared
+dictionary, one column per Python type (floats and ints as arrays, text
+as a blob plus offsets). Histograms are stored per series as CSR arrays
+(per cell offsets into value ids and counts) using the narrowest integer
+type that fits, numeric moments and unknown sample counts as one array
+per series and side. The log odds bounds of every cell (see
+CompiledCell.log_odds_bounds) are two more arrays."""
+
+import os
+import json
+import mmap
+import struct
+import tempfile
+from contextlib import contextmanager
+from statistics import *
+from filter_criteria import *
+
+MAGIC = 'BXCSET'
+FORMAT_VERSION = 1
+BINARY_EXTENSION = '.bset'
+
+_preamble = struct.Struct('<6sHI')
+
+# Types of the value dictionary columns, ids are given in this order
+_value_types = (float, unicode, str, int, long, bool, type(None))
+
+def is_binary_set(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+@contextmanager
+def atomic_write(path):
+    """Binary file to write path with: the data goes to a temporary file
+    in the same directory, renamed over path once it is complete and on
+    disk, so path always holds either the old or the new contents"""
+    directory = os.path.dirname(os.path.abspath(path))
+    f = tempfile.NamedTemporaryFile(dir=directory, prefix='.%s.' % os.path.basename(path), delete=False)
+    try:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        if os.path.exists(path):
+            mode = os.stat(path).st_mode & 0777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.chmod(f.name, mode)
+        os.rename(f.name, path)
+    except:
+        f.close()
+        os.remove(f.name)
+        raise
+
+def _smallest_code(largest):
+    for code in 'BHI':
+        if largest < 1 << (8 * struct.calcsize(code)):
+            return code
+    return 'Q'
+
+def _series_of(tcell):
+    return [innermost_series(s) for s in tcell.value_classes + tcell.type_classes]
+
+def _describe(series):
+    """Class and parameters of a series and its wrappers, outermost first"""
+    description = []
+    while hasattr(series, 'inner_series'):
+        parameter = series.confidence if isinstance(series, LowConfidenceSeries) else series.exponent
+        description.append([type(series).__name__, parameter])
+        series = series.inner_series
+    options = {}
+    if isinstance(series, NominalSeries):
+        options = {'ignore_blanks': series.ignore_blanks, 'ignored_values': list(series.ignored_values),
+                   'correct_for_confidence': series.correct_for_confidence,
+                   'estimate_missing_probabilities': series.estimate_missing_probabilities}
+    description.append([type(series).__name__, options])
+    return description
+
+def cell_parameters(tcell):
+    """JSON friendly description of how a TrainingCell's series are built"""
+    return [_describe(s) for s in tcell.value_classes + tcell.type_classes]
+
+class _SectionWriter(object):
+    def __init__(self):
+        self.sections = []
+        self.chunks = []
+        self.offset = 0
+
+    def add(self, name, code, items):
+        count = len(items)
+        if code == 'raw':
+            data = items
+        else:
+            data = struct.pack('<%d%s' % (count, code), *items)
+        self.sections.append([name, code, count, self.offset])
+        self.chunks.append(data)
+        self.offset += len(data)
+
+    def add_counts(self, name, items):
+        """Non negative integers, stored with the narrowest type"""
+        self.add(name, _smallest_code(max(items) if items else 0), items)
+
+    def add_text(self, name, items):
+        encoded = [item.encode('utf-8') if type(item) == unicode else item for item in items]
+        offsets = [0]
+        for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+        self.add_counts(name + '.offsets', offsets)
+        self.add(name, 'raw', ''.join(encoded))
+
+def _write_values(writer, values):
+    """Writes one column per type, returns {(type, value): id}"""
+    ids = {}
+    for typ in _value_types:
+        column = sorted(value for value in values if type(value) == typ)
+        name = 'values.' + typ.__name__
+        if typ == float:
+            writer.add(name, 'd', column)
+        elif typ == int or typ == long:
+            writer.add(name, 'q', column)
+        elif typ == bool:
+            writer.add(name, 'B', column)
+        elif typ == unicode or typ == str:
+            writer.add_text(name, column)
+        else:
+            writer.add(name, 'raw', '\0' * len(column))
+        for value in column:
+            ids[(typ, value)] = len(ids)
+    return ids
+
+def read_values(sections):
+    """Every value in the dictionary, in id order"""
+    values = []
+    for typ in _value_types:
+        name = 'values.' + typ.__name__
+        if typ == unicode or typ == str:
+            offsets = sections[name + '.offsets']
+            blob = sections[name]
+            column = [blob[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+            if typ == unicode:
+                column = [data.decode('utf-8') for data in column]
+        elif typ == bool:
+            column = [b == 1 for b in sections[name]]
+        elif typ == type(None):
+            column = [None] * len(sections[name])
+        else:
+            column = list(sections[name])
+        values.extend(column)
+    return values
+
+def save_binary(tset, f):
+    """Writes tset to the open binary file f"""
+    cells = [_series_of(tcell) for tcell in tset.training_cells]
+    if cells and any(getattr(series, 'sketch_size', None) for series in cells[0]):
+        raise ValueError('Sets with sketched histograms can only be pickled')
+    writer = _SectionWriter()
+    kinds = []
+
+    histograms = lambda slot, side: [getattr(series[slot], side + '_data') for series in cells]
+    # (value, count) of every nominal series by slot and side
+    value_counts = {}
+    distinct = set()
+    for slot, prototype in enumerate(cells[0] if cells else []):
+        if not isinstance(prototype, NumericSeries):
+            for side in ('good', 'bad'):
+                counts = value_counts[(slot, side)] = [series[slot].value_counts(side == 'bad') for series in cells]
+                for pairs in counts:
+                    distinct.update((type(value), value) for value, count in pairs)
+    ids = _write_values(writer, [value for typ, value in distinct])
+
+    for slot, prototype in enumerate(cells[0] if cells else []):
+        if isinstance(prototype, NumericSeries):
+            kinds.append('numeric')
+            for side in ('good', 'bad'):
+                moments = histograms(slot, side)
+                writer.add_counts('%d.%s.count' % (slot, side), [m.count for m in moments])
+                writer.add('%d.%s.mean' % (slot, side), 'd', [m.mean for m in moments])
+                writer.add('%d.%s.m2' % (slot, side), 'd', [m.m2 for m in moments])
+        else:
+            kinds.append('nominal')
+            for side in ('good', 'bad'):
+                offsets = [0]
+                value_ids = []
+                counts = []
+                for pairs in value_counts[(slot, side)]:
+                    for value, count in pairs:
+                        value_ids.append(ids[(type(value), value)])
+                        counts.append(count)
+                    offsets.append(len(value_ids))
+                writer.add_counts('%d.%s.offsets' % (slot, side), offsets)
+                writer.add_counts('%d.%s.ids' % (slot, side), value_ids)
+                writer.add_counts('%d.%s.counts' % (slot, side), counts)
+        for side in ('good', 'bad'):
+            writer.add_counts('%d.%s.unknown' % (slot, side),
+                              [getattr(series[slot], side + '_unknown_samples_count') for series in cells])
+
+    # What each cell can add to the log odds of a score, so threshold
+    # scoring of mapped sets needn't build every cell to know
+    bounds = [tcell.compile().log_odds_bounds() for tcell in tset.training_cells]
+    writer.add('bounds.low', 'd', [low for low, high in bounds])
+    writer.add('bounds.high', 'd', [high for low, high in bounds])
+
+    header = json.dumps({'geometry': list(tset.geometry), 'cells': len(cells), 'kinds': kinds,
+                         'generation': getattr(tset, 'generation', None),
+                         'layout': getattr(tset, 'layout', None),
+                         'parameters': cell_parameters(tset.training_cells[0]) if cells else [],
+                         'sections': writer.sections}, sort_keys=True)
+    f.write(_preamble.pack(MAGIC, FORMAT_VERSION, len(header)))
+    f.write(header)
+    for chunk in writer.chunks:
+        f.write(chunk)
+
+def read_header(f):
+    """Reads the preamble and header, returns (header, offset of the
+    first section)"""
+    magic, version, header_length = _preamble.unpack(f.read(_preamble.size))
+    if magic != MAGIC:
+        raise ValueError('Not a binary training set')
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported training set format version %d' % (version))
+    header = json.loads(f.read(header_length))
+    return (header, _preamble.size + header_length)
+
+def _read_sections(data, header, base):
+    sections = {}
+    for name, code, count, offset in header['sections']:
+        start = base + offset
+        if code == 'raw':
+            sections[name] = data[start:start + count]
+        else:
+            sections[name] = struct.unpack_from('<%d%s' % (count, code), data, start)
+    return sections
+
+def check_parameters(header, tset):
+    if tset.training_cells and cell_parameters(tset.training_cells[0]) != header['parameters']:
+        raise ValueError('The training set was saved with different cell parameters')
+
+def load_binary(f, set_factory):
+    """Reads a set written by save_binary from the open file f,
+    set_factory(*geometry) must return an empty TrainingSet"""
+    header, base = read_header(f)
+    sections = _read_sections(f.read(), header, 0)
+    values = read_values(sections)
+
+    tset = set_factory(*header['geometry'])
+    tset.generation = header.get('generation')
+    check_parameters(header, tset)
+    cells = [_series_of(tcell) for tcell in tset.training_cells]
+    # Ids the ValueTable of the series give the values, by file id
+    table_ids = {}
+    def local_ids(table):
+        if id(table) not in table_ids:
+            table_ids[id(table)] = [table.add(value) for value in values]
+        return table_ids[id(table)]
+
+    for slot, kind in enumerate(header['kinds']):
+        for side in ('good', 'bad'):
+            data_name = side + '_data'
+            prefix = '%d.%s.' % (slot, side)
+            if kind == 'numeric':
+                counts = sections[prefix + 'count']
+                means = sections[prefix + 'mean']
+                m2s = sections[prefix + 'm2']
+                for ndx, series in enumerate(cells):
+                    moments = getattr(series[slot], data_name)
+                    moments.count, moments.mean, moments.m2 = counts[ndx], means[ndx], m2s[ndx]
+            else:
+                offsets = sections[prefix + 'offsets']
+                ids = sections[prefix + 'ids']
+                counts = sections[prefix + 'counts']
+                for ndx, series in enumerate(cells):
+                    start, end = offsets[ndx], offsets[ndx + 1]
+                    if start != end:
+                        mapped = local_ids(series[slot].values)
+                        setattr(series[slot], data_name,
+                                Histogram([(mapped[i], c) for i, c in zip(ids[start:end], counts[start:end])]))
+            unknown = sections[prefix + 'unknown']
+            for ndx, series in enumerate(cells):
+                setattr(series[slot], side + '_unknown_samples_count', unknown[ndx])
+
+    return tset
+
+class MappedSet(object):
+    """Binary set memory-mapped from disk, cells are read on demand so
+    only the pages holding the cells asked for are touched, and processes
+    mapping the same file share the page cache"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header, base = read_header(f)
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.sections = dict((name, (code, count, base + offset))
+                             for name, code, count, offset in self.header['sections'])
+        self.kinds = self.header['kinds']
+
+        # First id of every value dictionary column
+        self._columns = []
+        first_id = 0
+        for typ in _value_types:
+            code, count, offset = self.sections['values.' + typ.__name__]
+            if typ == unicode or typ == str:
+                count = self.sections['values.%s.offsets' % typ.__name__][1] - 1
+            self._columns.append((first_id, first_id + count, typ))
+            first_id += count
+
+    def close(self):
+        self.buffer.close()
+
+    def _items(self, name, start, end):
+        code, count, offset = self.sections[name]
+        return struct.unpack_from('<%d%s' % (end - start, code), self.buffer, 
+                                  offset + start * struct.calcsize(code))
+
+    def _item(self, name, ndx):
+        return self._items(name, ndx, ndx + 1)[0]
+
+    def value(self, value_id):
+        """Value of the dictionary id, decoded from the mapping every time
+        so nothing read stays in memory"""
+        for first_id, end_id, typ in self._columns:
+            if value_id < end_id:
+                break
+        name = 'values.' + typ.__name__
+        ndx = value_id - first_id
+        if typ == unicode or typ == str:
+            start, end = self._items(name + '.offsets', ndx, ndx + 2)
+            offset = self.sections[name][2]
+            value = self.buffer[offset + start:offset + end]
+            if typ == unicode:
+                value = value.decode('utf-8')
+        elif typ == bool:
+            value = self._item(name, ndx) == 1
+        elif typ == type(None):
+            value = None
+        else:
+            value = self._item(name, ndx)
+        return value
+
+    def log_odds_bounds(self, start, end):
+        """(lowest, highest) log odds of cells start to end - 1 as saved,
+        None for sets saved without them"""
+        if 'bounds.low' not in self.sections:
+            return None
+        return zip(self._items('bounds.low', start, end), self._items('bounds.high', start, end))
+
+    def fill_cell(self, tcell, ndx):
+        """Loads the trained data of cell ndx into the empty tcell"""
+        series = _series_of(tcell)
+        for slot, kind in enumerate(self.kinds):
+            for side in ('good', 'bad'):
+                data_name = side + '_data'
+                prefix = '%d.%s.' % (slot, side)
+                if kind == 'numeric':
+                    moments = getattr(series[slot], data_name)
+                    moments.count = self._item(prefix + 'count', ndx)
+                    moments.mean = self._item(prefix + 'mean', ndx)
+                    moments.m2 = self._item(prefix + 'm2', ndx)
+                else:
+                    start, end = self._items(prefix + 'offsets', ndx, ndx + 2)
+                    if start != end:
+                        ids = self._items(prefix + 'ids', start, end)
+                        counts = self._items(prefix + 'counts', start, end)
+                        values = series[slot].values
+                        setattr(series[slot], data_name, 
+                                Histogram([(values.add(self.value(i)), c) for i, c in zip(ids, counts)]))
+                setattr(series[slot], side + '_unknown_samples_count', self._item(prefix + 'unknown', ndx))
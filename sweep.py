@@ -0,0 +1,202 @@
+"""Cross-validated sweeps over the CellParameters of TrainingCell.
+
+The parameters only set the transforms of the series wrappers, they
+never change what the innermost series count, and a wrapper scores
+transform(inner score). So the labelled corpus is read once, the raw
+counts are trained once per fold, each file is scored once by the
+innermost series of the set trained without its fold, and evaluating a
+configuration only applies its transforms to those raw scores and
+combines them."""
+
+import sys
+import itertools
+import multiprocessing
+from itertools import izip
+from statistics import *
+from filter_criteria import *
+import xlrd
+from set_io import open_workbook_for
+from classifier import TrainingSet, TrainingCell, CellParameters, DEFAULT_CELL_PARAMETERS
+
+def extract_corpus(labelled_files, geometry, cache=None):
+    """[(path, bad_set, inputs)] of every (path, bad_set) that can be
+    read, inputs being TrainingSet.cell_inputs of the workbook"""
+    reader = TrainingSet(*geometry)
+    corpus = []
+    for f, bad_set in labelled_files:
+        try:
+            with open_workbook_for(f, reader, cache) as wb:
+                corpus.append((f, bad_set, reader.cell_inputs(wb)))
+        except (IOError, OSError, xlrd.XLRDError), e:
+            print >> sys.stderr, 'Skipping %s: %s' % (f, e)
+    return corpus
+
+def assign_folds(corpus, folds):
+    """Fold of every file, good and bad files are dealt out separately so
+    every fold gets its share of both
+
+    >>> assign_folds([('a', False, []), ('b', True, []), ('c', False, []), ('d', False, [])], 2)
+    [0, 0, 1, 0]
+    """
+    dealt = {False: 0, True: 0}
+    assignment = []
+    for path, bad_set, inputs in corpus:
+        assignment.append(dealt[bad_set] % folds)
+        dealt[bad_set] += 1
+    return assignment
+
+def raw_scores(corpus, geometry, folds):
+    """For every file, the scores of the innermost series of every cell
+    of a set trained with the other folds, one list per cell"""
+    assignment = assign_folds(corpus, folds)
+    parts = [TrainingSet(*geometry) for fold in range(folds)]
+    for (path, bad_set, inputs), fold in izip(corpus, assignment):
+        parts[fold].train_inputs(inputs, bad_set)
+
+    scores = [None] * len(corpus)
+    for fold in range(folds):
+        tset = TrainingSet(*geometry)
+        for other, part in enumerate(parts):
+            if other != fold:
+                tset.merge(part)
+        cells = [([innermost_series(s).compile() for s in tcell.value_classes],
+                  [innermost_series(s).compile() for s in tcell.type_classes]) for tcell in tset.training_cells]
+        for ndx, ((path, bad_set, inputs), file_fold) in enumerate(izip(corpus, assignment)):
+            if file_fold != fold:
+                continue
+            scores[ndx] = [[s.score(cell_value) for s in value_scorers] + [s.score(cell_type) for s in type_scorers]
+                           for (value_scorers, type_scorers), (cell_type, cell_value) 
+                           in izip(tset.input_cells(cells), inputs)]
+    return scores
+
+def slot_transforms(parameters):
+    """Transforms of every series of a TrainingCell built with parameters,
+    in the order of TrainingCell.score"""
+    tcell = TrainingCell(parameters)
+    return [series_transforms(s) for s in tcell.value_classes + tcell.type_classes]
+
+def parameter_grid(grid):
+    """Every combination of the values in grid, a dict of CellParameters
+    field to values, with the defaults for the fields not in grid
+
+    >>> [p.type_bias for p in parameter_grid({'type_bias': [1.5, 1.9]})]
+    [1.5, 1.9]
+    """
+    for name in grid:
+        if name not in CellParameters._fields:
+            raise ValueError('Unknown cell parameter %s, expected one of %s' % (name, ', '.join(CellParameters._fields)))
+    names = [name for name in CellParameters._fields if name in grid]
+    return [DEFAULT_CELL_PARAMETERS._replace(**dict(zip(names, values)))
+            for values in itertools.product(*[grid[name] for name in names])]
+
+def accuracy(probabilities, bad_labels):
+    right = sum(1 for prob, bad_set in izip(probabilities, bad_labels) if (prob >= 0.5) != bad_set)
+    return float(right) / len(probabilities) if probabilities else float('nan')
+
+def auc(probabilities, bad_labels):
+    """Probability that a good file scores higher than a bad one, ties
+    count as half
+
+    >>> auc([0.9, 0.8, 0.3, 0.8], [False, False, True, True])
+    0.875
+    """
+    ranked = sorted(izip(probabilities, bad_labels))
+    goods = sum(1 for bad_set in bad_labels if not bad_set)
+    bads = len(bad_labels) - goods
+    if not goods or not bads:
+        return float('nan')
+
+    # Sum of the (average, for ties) ranks of the good files
+    rank_sum = 0.0
+    ndx = 0
+    while ndx < len(ranked):
+        end = ndx
+        while end < len(ranked) and ranked[end][0] == ranked[ndx][0]:
+            end += 1
+        tied_goods = sum(1 for prob, bad_set in ranked[ndx:end] if not bad_set)
+        rank_sum += tied_goods * (ndx + end + 1) / 2.0
+        ndx = end
+    return (rank_sum - goods * (goods + 1) / 2.0) / (goods * bads)
+
+class RawScores(object):
+    """Raw scores of every file with its label, as a (files x cells x
+    series) array when numpy is available and every file has as many
+    cells, which the body of column templates doesn't"""
+    def __init__(self, scores, bad_labels):
+        self.scores = scores
+        self.bad_labels = bad_labels
+        self.array = None
+        try:
+            import numpy
+        except ImportError:
+            return
+        if len(set(len(cells) for cells in scores)) <= 1:
+            self.array = numpy.array(scores, dtype=float)
+
+    def probabilities(self, transforms):
+        """Probability of every file with the transforms of slot_transforms"""
+        if self.array is not None:
+            return self._probabilities_array(transforms)
+
+        probabilities = []
+        for cells in self.scores:
+            combined = BayesAccumulator()
+            for probs in cells:
+                for prob, transforms_of_slot in izip(probs, transforms):
+                    for transform, parameter in transforms_of_slot:
+                        prob = transform(prob, parameter)
+                    combined.add(prob)
+            probabilities.append(combined.probability)
+        return probabilities
+
+    def _probabilities_array(self, transforms):
+        import numpy
+        from vector_scoring import _array_transforms
+        with numpy.errstate(all='ignore'):
+            slots = []
+            for slot, transforms_of_slot in enumerate(transforms):
+                probs = self.array[:, :, slot]
+                for transform, parameter in transforms_of_slot:
+                    probs = _array_transforms[transform](probs, parameter)
+                slots.append(probs)
+            probs = numpy.concatenate(slots, axis=1)
+            certain_good = (probs >= 1).sum(axis=1)
+            certain_bad = (probs <= 0).sum(axis=1)
+            uncertain = (probs > 0) & (probs < 1)
+            log_odds = numpy.where(uncertain, numpy.log(probs) - numpy.log1p(-probs), 0).sum(axis=1)
+        return [odds_to_probability(float(l), int(g), int(b))
+                for l, g, b in izip(log_odds, certain_good, certain_bad)]
+
+    def evaluate(self, parameters):
+        """(parameters, accuracy, AUC) of a configuration"""
+        probabilities = self.probabilities(slot_transforms(parameters))
+        return (parameters, accuracy(probabilities, self.bad_labels), auc(probabilities, self.bad_labels))
+
+_worker_scores = None
+
+def _init_sweep_worker(scores):
+    global _worker_scores
+    _worker_scores = scores
+
+def _evaluate_in_worker(parameters):
+    return _worker_scores.evaluate(parameters)
+
+def sweep(scores, configurations, processes=1):
+    """Yields (parameters, accuracy, AUC) of every configuration, in order,
+    scores being a RawScores"""
+    if processes <= 1:
+        for parameters in configurations:
+            yield scores.evaluate(parameters)
+        return
+
+    pool = multiprocessing.Pool(processes, _init_sweep_worker, (scores,))
+    try:
+        for result in pool.imap(_evaluate_in_worker, configurations, chunksize=4):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -8,27 +8,9 @@ rm random_generated/verification/*xls 2>/dev/null
 
 python classifier.py --init test.set --rs 0 --re 3 --cs 0 --ce 8 --sheet=0
 
-train()
-{
-    case "$1" in
-	"bad") bad="--bad" ;;
-	*) bad="" ;;
-    esac
-	    
-    while read l
-    do
-	echo "Training using $l"
-	python classifier.py --train test.set $bad "$l"
-    done
-}
+python classifier.py --train-batch test.set good/training "random_generated/training/training*.xls"
 
-find good/training -type f -name "*.xls" | train good
-
-find random_generated -type f -name "training*.xls" | train good
-
-find bad/training -type f -name "*.xls" | train bad
-
-find misc_samples/training -type f -name "*.xls" | train bad
+python classifier.py --train-batch test.set --bad bad/training misc_samples/training
 
 find -maxdepth 3 -type f -name "*.xls" | grep -v "training" | while read l; 
 do
@@ -0,0 +1,197 @@
+"""Append-only log of the workbooks a set was trained with since it was
+last saved, next to the set as <set name>.log. Training appends to the
+log instead of rewriting the set, loading the set replays the log and
+saving the set (compacting it) removes the log.
+
+Layout: magic 'BXCLOG', uint16 format version and the generation of the
+saved set the log belongs to, then one record per workbook: uint32
+length, uint32 crc32 and a compressed pickle of (file hash, label,
+inputs), inputs being the (type, value) read for every training cell.
+
+Every save gives the set a new generation, so a log left behind by a
+crash between saving the set and removing the log is recognised as
+stale and ignored. A record cut short by a crash fails its length or
+checksum and is dropped.
+
+Saving a set and appending to its log both happen under the exclusive
+lock of the log (see lock_log), so records can't be appended between a
+set being read for saving and its log being removed, or to a log the
+set has just been saved past."""
+
+import os
+import sys
+import errno
+import uuid
+import zlib
+import struct
+import hashlib
+import cPickle
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # No locking where there is no flock, concurrent appends can interleave
+    fcntl = None
+
+MAGIC = 'BXCLOG'
+FORMAT_VERSION = 1
+LOG_EXTENSION = '.log'
+
+_preamble = struct.Struct('<6sH32s')
+_record = struct.Struct('<II')
+
+def new_generation():
+    return uuid.uuid4().hex
+
+def log_path(set_name):
+    return set_name + LOG_EXTENSION
+
+def contents_hash(contents):
+    return hashlib.sha1(contents).hexdigest()
+
+def file_hash(path):
+    """SHA-1 of the file's contents, as contents_hash gives"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _scan(f, path, generation, load=True):
+    """(records, end of the last intact record) of the log open as f, or
+    None if it isn't a log for this generation of the set. Records are
+    only checked against their length and checksum, not loaded, unless
+    load is set (records is then None)"""
+    f.seek(0)
+    preamble = f.read(_preamble.size)
+    if len(preamble) < _preamble.size:
+        return None
+    magic, version, log_generation = _preamble.unpack(preamble)
+    if magic != MAGIC:
+        raise ValueError('%s is not a training log' % (path))
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported training log format version %d' % (version))
+    if log_generation != generation:
+        print >> sys.stderr, 'Ignoring %s, it was written for an older version of the set' % (path)
+        return None
+
+    records = [] if load else None
+    end = f.tell()
+    while True:
+        head = f.read(_record.size)
+        if not head:
+            break
+        payload = ''
+        if len(head) == _record.size:
+            length, checksum = _record.unpack(head)
+            payload = f.read(length)
+        if len(head) < _record.size or len(payload) < length or zlib.crc32(payload) & 0xffffffff != checksum:
+            print >> sys.stderr, 'Dropping an incomplete record at the end of %s' % (path)
+            break
+        if load:
+            records.append(cPickle.loads(zlib.decompress(payload)))
+        end = f.tell()
+    return (records, end)
+
+def _lock(f, exclusive):
+    """Locks the log open as f until it is closed"""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+def _open_locked(path, exclusive):
+    """The log at path open and locked, created if exclusive, otherwise
+    None if there is none. A log removed while waiting for the lock is
+    opened again, the lock of a removed file protects nothing"""
+    while True:
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT if exclusive else os.O_RDONLY, 0666)
+        except OSError, e:
+            if e.errno == errno.ENOENT and not exclusive:
+                return None
+            raise
+        f = os.fdopen(fd, 'r+b' if exclusive else 'rb')
+        _lock(f, exclusive)
+        try:
+            if os.path.samestat(os.fstat(fd), os.stat(path)):
+                return f
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                f.close()
+                raise
+        f.close()
+
+@contextmanager
+def lock_log(set_name, exclusive=True):
+    """Holds the lock of the log of set_name for the with block, yielding
+    the open log for read_log and append_records. The exclusive lock
+    creates the log, the shared one yields None if there is none. The
+    set is only saved, and its log appended to, under the exclusive lock"""
+    f = _open_locked(log_path(set_name), exclusive)
+    try:
+        yield f
+    finally:
+        if f is not None:
+            f.close()
+
+def read_log(set_name, generation, log=None):
+    """Records logged for this generation of set_name, in the order they
+    were appended. log is the log when the caller holds its lock
+
+    >>> import tempfile
+    >>> set_name = os.path.join(tempfile.mkdtemp(), 'set')
+    >>> generation = new_generation()
+    >>> with lock_log(set_name) as log:
+    ...     append_records(set_name, generation, [('hash1', 'good', [(1, u'a')])], log)
+    ...     append_records(set_name, generation, [('hash2', 'bad', [(2, 3.0)])], log)
+    >>> read_log(set_name, generation)
+    [('hash1', 'good', [(1, u'a')]), ('hash2', 'bad', [(2, 3.0)])]
+    >>> with open(log_path(set_name), 'ab') as f:
+    ...     f.write(_record.pack(100, 0) + 'cut short')
+    >>> len(read_log(set_name, generation))
+    2
+    >>> with lock_log(set_name) as log:
+    ...     append_records(set_name, generation, [('hash3', 'good', [])], log)
+    ...     [record[0] for record in read_log(set_name, generation, log)]
+    ['hash1', 'hash2', 'hash3']
+    >>> remove_log(set_name)
+    >>> read_log(set_name, generation)
+    []
+    """
+    path = log_path(set_name)
+    if log is not None:
+        scanned = _scan(log, path, generation)
+    else:
+        with lock_log(set_name, exclusive=False) as f:
+            scanned = f and _scan(f, path, generation)
+    return scanned[0] if scanned else []
+
+def append_records(set_name, generation, records, log):
+    """Appends (file hash, label, inputs) records to the log of set_name,
+    held locked by the caller (see lock_log), starting a new log if there 
+    is none for this generation. generation must be the set's, read under 
+    the lock, a log for any other generation is then a stale one"""
+    path = log_path(set_name)
+    scanned = _scan(log, path, generation, load=False)
+    if scanned is None:
+        log.seek(0)
+        log.truncate()
+        log.write(_preamble.pack(MAGIC, FORMAT_VERSION, str(generation)))
+    else:
+        # Records appended after a damaged one would never be read
+        log.seek(scanned[1])
+        log.truncate()
+
+    for record in records:
+        payload = zlib.compress(cPickle.dumps(record, protocol=2))
+        log.write(_record.pack(len(payload), zlib.crc32(payload) & 0xffffffff))
+        log.write(payload)
+    log.flush()
+    os.fsync(log.fileno())
+
+def remove_log(set_name):
+    if os.path.exists(log_path(set_name)):
+        os.remove(log_path(set_name))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,147 @@
+"""NumPy backend for scoring a whole grid of compiled cells at once.
+Importing this module fails without numpy, callers fall back to the
+pure Python CompiledTrainingSet in that case."""
+
+import numpy
+from statistics import *
+from filter_criteria import *
+
+# Cell types as returned by xlrd's row_types, 0 (empty) to 6 (blank)
+TYPE_CODES = 7
+
+def _bias_array(prob, exponent):
+    return numpy.where(prob >= 0.5,
+                       numpy.power((prob - 0.5) * 2, exponent) / 2 + 0.5,
+                       numpy.power(prob * 2, exponent) / 2)
+
+def _moderation_array(prob, moderation):
+    return numpy.where(prob >= 0.5,
+                       numpy.power((prob - 0.5) * 2, moderation) / 2.0 + 0.5,
+                       numpy.power(prob * 2, 1.0 / moderation) / 2.0)
+
+def _confidence_array(prob, confidence):
+    return prob * confidence + (0.5 * (1 - confidence))
+
+_array_transforms = {adjust_for_bias: _bias_array,
+                     adjust_for_moderation: _moderation_array,
+                     adjust_for_confidence: _confidence_array}
+
+def _numeric_side_array(values, parameters):
+    """Vectorised filter_criteria._numeric_side_score, parameters is an
+    array with one (mean, stdev, confidence, corrected confidence) row
+    per cell and a NaN mean where there were too few samples"""
+    mean, stdev, confidence, corrected = parameters.T
+    constant = stdev == 0
+    probability = 1.0 / (numpy.square(numpy.abs(values - mean) / numpy.where(constant, 1, stdev)) + 1)
+    return numpy.where(constant,
+                       _confidence_array((values == mean).astype(float), confidence),
+                       _confidence_array(probability, corrected))
+
+class _NumericSlot(object):
+    """Numeric series of every cell, they must share the same transforms"""
+    def __init__(self, scorers):
+        to_row = lambda (mean, stdev, confidence, corrected): (
+            numpy.nan if mean is None else mean, stdev, confidence, corrected)
+        self.good_parameters = numpy.array([to_row(s.good_parameters) for s in scorers], dtype=float)
+        self.bad_parameters = numpy.array([to_row(s.bad_parameters) for s in scorers], dtype=float)
+        self.non_numeric = numpy.array([s.non_numeric_probability for s in scorers])
+        self.transforms = [(_array_transforms[transform], parameter) for transform, parameter
+                           in scorers[0].transforms]
+
+    def score(self, numbers, is_number, types, values):
+        count = len(numbers)
+        good_prob = _numeric_side_array(numbers, self.good_parameters[:count])
+        bad_prob = _numeric_side_array(numbers, self.bad_parameters[:count])
+        prob = good_prob / (good_prob + bad_prob)
+        for transform, parameter in self.transforms:
+            prob = transform(prob, parameter)
+        return numpy.where(is_number, prob, self.non_numeric[:count])
+
+class _TableSlot(object):
+    """Series whose input has few possible values, scored by indexing a
+    (cells x inputs) table with the code of each cell's input"""
+    def __init__(self, scorers, inputs, codes):
+        self.table = numpy.array([[s.score(i) for i in inputs] for s in scorers])
+        self.codes = codes
+
+    def score(self, numbers, is_number, types, values):
+        codes = self.codes(types, values)
+        return self.table[numpy.arange(len(codes)), codes]
+
+class _LookupSlot(object):
+    """Any other series, one Python call per cell"""
+    def __init__(self, scorers, uses_type):
+        self.scorers = scorers
+        self.uses_type = uses_type
+
+    def score(self, numbers, is_number, types, values):
+        inputs = types if self.uses_type else values
+        return numpy.array([s.score(i) for s, i in zip(self.scorers, inputs)])
+
+def _has_value_codes(types, values):
+    return numpy.array([has_value(v) for v in values], dtype=int)
+
+def _type_codes(types, values):
+    return numpy.clip(numpy.asarray(types, dtype=int), 0, TYPE_CODES - 1)
+
+def _slot_for(scorers, uses_type):
+    kinds = set(type(s) for s in scorers)
+    if kinds == set([CompiledNumericSeries]) and not uses_type:
+        transforms = set(tuple(t for t, p in s.transforms) for s in scorers)
+        parameters = set(tuple(p for t, p in s.transforms) for s in scorers)
+        if len(transforms) == 1 and len(parameters) == 1 and all(t in _array_transforms for t in transforms.pop()):
+            return _NumericSlot(scorers)
+    elif kinds == set([CompiledNominalSeries]):
+        if uses_type:
+            return _TableSlot(scorers, range(TYPE_CODES), _type_codes)
+        if all(s.map_has_value for s in scorers):
+            return _TableSlot(scorers, [False, True], _has_value_codes)
+    return _LookupSlot(scorers, uses_type)
+
+class GridScorer(object):
+    """Scores every cell of a grid against compiled cells, one array
+    operation per series instead of one call per cell and series.
+
+    >>> from classifier import TrainingCell
+    >>> from spreadsheet import XlsType
+    >>> cells = [TrainingCell() for i in range(3)]
+    >>> for n in range(40):
+    ...     for ndx, tcell in enumerate(cells):
+    ...         tcell.good(XlsType.xls_float, 10.0 + n % 7 + ndx)
+    ...         tcell.bad(XlsType.xls_string, 'x%d' % (n % 3))
+    >>> compiled = [tcell.compile() for tcell in cells]
+    >>> types, values = [2, 1, 0], [12.0, 'x1', '']
+    >>> grid = GridScorer(compiled).score_grid(types, values)
+    >>> expected = [c.score(t, v) for c, t, v in zip(compiled, types, values)]
+    >>> float(numpy.abs(grid - numpy.array(expected)).max()) < 1e-12
+    True
+    """
+    def __init__(self, compiled_cells):
+        self.cell_count = len(compiled_cells)
+        value_slots = zip(*[c.value_scorers for c in compiled_cells])
+        type_slots = zip(*[c.type_scorers for c in compiled_cells])
+        self.slots = ([_slot_for(list(scorers), False) for scorers in value_slots] +
+                      [_slot_for(list(scorers), True) for scorers in type_slots])
+
+    def score_grid(self, types, values):
+        """Returns a (cells x series) array with the same probabilities
+        CompiledCell.score gives, for the first len(values) cells"""
+        numbers = [as_number(v) for v in values]
+        is_number = numpy.array([n is not None for n in numbers], dtype=bool)
+        numbers = numpy.array([0.0 if n is None else n for n in numbers], dtype=float)
+        with numpy.errstate(all='ignore'):
+            columns = [slot.score(numbers, is_number, types, values) for slot in self.slots]
+        return numpy.column_stack(columns)
+
+def combine_array(probs):
+    """bayes_combine over every element of probs, summing log odds"""
+    probs = numpy.ravel(probs)
+    certain_good = probs >= 1
+    certain_bad = probs <= 0
+    uncertain = probs[~(certain_good | certain_bad)]
+    total_log_odds = float(numpy.sum(numpy.log(uncertain) - numpy.log1p(-uncertain)))
+    return odds_to_probability(total_log_odds, int(certain_good.sum()), int(certain_bad.sum()))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()